@@ -0,0 +1,137 @@
+"""
+批量审核
+
+从JSONL文件逐行读取{"id": 可选, "document": 待审核文档, "query": 任务指令}，
+用线程池并发跑智能体，每完成一条就把结果追加写入输出的JSONL文件。
+输出文件中已经成功的记录在重跑时会被跳过，中途崩溃后重新执行同一命令即可续跑。
+默认开启相似文档复用：和已审核文档（包括之前批次的）足够相似的文案沿用其结论，只审核改动的句子，
+输出记录的reused字段为沿用的已审核文档编号。
+
+用法：python Batch_Audit.py input.jsonl output.jsonl --workers 8 [--no-reuse]
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import Casa_QA
+from Casa_QA import new_state, run_turn, safety_filter
+from Config.Events import ConsolePrinter
+from Config.Limiter import request_priority
+
+
+def record_id(record: dict) -> str:
+    """
+    优先使用记录自带的id，否则用文档和指令的哈希，保证重跑时id不变
+    """
+    if record.get("id"):
+        return str(record["id"])
+    data = f"{record.get('document', '')}\0{record.get('query', '')}".encode("utf-8")
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+def load_records(path: str) -> list:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                record["id"] = record_id(record)
+                records.append(record)
+    return records
+
+
+def load_finished(path: str) -> set:
+    """
+    输出文件中已经成功的记录id，最后一行写了一半的情况直接忽略
+    """
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get("status") == "ok":
+                finished.add(result["id"])
+    return finished
+
+
+def audit(record: dict, verbose: bool = False) -> dict:
+    """
+    单条记录跑完整的智能体流程，异常不外抛，记录为失败状态。verbose为True时把过程打印到控制台
+    """
+    start = time.time()
+    state = new_state()
+    state["query"] = record.get("query", "")
+    state["response"] = ""
+    try:
+        subscriber = ConsolePrinter() if verbose else None
+        # 和交互问答共用一个模型服务时，批量审核只用交互请求剩下的容量
+        with request_priority("batch"):
+            state = run_turn(state, record.get("document", ""), request_id=record["id"], subscriber=subscriber)
+        result = {
+            "id": record["id"],
+            "status": "ok",
+            "response": state["response"],
+            "n_loop": state.get("n_loop", 0),
+            "stop_reason": state.get("stop_reason", ""),
+        }
+        if state.get("reused"):
+            result["reused"] = state["reused"]
+    except Exception as e:
+        result = {"id": record["id"], "status": "error", "error": f"{type(e).__name__}: {e}"}
+    result["latency"] = round(time.time() - start, 3)
+    return result
+
+
+def run_batch(input_path: str, output_path: str, workers: int = 4, verbose: bool = False) -> dict:
+    records = load_records(input_path)
+    finished = load_finished(output_path)
+    todo = [record for record in records if record["id"] not in finished]
+    print(f"共{len(records)}条，已完成{len(records) - len(todo)}条，待处理{len(todo)}条", file=sys.stderr)
+
+    write_lock = Lock()
+    counts = {"ok": 0, "error": 0}
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    # 并发执行时各会话的流式输出会混在一起，默认不订阅事件，不打印
+    with open(output_path, "a", encoding="utf-8") as out:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(audit, record, verbose) for record in todo]
+            for future in as_completed(futures):
+                result = future.result()
+                with write_lock:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                    counts[result["status"]] += 1
+                print(
+                    f"[{counts['ok'] + counts['error']}/{len(todo)}] {result['id']} {result['status']} {result['latency']}s",
+                    file=sys.stderr,
+                )
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量审核宣传文档")
+    parser.add_argument("input", help="输入JSONL文件，每行包含document和query")
+    parser.add_argument("output", help="输出JSONL文件，已存在时续跑")
+    parser.add_argument("--workers", type=int, default=4, help="并发会话数")
+    parser.add_argument("--verbose", action="store_true", help="打印每个会话的流式输出")
+    parser.add_argument("--no-reuse", action="store_true", help="每条文档都完整审核，不沿用相似文档的结论")
+    args = parser.parse_args()
+
+    Casa_QA.document_reuse = not args.no_reuse
+
+    counts = run_batch(args.input, args.output, args.workers, args.verbose)
+    print(f"完成：成功{counts['ok']}条，失败{counts['error']}条", file=sys.stderr)
+    print(safety_filter.report(), file=sys.stderr)
+    if Casa_QA.document_reuse:
+        stats = Casa_QA.document_store().stats()
+        print(f"相似文档复用：命中{stats['hits']}条，未命中{stats['misses']}条，指纹库共{stats['documents']}份文档", file=sys.stderr)
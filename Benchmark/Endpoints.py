@@ -0,0 +1,91 @@
+"""
+多服务连接池测试
+
+在本地启动几个模拟服务（Benchmark/StubServer.py）：一个稳定、一个有长尾延迟、一个经常失败，
+用Config/Pool.py的连接池并发发请求，对比开关对冲时的首token耗时，并输出各服务分到的请求数、错误数和熔断状态。
+
+用法：python -m Benchmark.Endpoints --requests 200 --concurrency 8
+"""
+
+import time
+import asyncio
+import argparse
+import Config.Pool as pool_config
+from Config.Pool import ChatModelPool
+from .StubServer import start_stub
+from .Suite import percentile
+
+
+def start_stubs(ttft: float, slow_ttft: float) -> list:
+    return [
+        start_stub(name="稳定", ttft=ttft),
+        start_stub(name="长尾", ttft=ttft, slow_rate=0.2, slow_ttft=slow_ttft),
+        start_stub(name="故障", ttft=ttft, fail_rate=0.6),
+    ]
+
+
+def endpoints(stubs: list) -> list:
+    return [
+        {"url": stub.url, "api_key": "EMPTY", "model": "stub", "name": stub.name, "max_concurrency": 4}
+        for stub in stubs
+    ]
+
+
+async def run(pool: ChatModelPool, n_requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    ttfts, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            first = None
+            try:
+                async for chunk in pool.astream(f"请求{i}"):
+                    if first is None:
+                        first = time.perf_counter() - start
+            except Exception:
+                errors += 1
+            if first is not None:
+                ttfts.append(first)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(n_requests)])
+    elapsed = time.perf_counter() - start
+    return {
+        "throughput": n_requests / elapsed,
+        "p50_ms": percentile(ttfts, 0.5) * 1000,
+        "p95_ms": percentile(ttfts, 0.95) * 1000,
+        "p99_ms": percentile(ttfts, 0.99) * 1000,
+        "errors": errors,
+    }
+
+
+def report(name: str, result: dict, pool: ChatModelPool) -> str:
+    lines = [
+        f"{name}：吞吐{result['throughput']:.1f}/s，首token p50 {result['p50_ms']:.0f}ms、p95 {result['p95_ms']:.0f}ms、"
+        f"p99 {result['p99_ms']:.0f}ms，失败{result['errors']}次"
+    ]
+    for stats in pool.stats():
+        ttft = "-" if stats["ttft_ms"] is None else f"{stats['ttft_ms']:.0f}ms"
+        lines.append(f"    {stats['name']:<6}请求{stats['requests']:>5} 错误{stats['errors']:>4} 首token均值{ttft:>8} 状态{stats['state']}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="多服务连接池测试")
+    parser.add_argument("--requests", type=int, default=200, help="请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时在跑的请求数")
+    parser.add_argument("--ttft", type=float, default=0.05, help="模拟服务的正常首token延迟，秒")
+    parser.add_argument("--slow-ttft", type=float, default=1.0, help="长尾请求的首token延迟，秒")
+    args = parser.parse_args()
+
+    pool_config.hedge_min_delay = args.ttft * 2
+    for hedge in [False, True]:
+        pool_config.hedge_enabled = hedge
+        stubs = start_stubs(args.ttft, args.slow_ttft)
+        pool = ChatModelPool.from_config(endpoints(stubs))
+        result = asyncio.run(run(pool, args.requests, args.concurrency))
+        print(report("对冲" if hedge else "不对冲", result, pool))
+        for stub in stubs:
+            stub.shutdown()
@@ -0,0 +1,85 @@
+"""
+启动耗时测试
+
+每一项都在新的子进程里执行，排除模块缓存的影响，重复多次取中位数。
+
+用法：python -m Benchmark.ImportTime --repeat 5
+"""
+
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# (名称, 计时代码)，知识库相关的几项先导入Tools.Search再计时，只比较数据加载本身
+search = "import Tools.Search\n"
+cases = [
+    ("import Tools.Search", "import Tools.Search"),
+    ("import Casa_QA", "import Casa_QA"),
+    ("import Casa_QA+构建图", "import Casa_QA\nCasa_QA.get_app()"),
+    (
+        "JSON加载规则库和术语库",
+        "import json\n"
+        "for path in ['Tools/Search/rules.json', 'Tools/Search/insurance_terms.json', 'Tools/Search/consumer_protection_terms.json']:\n"
+        "    json.load(open(path, encoding='utf-8'))",
+    ),
+    (
+        "知识库映射",
+        search + "from Tools.Search.KnowledgeBase import knowledge_base\nknowledge_base()",
+    ),
+    (
+        "知识库映射+首次检索",
+        search + "from Tools.Search.KnowledgeBase import knowledge_base\n"
+        "kb = knowledge_base()\n"
+        "kb.rules_index.search('分红险保证收益', 10)\n"
+        "kb.automaton('insurance').find_all('犹豫期内退保')",
+    ),
+    (
+        "JSON加载+构建索引和自动机",
+        search + "import json\n"
+        "from Tools.Search.BM25Index import BM25Index\n"
+        "from Tools.Search.AhoCorasick import AhoCorasick\n"
+        "rules = json.load(open('Tools/Search/rules.json', encoding='utf-8'))\n"
+        "BM25Index().build([rule['fileName'] + rule['rule'] for rule in rules])\n"
+        "for path in ['Tools/Search/insurance_terms.json', 'Tools/Search/consumer_protection_terms.json']:\n"
+        "    AhoCorasick(json.load(open(path, encoding='utf-8')))",
+    ),
+]
+
+runner = """
+import time, json
+{setup}
+start = time.perf_counter()
+{code}
+print(json.dumps((time.perf_counter() - start) * 1000))
+"""
+
+
+def measure(code: str, repeat: int) -> list:
+    setup, code = code.split("\n", 1) if code.startswith(search) else ("", code)
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", runner.format(setup=setup, code=code)],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="启动耗时测试")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数")
+    args = parser.parse_args()
+
+    # 先编译一次知识库，后面测的是已编译的情况
+    from Tools.Search.KnowledgeBase import compile_kb
+
+    compile_kb()
+    print(f"{'测试项':<28}{'中位数ms':>10}{'最小ms':>10}")
+    for name, code in cases:
+        timings = measure(code, args.repeat)
+        print(f"{name:<28}{statistics.median(timings):>10.1f}{min(timings):>10.1f}")
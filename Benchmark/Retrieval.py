@@ -0,0 +1,130 @@
+"""
+规则和术语检索的召回与耗时测试
+
+规则检索对比四种做法：把全部规则写进提示词（召回率100%，但提示词最长）、只用BM25、只用语义检索、两者融合，
+统计命中率（前k条里至少有一条相关规则）、召回率（相关规则被召回的比例）、单次检索耗时和规则部分的提示词token数。
+语义检索另测一次批量查询（所有样例一次矩阵乘法）的平均耗时。
+术语检索统计工具调用给出的说法不在术语库时，原词查询和语义检索给出正确结果的比例：
+expected为null的样例是术语库里只有上位或下位概念（比如投保人年龄和投保人），不找到任何术语才算正确。
+
+用法：python -m Benchmark.Retrieval --k 10 --repeat 20
+"""
+
+import json
+import time
+import argparse
+from Config.Context import estimate_tokens
+from Tools.Search.KnowledgeBase import knowledge_base
+from Tools.Search.SemanticIndex import split_text
+from Tools.Search.RulesSearch import search_rules, semantic_min_score
+from Tools.Search.TermsSearch import nearest_terms
+from .Suite import percentile
+
+cases_path = "Benchmark/retrieval_cases.jsonl"
+
+
+def load_cases(path: str = cases_path):
+    with open(path, "r", encoding="utf-8") as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+    return [case for case in cases if "rules" in case], [case for case in cases if "term" in case]
+
+
+def timed(func, items: list, repeat: int):
+    """
+    返回(每个样例的结果, 每次调用的耗时列表)
+    """
+    results = [func(item) for item in items]
+    latencies = []
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter()
+            func(item)
+            latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def rules_report(cases: list, k: int, repeat: int) -> list:
+    kb = knowledge_base()
+    semantic = kb.semantic("rules")
+    all_rules = list(range(len(kb.rules)))
+
+    def bm25(case):
+        return [doc_id for doc_id, _ in kb.rules_index.search(case["text"], k=k)]
+
+    def dense(case):
+        return [doc_id for doc_id, _ in semantic.search(split_text(case["text"]), k=k, min_score=semantic_min_score)]
+
+    def hybrid(case):
+        return [doc_id for doc_id, _ in search_rules(case["text"], k=k)]
+
+    methods = [("全部规则", lambda case: all_rules), ("BM25", bm25)]
+    if semantic is not None:
+        methods += [("语义", dense), ("BM25+语义", hybrid)]
+
+    rows = []
+    for name, func in methods:
+        results, latencies = timed(func, cases, repeat)
+        hits = [bool(set(result) & set(case["rules"])) for result, case in zip(results, cases)]
+        recalls = [len(set(result) & set(case["rules"])) / len(case["rules"]) for result, case in zip(results, cases)]
+        tokens = [estimate_tokens(str([kb.rules[doc_id] for doc_id in result])) for result in results]
+        rows.append(
+            {
+                "method": name,
+                "hit_rate": sum(hits) / len(cases),
+                "recall": sum(recalls) / len(cases),
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "prompt_tokens": sum(tokens) / len(tokens),
+            }
+        )
+
+    if semantic is not None:
+        # 所有样例的句子一次编码、一次矩阵乘法
+        sentences = [sentence for case in cases for sentence in split_text(case["text"])]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            semantic.scores(sentences)
+        per_query = (time.perf_counter() - start) / repeat / len(cases)
+        rows.append({"method": "语义(批量)", "p50_ms": per_query * 1000})
+    return rows
+
+
+def terms_report(cases: list) -> list:
+    kb = knowledge_base()
+    rows = []
+    exact = [(case["term"] if case["term"] in kb.terms(case["glossary"]) else None) == case["expected"] for case in cases]
+    rows.append({"method": "原词查询", "hit_rate": sum(exact) / len(cases)})
+    if all(kb.semantic(case["glossary"]) is not None for case in cases):
+        found = []
+        for case in cases:
+            glossary = kb.terms(case["glossary"])
+            term = nearest_terms([case["term"]], glossary, kb.semantic(case["glossary"]))[0]
+            found.append(term == case["expected"])
+        rows.append({"method": "语义检索", "hit_rate": sum(found) / len(cases)})
+    return rows
+
+
+def report(rules: list, terms: list, k: int) -> str:
+    lines = [f"规则检索（前{k}条）", f"{'方法':<12}{'命中率':>8}{'召回率':>8}{'p50ms':>10}{'p95ms':>10}{'规则token':>10}"]
+    for r in rules:
+        if "hit_rate" not in r:
+            lines.append(f"{r['method']:<12}{'-':>8}{'-':>8}{r['p50_ms']:>10.3f}{'-':>10}{'-':>10}")
+            continue
+        lines.append(
+            f"{r['method']:<12}{r['hit_rate']:>8.2f}{r['recall']:>8.2f}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}{r['prompt_tokens']:>10.0f}"
+        )
+    lines.append("术语检索（说法不在术语库）")
+    for r in terms:
+        lines.append(f"{r['method']:<12}{r['hit_rate']:>8.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="检索召回与耗时测试")
+    parser.add_argument("--cases", default=cases_path, help="标注样例JSONL")
+    parser.add_argument("--k", type=int, default=10, help="规则检索返回的条数")
+    parser.add_argument("--repeat", type=int, default=20, help="耗时测试的重复次数")
+    args = parser.parse_args()
+
+    rule_cases, term_cases = load_cases(args.cases)
+    print(report(rules_report(rule_cases, args.k, args.repeat), terms_report(term_cases), args.k))
@@ -0,0 +1,85 @@
+"""
+请求调度测试
+
+用本地模拟模型模拟同一个模型服务上的两类负载：多个批量审核会话不停地发请求，同时一个交互会话隔一会儿发一次请求。
+对比不分优先级（所有请求先到先得）和按Config/Limiter.py的优先级调度时，交互请求的耗时和批量请求的吞吐，
+可以再加上每分钟请求数和token数的限制看令牌桶的效果。
+
+用法：python -m Benchmark.Scheduler --seconds 5 --batch-workers 16 --concurrency 4 --ttft 0.05
+"""
+
+import time
+import asyncio
+import argparse
+import Config.Limiter as limiter_config
+from Config.Limiter import RequestScheduler, LimitedChatModel, request_priority
+from Config.MockLLM import MockChatModel
+from .Suite import percentile
+
+
+async def run(model, seconds: float, batch_workers: int, interval: float, priority: bool) -> dict:
+    deadline = time.perf_counter() + seconds
+    batch_calls = 0
+    latencies = []
+
+    async def batch_worker(i):
+        nonlocal batch_calls
+        # 不分优先级时批量请求和交互请求同属一类，先到先得
+        with request_priority("batch" if priority else "interactive"):
+            n = 0
+            while time.perf_counter() < deadline:
+                async for _ in model.astream(f"批量{i}-{n}"):
+                    pass
+                n += 1
+                batch_calls += 1
+
+    async def interactive_worker():
+        n = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            async for _ in model.astream(f"交互{n}"):
+                pass
+            latencies.append(time.perf_counter() - start)
+            n += 1
+            await asyncio.sleep(interval)
+
+    start = time.perf_counter()
+    await asyncio.gather(interactive_worker(), *[batch_worker(i) for i in range(batch_workers)])
+    elapsed = time.perf_counter() - start
+    return {
+        "interactive_p50_ms": percentile(latencies, 0.5) * 1000,
+        "interactive_p95_ms": percentile(latencies, 0.95) * 1000,
+        "interactive_n": len(latencies),
+        "batch_throughput": batch_calls / elapsed,
+    }
+
+
+def report(name: str, result: dict, scheduler: RequestScheduler) -> str:
+    stats = scheduler.stats()
+    depth = "、".join(f"{k}{v}" for k, v in stats["max_waiting"].items() if v)
+    return (
+        f"{name}：交互请求{result['interactive_n']}次 p50 {result['interactive_p50_ms']:.0f}ms、"
+        f"p95 {result['interactive_p95_ms']:.0f}ms，批量吞吐{result['batch_throughput']:.1f}次/s，"
+        f"最大排队数 {depth or '0'}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="请求调度测试")
+    parser.add_argument("--seconds", type=float, default=5.0, help="每种调度方式的测试时长")
+    parser.add_argument("--batch-workers", type=int, default=16, help="批量审核的并发会话数")
+    parser.add_argument("--concurrency", type=int, default=4, help="模型服务的并发上限")
+    parser.add_argument("--interval", type=float, default=0.1, help="交互请求的间隔，秒")
+    parser.add_argument("--ttft", type=float, default=0.05, help="模拟首token延迟，秒")
+    parser.add_argument("--tps", type=float, default=0.0, help="模拟输出速度，token/秒，0为不限速")
+    parser.add_argument("--rpm", type=int, default=0, help="每分钟请求数限制，0为不限")
+    parser.add_argument("--tpm", type=int, default=0, help="每分钟token数限制，0为不限")
+    args = parser.parse_args()
+
+    for priority in [False, True]:
+        # 不分优先级时也不给交互请求预留名额
+        limiter_config.reserved_slots = 1 if priority else 0
+        scheduler = RequestScheduler(args.concurrency, args.rpm, args.tpm)
+        model = LimitedChatModel(MockChatModel(ttft=args.ttft, tokens_per_second=args.tps), scheduler)
+        result = asyncio.run(run(model, args.seconds, args.batch_workers, args.interval, priority))
+        print(report("优先级调度" if priority else "先到先得", result, scheduler))
@@ -0,0 +1,141 @@
+"""
+本地模拟模型服务
+
+兼容OpenAI的/v1/chat/completions接口（流式和非流式），回复固定文本，首token延迟、长尾延迟、输出速度和失败率可调，
+用来在本地测试Config/Pool.py的负载均衡、对冲和熔断，不访问远程服务。
+
+用法：
+    python -m Benchmark.StubServer --port 8001 --ttft 0.2
+    python -m Benchmark.StubServer --port 8002 --ttft 0.2 --slow-rate 0.1 --slow-ttft 3 --fail-rate 0.2
+"""
+
+import json
+import time
+import random
+import argparse
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持长连接，连接池可以复用
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server.requests += 1
+        if random.random() < server.fail_rate:
+            self.send_json(500, {"error": {"message": "stub failure", "type": "server_error"}})
+            return
+        time.sleep(server.slow_ttft if random.random() < server.slow_rate else server.ttft)
+        text = f"{server.name}回复：{server.reply}"
+        model = body.get("model", "stub")
+        if not body.get("stream"):
+            self.send_json(
+                200,
+                {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": len(text), "total_tokens": len(text) + 1},
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [text[i : i + 4] for i in range(0, len(text), 4)]
+        for i, piece in enumerate(pieces):
+            if i and server.tps:
+                time.sleep(len(piece) / server.tps)
+            self.send_event({"role": "assistant", "content": piece} if i == 0 else {"content": piece}, model)
+        self.send_event({}, model, finish_reason="stop")
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def send_json(self, status: int, data: dict):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_event(self, delta: dict, model: str, finish_reason: str = None):
+        data = {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self.write_chunk(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        ttft: float = 0.0,
+        tps: float = 0.0,
+        fail_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_ttft: float = 0.0,
+        name: str = "stub",
+        reply: str = "文案存在违规内容。",
+    ):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.ttft = ttft
+        self.slow_rate = slow_rate  # 这个比例的请求首token延迟为slow_ttft，模拟长尾
+        self.slow_ttft = slow_ttft
+        self.tps = tps
+        self.fail_rate = fail_rate
+        self.name = name
+        self.reply = reply
+        self.requests = 0
+
+    def handle_error(self, request, client_address):
+        # 对冲失败的一方会被客户端提前断开，不打印
+        pass
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+def start_stub(**kwargs) -> StubServer:
+    """
+    在后台线程启动一个模拟服务，port为0时自动分配端口，地址见server.url
+    """
+    server = StubServer(**kwargs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟模型服务")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.0, help="首token延迟，秒")
+    parser.add_argument("--tps", type=float, default=0.0, help="输出速度，字/秒，0为不限速")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="返回500错误的比例")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="首token特别慢的请求比例")
+    parser.add_argument("--slow-ttft", type=float, default=0.0, help="慢请求的首token延迟，秒")
+    parser.add_argument("--name", default="stub", help="回复中带上的服务名，便于区分")
+    args = parser.parse_args()
+
+    server = StubServer(args.port, args.ttft, args.tps, args.fail_rate, args.slow_rate, args.slow_ttft, args.name)
+    print(f"模拟服务已启动：{server.url}")
+    server.serve_forever()
@@ -0,0 +1,308 @@
+"""
+性能测试
+
+用Config/MockLLM.py的本地模拟模型跑完整的图和各检索环节，统计吞吐、p50/p95耗时和内存占用，
+不访问远程服务，结果可以保存下来作为基线，之后对比发现性能回退。
+
+用法：
+    python -m Benchmark.Suite --repeat 3 --concurrency 8 --ttft 0 --tps 0
+    python -m Benchmark.Suite --save bench.json
+    python -m Benchmark.Suite --baseline bench.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块
+    resource = None
+
+samples_path = "Benchmark/samples.jsonl"
+
+
+class NullConsole:
+    """
+    检索环节测试时不打印
+    """
+
+    def print(self, *args, **kwargs):
+        pass
+
+    def write(self, text: str):
+        pass
+
+
+def load_samples(path: str = samples_path) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 if sys.platform != "darwin" else rss / 1024 / 1024  # Linux单位KB，macOS单位字节
+
+
+def summarize(name: str, latencies: list, elapsed: float, peak: int = None) -> dict:
+    return {
+        "case": name,
+        "n": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "max_rss_mb": max_rss_mb(),
+        "py_peak_mb": None if peak is None else peak / 1024 / 1024,
+    }
+
+
+def measure(name: str, func, items: list, trace_memory: bool = False) -> dict:
+    """
+    逐个执行func(item)，记录每次耗时
+    """
+    if trace_memory:
+        tracemalloc.start()
+    latencies = []
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        func(item)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return summarize(name, latencies, elapsed, peak)
+
+
+def setup_mock(ttft: float, tps: float, cache: bool):
+    """
+    把底层模型换成模拟模型，默认去掉缓存层，让每次调用都走完整链路
+    """
+    import Config.LLM_Client as client
+    import Config.Trace as trace
+    from Config.Proxy import ChatModelProxy
+    from Config.Cache import CachedChatModel
+    from Config.MockLLM import MockChatModel
+
+    client.use_chat_model(MockChatModel(ttft=ttft, tokens_per_second=tps))
+    proxy = client.llm
+    while not cache and isinstance(proxy.model, ChatModelProxy):
+        if isinstance(proxy.model, CachedChatModel):
+            proxy.model = proxy.model.model
+            break
+        proxy = proxy.model
+    # 测试产生的trace不混进正式记录
+    trace.trace_path = "traces/benchmark_trace.jsonl"
+    trace.metrics_path = "traces/benchmark_metrics.json"
+
+    # 模拟模型生成的术语定义写到临时目录，不污染正式的生成术语库
+    import Tools.Search.TermsSearch as terms_search
+    from Tools.Search.GeneratedGlossary import GeneratedGlossary
+
+    tmp_dir = tempfile.mkdtemp(prefix="cpir_bench_")
+    terms_search.insurance_generated = GeneratedGlossary("保险术语", os.path.join(tmp_dir, "insurance.json"))
+    terms_search.consumer_protection_generated = GeneratedGlossary(
+        "消保术语", os.path.join(tmp_dir, "consumer_protection.json")
+    )
+
+
+def bench_graph(samples: list, repeat: int, concurrency: int, trace_memory: bool) -> list:
+    import Casa_QA
+
+    def run(sample):
+        state = Casa_QA.new_state()
+        state["query"] = sample["query"]
+        Casa_QA.run_turn(state, sample["document"])
+
+    async def arun_all(items):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def arun(sample):
+            async with semaphore:
+                state = Casa_QA.new_state()
+                state["query"] = sample["query"]
+                t = time.perf_counter()
+                await Casa_QA.arun_turn(state, sample["document"])
+                latencies.append(time.perf_counter() - t)
+
+        await asyncio.gather(*[arun(sample) for sample in items])
+        return latencies
+
+    def stream(sample):
+        state = Casa_QA.new_state()
+        state["query"] = sample["query"]
+        for _ in Casa_QA.stream_turn(state, sample["document"]):
+            pass
+
+    items = samples * repeat
+    results = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run(samples[0])  # 预热：知识库映射、图编译、工具绑定
+        results.append(measure("图-同步", run, items, trace_memory))
+        results.append(measure("图-同步事件流", stream, items, trace_memory))
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        latencies = asyncio.run(arun_all(items))
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    results.append(summarize(f"图-异步x{concurrency}", latencies, elapsed, peak))
+    return results
+
+
+def planner_chunks(document: str) -> list:
+    """
+    模拟任务规划的流式输出：先输出一段思考，再逐片段输出一个参数很长的工具调用
+    """
+    from langchain_core.messages import AIMessageChunk
+
+    args = json.dumps({"query": document}, ensure_ascii=False)
+    chunks = [AIMessageChunk(content=document[i : i + 4]) for i in range(0, len(document), 4)]
+    chunks.append(AIMessageChunk(content="", tool_call_chunks=[{"name": "审核规则查询", "args": "", "id": "call_0", "index": 0}]))
+    chunks += [
+        AIMessageChunk(content="", tool_call_chunks=[{"name": None, "args": args[i : i + 4], "id": None, "index": 0}])
+        for i in range(0, len(args), 4)
+    ]
+    return chunks
+
+
+def accumulate(chunks: list):
+    from Config.Stream import StreamAccumulator
+
+    stream = StreamAccumulator()
+    for chunk in chunks:
+        stream.add(chunk)
+    return stream.message().tool_calls
+
+
+def bench_search(samples: list, repeat: int, trace_memory: bool) -> list:
+    from Config.Context import ContextManager
+    from Tools.Search.KnowledgeBase import knowledge_base
+    from Tools.Search.RulesSearch import rules_prompt
+    from Tools.Search.TermsSearch import lookup_terms
+    from Tools.Audit.Segment import chunk_document
+    from Tools.Audit.ChunkAudit import chunk_prompt, chunk_max_chars
+    from Tools.Audit.NearDuplicate import DocumentStore
+
+    kb = knowledge_base()
+    console = NullConsole()
+    items = samples * repeat
+    chunks = [
+        (chunk, sample["query"])
+        for sample in samples
+        for chunk in chunk_document(sample["document"], chunk_max_chars)
+    ] * repeat
+    # 模拟多轮规划后的长上下文
+    history = [
+        {"role": "user" if i % 2 else "assistant", "content": sample["document"] * 3}
+        for i, sample in enumerate(samples * 8)
+    ]
+    context_manager = ContextManager(None)
+    streams = [planner_chunks(sample["document"]) for sample in samples] * repeat
+    # 已审核文档入库，每个样例改一个字作为变体
+    store = DocumentStore(os.path.join(tempfile.mkdtemp(prefix="cpir_bench_"), "documents.sqlite"))
+    for sample in samples:
+        store.add(sample["document"], sample["query"], "审核结论")
+    variants = [(sample["document"][:-2] + "。", sample["query"]) for sample in samples] * repeat
+
+    return [
+        measure("规则检索+提示词", lambda s: rules_prompt(s["query"], s["document"]), items, trace_memory),
+        measure(
+            "保险术语检索",
+            lambda s: lookup_terms(["犹豫期", "现金价值"], s["document"], kb.terms("insurance"), kb.automaton("insurance"), console),
+            items,
+            trace_memory,
+        ),
+        measure(
+            "消保术语检索",
+            lambda s: lookup_terms(
+                [], s["document"], kb.terms("consumer_protection"), kb.automaton("consumer_protection"), console
+            ),
+            items,
+            trace_memory,
+        ),
+        measure("分段审核提示词", lambda x: chunk_prompt(*x), chunks, trace_memory),
+        measure("上下文渲染", lambda _: context_manager.render(history), list(range(repeat * 10)), trace_memory),
+        measure("规划流式拼接", accumulate, streams, trace_memory),
+        measure("相似文档查找", lambda x: store.lookup(*x), variants, trace_memory),
+    ]
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    """
+    和基线比较p95耗时，超出容忍比例的记为回退
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result["case"]: result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        base = baseline.get(result["case"])
+        if base and base["p95_ms"] > 0 and result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['case']}: p95 {base['p95_ms']:.2f}ms -> {result['p95_ms']:.2f}ms")
+    return regressions
+
+
+def report(results: list) -> str:
+    lines = [f"{'测试项':<16}{'次数':>6}{'吞吐/s':>12}{'p50ms':>10}{'p95ms':>10}{'RSS MB':>9}{'py峰值MB':>10}"]
+    for r in results:
+        rss = "-" if r["max_rss_mb"] is None else f"{r['max_rss_mb']:.0f}"
+        peak = "-" if r["py_peak_mb"] is None else f"{r['py_peak_mb']:.1f}"
+        lines.append(
+            f"{r['case']:<16}{r['n']:>6}{r['throughput']:>12.1f}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{rss:>9}{peak:>10}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线性能测试")
+    parser.add_argument("--samples", default=samples_path, help="样例文档JSONL，每行包含document和query")
+    parser.add_argument("--repeat", type=int, default=3, help="图测试每个样例的重复次数")
+    parser.add_argument("--search-repeat", type=int, default=50, help="检索测试每个样例的重复次数")
+    parser.add_argument("--concurrency", type=int, default=8, help="异步测试的并发会话数")
+    parser.add_argument("--ttft", type=float, default=0.0, help="模拟首token延迟，秒")
+    parser.add_argument("--tps", type=float, default=0.0, help="模拟输出速度，token/秒，0为不限速")
+    parser.add_argument("--cache", action="store_true", help="保留大模型回复缓存")
+    parser.add_argument("--tracemalloc", action="store_true", help="统计Python内存峰值，会明显变慢")
+    parser.add_argument("--skip-graph", action="store_true", help="只测检索环节")
+    parser.add_argument("--save", help="结果保存为JSON，作为之后对比的基线")
+    parser.add_argument("--baseline", help="对比的基线JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="p95耗时允许超出基线的比例")
+    args = parser.parse_args()
+
+    setup_mock(args.ttft, args.tps, args.cache)
+    samples = load_samples(args.samples)
+    results = bench_search(samples, args.search_repeat, args.tracemalloc)
+    if not args.skip_graph:
+        results += bench_graph(samples, args.repeat, args.concurrency, args.tracemalloc)
+    print(report(results))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for line in regressions:
+            print(f"性能回退 {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -1,12 +1,37 @@
-import os, json
+import os, sys, json, uuid, asyncio, contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated
 from typing_extensions import TypedDict
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, RemoveMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
+from langchain_core.runnables import RunnableLambda
 from langgraph.prebuilt import ToolNode
 from langgraph.runtime import get_runtime
-from Config.LLM_Client import llm
+from Config.LLM_Client import llm, context_manager, cache_ttl
+from Config.Cache import LLMCache
+from Config.ToolMemo import ToolMemo, cached_note
+from Config.Console import SpeculativeConsole
+from Config.Stream import StreamAccumulator
+from Config.Events import (
+    emit,
+    task_event,
+    tool_call_events,
+    atool_call_events,
+    ConsolePrinter,
+    Event,
+    TOKEN,
+    NOTICE,
+    VERIFICATION,
+    FINAL_ANSWER,
+    DONE,
+)
+from Config.Trace import traced, trace_request, trace_tool_call, atrace_tool_call
+from Config.Limiter import call_priority
+from Config.Budget import request_budget, current_budget, budget_exceeded, finalizing, budget_tool_call, abudget_tool_call
+from Config.Context import render_message
 from Tools.Thinking import (
     recalling,
     recognizing,
@@ -21,7 +46,12 @@ from Tools.Search import (
     insurance_terms_search,  # 保险术语查询
     consumer_protection_terms_search,  # 消保术语查询
     rules_search,  # 审核规则查询
+    validators,  # 检索工具的结构校验
 )
+from Tools.Search.KnowledgeBase import knowledge_version
+from Tools.Audit import chunk_audit, achunk_audit, format_findings, document_store, reuse_prompt, remap_findings
+from Tools.Audit.ChunkAudit import chunk_min_chars, document_view
+from Tools.Safety import SafetyFilter
 
 # 载入工具
 tools = [
@@ -37,7 +67,35 @@ tools = [
     consumer_protection_terms_search,  # 消保术语查询
     rules_search,  # 审核规则查询
 ]
-llm_with_tools = llm.bind_tools(tools)
+# 结果只取决于参数和文档的工具，同一会话内相同参数直接复用结果；检索类工具可以跨会话复用
+memo_tools = ["审核规则查询", "保险术语查询", "消保术语查询", "要素识别", "任务解释", "任务举例"]
+persistent_memo_tools = ["审核规则查询", "保险术语查询", "消保术语查询"]
+tool_memo_persist = False  # 为True时检索类工具的结果存到tool_memo_path，同一文档跨会话复用
+tool_memo_path = "cache/tool_cache.sqlite"
+tool_memo = ToolMemo(
+    memo_tools,
+    persistent_memo_tools,
+    LLMCache(tool_memo_path, cache_ttl) if tool_memo_persist else None,
+    versioned=persistent_memo_tools,  # 检索类工具的结果依赖知识库，热更新后不复用
+    version=knowledge_version,
+)
+_llm_with_tools = None
+safety_filter = SafetyFilter()  # 拒答判断的本地预筛
+speculative_gate = True  # 拒答判断需要调用大模型时，同时开始任务分析
+session_messages = 60  # 持久化会话每轮开始时保留的最近消息数，更早的轨迹已折叠进上下文摘要
+session_memory = 20  # 持久化会话保留的最近问答记录数
+fast_verify = True  # 检索工具的结果先做结构校验，全部通过时不再调用大模型验证
+document_reuse = False  # 为True时记录审核完成的文档，相似的新文档沿用结论、只审核改动的句子，见Tools/Audit/NearDuplicate.py
+
+
+def tools_model():
+    """
+    绑定工具的模型，第一次规划时才创建，导入本模块时不触发模型初始化
+    """
+    global _llm_with_tools
+    if _llm_with_tools is None:
+        _llm_with_tools = llm.bind_tools(tools)
+    return _llm_with_tools
 
 
 # 固化信息
@@ -63,41 +121,25 @@ class State(TypedDict):
     response: str = "很抱歉，该问题目前无法回答。"
     n_tools: int
     n_loop: int = 0
+    findings: str = ""  # 长文档的逐句审核结果
+    gate: str = ""  # 投机执行时的拒答判断结果
+    reused: str = ""  # 沿用了哪份已审核文档的结论
+    stop_reason: str = ""  # 预算用完或出现循环时的停止原因
 
 
 # 拒答判断
-def reject(state: State):
-    """
-    判断是否拒绝回答，更新在状态的"reject"字段
-    1. 返回“回答”：目标明确且不违规
-    2. 返回“拒答”：目标不明确或违规
-    """
-    # print(f"\n=====我们看看进入到reject的状态是啥样：=====\n{state}\n")
+def reject_prompt(state: State, history: str) -> str:
     query = state["query"]
-    messages = state["messages"]
-    prompt = f"请综合历史上下文，判断当前问题是否存在色情、暴力等安全风险，如果不存在安全风险则返回“回答”，否则返回“拒答”。用户当前的问题是：{query}。历史上下文为：{messages}"
-    messages.append(
-        {
-            "role": "user",
-            "content": prompt,
-        }
-    )
+    return f"请综合历史上下文，判断当前问题是否存在色情、暴力等安全风险，如果不存在安全风险则返回“回答”，否则返回“拒答”。用户当前的问题是：{query}。历史上下文为：{history}"
 
-    # 流式输出
-    response = ""
-    for chunk in llm.stream(prompt):
-        response += chunk.content
-
-    # # 直接输出
-    # response = llm.invoke(messages).content
-    messages.pop()  # 剔除中间判断信息
 
+def reject_result(state: State, response: str, reason: str = "") -> str:
     # 过程记录
     state["memory"].extend(
         [
             {
                 "role": "user",
-                "content": query,
+                "content": state["query"],
             },
             {
                 "role": "assistant",
@@ -107,19 +149,94 @@ def reject(state: State):
     )
     if "回答" in response:
         return "回答"
+    elif reason:
+        state["response"] = f"很抱歉，{reason}，该问题暂时无法回答，请稍后重试。"
+        state["stop_reason"] = reason
+        emit(FINAL_ANSWER, state["response"], refused=True, stop_reason=reason)
     else:
         state["response"] = "很抱歉，该问题目前无法回答。"
+        emit(FINAL_ANSWER, state["response"], refused=True)
     return "拒答"
 
 
-def analyse(state: State) -> State:
+def truncated_result(state: State) -> str:
     """
-    对给定问题的做初始的分析
+    拒答判断的回复被截止时间截断，不能作为放行依据，按拒答处理并说明预算原因
+    """
+    return reject_result(state, "拒答", budget_exceeded() or "拒答判断超时")
+
+
+def local_verdict(state: State):
+    """
+    本地预筛，已有历史消息时是多轮追问，只在本地拒答，不在本地直接回答
+    """
+    return safety_filter.classify(state["query"], follow_up=bool(state["messages"]))
+
+
+def reject(state: State):
+    """
+    判断是否拒绝回答，更新在状态的"reject"字段
+    1. 返回“回答”：目标明确且不违规
+    2. 返回“拒答”：目标不明确或违规
     """
+    # print(f"\n=====我们看看进入到reject的状态是啥样：=====\n{state}\n")
+    # 明确的问题本地直接判断，不调用大模型
+    verdict = local_verdict(state)
+    if verdict is not None:
+        return reject_result(state, verdict)
+    return reject_llm(state)
+
+
+@traced("node", "拒答判断")
+def reject_llm(state: State):
+    """
+    本地预筛拿不准时由大模型判断
+    """
+    prompt = reject_prompt(state, context_manager.render(state["messages"]))
+
+    # 流式输出，拒答判断挡在每轮问答的最前面，按最高优先级排队
+    stream = StreamAccumulator()
+    with call_priority("gate"):
+        for chunk in llm.stream(prompt):
+            stream.add(chunk)
+    # 超过截止时间被中断的回复不能作为判断依据，不放行
+    if stream.truncated:
+        return truncated_result(state)
+    response = stream.text()
+
+    # # 直接输出
+    # response = llm.invoke(messages).content
+
+    return reject_result(state, response)
+
+
+async def areject(state: State):
+    """
+    拒答判断的异步版本
+    """
+    verdict = local_verdict(state)
+    if verdict is not None:
+        return reject_result(state, verdict)
+    return await areject_llm(state)
+
+
+@traced("node", "拒答判断")
+async def areject_llm(state: State):
+    stream = StreamAccumulator()
+    prompt = reject_prompt(state, await context_manager.arender(state["messages"]))
+    with call_priority("gate"):
+        async for chunk in llm.astream(prompt):
+            stream.add(chunk)
+    if stream.truncated:
+        return truncated_result(state)
+    return reject_result(state, stream.text())
+
+
+def analyse_prompt(state: State, history: str) -> str:
     query = state["query"]
     messages = state["messages"]
     ctx = get_runtime(ContextSchema)
-    document = ctx.context.get("document", "")
+    document = document_view(ctx.context.get("document", ""))
     # 存在审核文档是审核任务
     if document != "":
         demo = """
@@ -127,7 +244,7 @@ def analyse(state: State) -> State:
         """
         prompt = f"""
         请综合历史上下文，对用户指令做分析，识别任务目标、背景约束和回答的关键组成，输出一段精炼的分析结果。
-        1.宣传文档内容是：{document}。用户指令是：{query}。上下文轨迹是：{messages}。
+        1.宣传文档内容是：{document}。用户指令是：{query}。上下文轨迹是：{history}。
         2.优秀的分析样例：{demo}。这个例子准确的识别出目标是“分析文案中的消保合规问题”，并识别出约束为“分红险”，关键组成为“找出哪些内容违反规定以及具体违反了什么”。
         """
     else:
@@ -136,7 +253,7 @@ def analyse(state: State) -> State:
         """
         prompt = f"""
         请综合历史上下文，对用户指令做分析，识别任务目标、背景约束和回答的关键组成，输出一段精炼的分析结果。
-        1.用户指令是：{query}。上下文轨迹是：{messages}。
+        1.用户指令是：{query}。上下文轨迹是：{history}。
         2.优秀的分析样例：{demo}。这个例子准确的识别出目标是“为合规宣传提供明确指引”，并识别出约束为“百万医疗险、长期续保权益”，回答组件为“需要重点规避的特定措辞形态及表述倾向”。
         """
 
@@ -146,33 +263,260 @@ def analyse(state: State) -> State:
             "content": prompt,
         }
     )
+    return prompt
+
 
-    print("\n\n⭐开始分析\n")
+@traced("node", "任务分析")
+def analyse(state: State, console=None) -> State:
+    """
+    对给定问题的做初始的分析
+    console为None时直接发出事件，投机执行时传入SpeculativeConsole
+    """
+    send = console.emit if console else emit
+    prompt = analyse_prompt(state, context_manager.render(state["messages"]))
+
+    send(NOTICE, "\n\n⭐开始分析\n")
     # 流式输出
     gen = llm.stream(prompt)
-    response = ""
+    stream = StreamAccumulator()
     for chunk in gen:
-        print(chunk.content, end="", flush=True)
-        response = response + chunk.content
+        if console and console.cancelled:
+            gen.close()  # 拒答时提前结束生成
+            break
+        send(TOKEN, chunk.content)
+        stream.add(chunk)
 
-    return {"messages": AIMessage(content=response)}
+    # 拒答判断写入的问答记录随本步一起更新，持久化会话才能保存
+    return {"messages": AIMessage(content=stream.text()), "memory": state["memory"]}
 
 
-def planing(state: State) -> State:
+@traced("node", "任务分析")
+async def aanalyse(state: State, console=None) -> State:
     """
-    计划下一步的操作
+    任务分析的异步版本，投机执行时由任务取消来中止
     """
-    message = state["messages"]
+    send = console.emit if console else emit
+    prompt = analyse_prompt(state, await context_manager.arender(state["messages"]))
+
+    send(NOTICE, "\n\n⭐开始分析\n")
+    stream = StreamAccumulator()
+    async for chunk in llm.astream(prompt):
+        send(TOKEN, chunk.content)
+        stream.add(chunk)
+
+    return {"messages": AIMessage(content=stream.text()), "memory": state["memory"]}
+
+
+@traced("node", "拒答判断与任务分析")
+def speculate(state: State) -> State:
+    """
+    拒答判断和任务分析同时执行：本地预筛有结论时按顺序执行，
+    需要大模型判断时先在后台开始分析，判断为回答则采用分析结果，判断为拒答则丢弃。
+    """
+    verdict = local_verdict(state)
+    if verdict is not None:
+        if reject_result(state, verdict) == "拒答":
+            return {"gate": "拒答", "response": state["response"], "memory": state["memory"]}
+        return {**analyse(state), "gate": "回答"}
+
+    console = SpeculativeConsole()
+    # 分析用消息列表的副本，拒答时不留下中间记录
+    speculative_state = {**state, "messages": list(state["messages"])}
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(contextvars.copy_context().run, analyse, speculative_state, console)
+    pool.shutdown(wait=False)
+
+    try:
+        verdict = reject_llm(state)
+    except BaseException:
+        # 拒答判断出错时分析结果也用不上，通知后台分析尽快停止
+        console.cancel()
+        future.cancel()
+        raise
+    if verdict == "拒答":
+        console.cancel()
+        future.cancel()
+        return {"gate": "拒答", "response": state["response"], "memory": state["memory"], "stop_reason": state.get("stop_reason", "")}
+    console.commit()
+    result = future.result()
+    # 与顺序执行一致，把分析提示词也记入消息
+    state["messages"].extend(speculative_state["messages"][len(state["messages"]) :])
+    return {**result, "gate": "回答"}
+
+
+@traced("node", "拒答判断与任务分析")
+async def aspeculate(state: State) -> State:
+    """
+    投机执行的异步版本，拒答时直接取消分析任务
+    """
+    verdict = local_verdict(state)
+    if verdict is not None:
+        if reject_result(state, verdict) == "拒答":
+            return {"gate": "拒答", "response": state["response"], "memory": state["memory"]}
+        return {**(await aanalyse(state)), "gate": "回答"}
+
+    console = SpeculativeConsole()
+    speculative_state = {**state, "messages": list(state["messages"])}
+    task = asyncio.create_task(aanalyse(speculative_state, console))
+
+    try:
+        verdict = await areject_llm(state)
+    except BaseException:
+        console.cancel()
+        task.cancel()
+        raise
+    if verdict == "拒答":
+        console.cancel()
+        task.cancel()
+        return {"gate": "拒答", "response": state["response"], "memory": state["memory"], "stop_reason": state.get("stop_reason", "")}
+    console.commit()
+    result = await task
+    state["messages"].extend(speculative_state["messages"][len(state["messages"]) :])
+    return {**result, "gate": "回答"}
+
+
+def route_gate(state: State) -> str:
+    return state["gate"]
+
+
+def remember_audit(state: State, answer: str):
+    """
+    完整审核得出最终答案后记下文档和结论，之后相似的文档可以沿用
+    """
+    document = get_runtime(ContextSchema).context.get("document", "")
+    if document_reuse and document:
+        document_store().add(document, state["query"], answer, state.get("findings", ""))
+
+
+def reuse_match(state: State):
+    """
+    同一任务指令下足够相似的已审核文档，没有时返回None
+    """
+    document = get_runtime(ContextSchema).context.get("document", "")
+    if not document_reuse or not document:
+        return None, document
+    match = document_store().lookup(document, state["query"])
+    if match is not None:
+        changes = len(match["added"]) + len(match["removed"])
+        emit(NOTICE, f"\n\n♻️与已审核文档#{match['id']}相似（未改动内容占{match['similarity']:.0%}），沿用其结论，只审核{changes}处改动\n\n")
+    return match, document
+
+
+def reuse_result(state: State, match: dict, document: str, response: str) -> State:
+    """
+    增量审核的结果也记入指纹库，同一文案的后续变体可以继续沿用
+    """
+    findings = remap_findings(match["findings"], document) if match["findings"] else ""
+    if match["added"] or match["removed"]:
+        document_store().add(document, state["query"], response, findings)
+    state["memory"].extend([{"role": "user", "content": state["query"]}, {"role": "assistant", "content": response}])
+    answer = response
+    if findings:
+        answer += f"\n\n逐句审核结果：\n{findings}"
+    emit(FINAL_ANSWER, answer, reused=match["id"])
+    return {
+        "messages": AIMessage(content=response),
+        "memory": state["memory"],
+        "response": answer,
+        "findings": findings,
+        "reused": str(match["id"]),
+        "n_tools": 0,
+    }
+
+
+@traced("node", "相似文档复用")
+def reuse_review(state: State) -> State:
+    """
+    相似的已审核文档存在时沿用其结论，只让大模型审核新增或改写的句子，不再走完整闭环。
+    只和同一任务指令下完整审核过的文档比对，这条指令已经通过过拒答判断
+    """
+    match, document = reuse_match(state)
+    if match is None:
+        return {"reused": ""}
+    prompt = reuse_prompt(match, state["query"])
+    if prompt is None:
+        return reuse_result(state, match, document, match["answer"])
+    stream = StreamAccumulator()
+    for chunk in llm.stream(prompt):
+        emit(TOKEN, chunk.content)
+        stream.add(chunk)
+    return reuse_result(state, match, document, stream.text())
+
+
+@traced("node", "相似文档复用")
+async def areuse_review(state: State) -> State:
+    match, document = reuse_match(state)
+    if match is None:
+        return {"reused": ""}
+    prompt = reuse_prompt(match, state["query"])
+    if prompt is None:
+        return reuse_result(state, match, document, match["answer"])
+    stream = StreamAccumulator()
+    async for chunk in llm.astream(prompt):
+        emit(TOKEN, chunk.content)
+        stream.add(chunk)
+    return reuse_result(state, match, document, stream.text())
+
+
+def route_reuse(state: State) -> str:
+    return "复用" if state.get("reused") else "审核"
+
+
+def reuse_or_reject(state: State) -> str:
+    if state.get("reused"):
+        return "复用"
+    return reject(state)
+
+
+async def areuse_or_reject(state: State) -> str:
+    if state.get("reused"):
+        return "复用"
+    return await areject(state)
+
+
+@traced("node", "分段审核")
+def chunk_review(state: State) -> State:
+    """
+    长文档分段并发审核，短文档跳过
+    """
+    document = get_runtime(ContextSchema).context.get("document", "")
+    if len(document) < chunk_min_chars:
+        return {"findings": ""}
+    emit(NOTICE, "\n\n📑分段审核中...\n")
+    findings = format_findings(chunk_audit(document, state["query"]))
+    emit(NOTICE, f"\n\n📑逐句审核结果\n{findings}\n")
+    return {"findings": findings}
+
+
+@traced("node", "分段审核")
+async def achunk_review(state: State) -> State:
+    """
+    分段审核的异步版本
+    """
+    document = get_runtime(ContextSchema).context.get("document", "")
+    if len(document) < chunk_min_chars:
+        return {"findings": ""}
+    emit(NOTICE, "\n\n📑分段审核中...\n")
+    findings = format_findings(await achunk_audit(document, state["query"]))
+    emit(NOTICE, f"\n\n📑逐句审核结果\n{findings}\n")
+    return {"findings": findings}
+
+
+def planing_prompt(state: State, history: str) -> str:
     query = state["query"]
     ctx = get_runtime(ContextSchema)
-    document = ctx.context.get("document", "")
+    document = document_view(ctx.context.get("document", ""))
+    findings = state.get("findings", "")
+    if findings:
+        findings = f"逐句审核结果（方括号内是句子在原文中的起止位置）：{findings}。最终答案请引用这些位置。"
 
     # 存在审核文档是审核任务
     if document != "":
         prompt = f"""
         用户上传了一份待审核的宣传文档内容，我们会通过任务规划、行动和反思的闭环来完成文档审核任务，只需要聚焦文档就可以，不要发散到文档内提及的其他文档。
         你是其中的任务规划模块，需要根据用户的指令和上下文轨迹，通过调用各种认知工具和信息搜索工具，来规划下一步的行动。相关指示如下：
-        1.宣传文档内容是：{document}。用户问题是：{query}。上下文轨迹是：{message}。
+        1.宣传文档内容是：{document}。用户问题是：{query}。上下文轨迹是：{history}。
+        {findings}
         2.认知工具清单：上下文回忆、要素识别、任务解释、任务举例、任务分解、信息检查、方案评论。他们是帮助你在复杂任务下做好思考的，如果你认为当前任务很简单，可以不调用认知工具。
         3.信息搜索工具清单：保险术语查询、消保术语查询、审核规则查询。他们是帮助你获取额外的信息，这些信息在文档和用户提问中没有直接给出，如果你认为不需要额外信息也能回答，可以不调用搜索工具。
         4.请给出你认为后续执行的行动是什么，将交给行动模块去具体执行，工具仅局限在目前提及的认知工具和信息搜索工具。
@@ -184,50 +528,190 @@ def planing(state: State) -> State:
         prompt = f"""
         给定用户的任务指令，我们会通过任务规划、行动和反思闭环来完成用户的任务。
         你是其中的任务规划模块，需要根据用户的指令和上下文轨迹，通过调用各种认知工具和信息搜索工具，来规划下一步的行动。相关指示如下：
-        1.用户问题是：{query}。上下文轨迹是：{message}。
+        1.用户问题是：{query}。上下文轨迹是：{history}。
         2.请给出你认为后续执行的行动是什么，将交给行动模块去具体执行。
         3.认知工具清单：上下文回忆、要素识别、任务解释、任务举例、任务分解、信息检查、方案评论。他们是帮助你在复杂任务下做好思考的，如果你认为当前任务很简单，可以不调用认知工具。
         4.信息搜索工具清单：保险术语查询、消保术语查询、审核规则查询。他们是帮助你获取额外的信息，这些信息用户提问中没有直接给出，如果你认为不需要额外信息也能回答，可以不调用搜索工具。
         5.工具调用会消耗大量时间，如果一个工具多次执行失败或者效果不佳，请更换工具避免陷入循环。
         6.如果你认为当前已经执行完毕用户的任务指令，则无需再调用工具，直接返回任务指令对应的最终答案即可。
         """
+    return prompt
 
-    # 如果上一个工具调用是直接回答，就结束了，不再规划。
+
+def planing_finished(state: State):
+    """
+    如果上一个工具调用是直接回答，就结束了，不再规划。
+    """
     messages = state["messages"]
     if len(messages) >= 2:
         if messages[-2].name == "直接作答" and "有效" in messages[-1].content:
-            print(f"\n\n👍任务完成")
+            emit(NOTICE, "\n\n👍任务完成\n")
+            emit(FINAL_ANSWER, messages[-2].content)
+            remember_audit(state, messages[-2].content)
             return {"response": messages[-2].content, "n_tools": 0}
+    return None
+
+
+def planing_result(state: State, response):
+    """
+    根据规划结果更新状态，工具选择出错时返回None
+    """
+    # 超过截止时间被中断，没有输出或输出不完整，由planing_stop转为强制作答
+    if response is None or response.response_metadata.get("truncated"):
+        return None
+    # 存在工具调用
+    if response.tool_calls:
+        emit(NOTICE, f"\n\n👉下一步：工具调用\n{response.tool_calls}\n")
+        return {"messages": response, "n_tools": len(response.tool_calls)}
+    elif response.invalid_tool_calls:
+        return None
+    else:
+        emit(NOTICE, "\n\n👍任务完成\n")
+        answer = response.content
+        remember_audit(state, answer)
+        # 长文档把带位置的逐句审核结果附在最终答案后
+        if state.get("findings"):
+            answer += f"\n\n逐句审核结果：\n{state['findings']}"
+        emit(FINAL_ANSWER, answer)
+        return {"messages": response, "response": answer, "n_tools": 0, "stop_reason": ""}
+
+
+def planing_stop(response, result) -> str:
+    """
+    规划出工具调用或需要重试时检查预算和循环，返回停止原因；规划出最终答案时直接采用
+    """
+    budget = current_budget()
+    if budget is None or (result is not None and result["n_tools"] == 0):
+        return None
+    if result is not None:
+        budget.note_tool_calls(response.tool_calls)
+    return budget.exceeded()
+
+
+def force_answer_prompt(state: State, history: str, reason: str) -> str:
+    query = state["query"]
+    ctx = get_runtime(ContextSchema)
+    document = document_view(ctx.context.get("document", ""))
+    findings = state.get("findings", "")
+    if findings:
+        findings = f"逐句审核结果（方括号内是句子在原文中的起止位置）：{findings}。"
+    document = f"宣传文档内容是：{document}。" if document != "" else ""
+    return f"""
+    我们通过任务规划、行动和反思的闭环来完成用户的任务，由于{reason}，闭环已经停止，不能再调用任何工具。
+    请根据上下文轨迹中已经获得的信息，直接给出用户任务指令对应的最终答案，信息不足的部分请明确说明。
+    {document}用户问题是：{query}。上下文轨迹是：{history}。
+    {findings}
+    """
+
+
+def force_answer_result(state: State, response: str, reason: str) -> State:
+    if not response:
+        response = "很抱歉，未能在限定的时间内完成分析，请缩小问题范围后重试。"
+    answer = response
+    if state.get("findings"):
+        answer += f"\n\n逐句审核结果：\n{state['findings']}"
+    emit(FINAL_ANSWER, answer, stop_reason=reason)
+    return {"messages": AIMessage(content=response), "response": answer, "n_tools": 0, "stop_reason": reason}
+
+
+@traced("node", "强制作答")
+def force_answer(state: State, reason: str) -> State:
+    """
+    预算用完或出现循环时，根据已有信息给出最终答案，不再调用工具
+    """
+    emit(NOTICE, f"\n\n⏱️{reason}，根据已有信息作答\n\n")
+    stream = StreamAccumulator()
+    with finalizing():
+        prompt = force_answer_prompt(state, context_manager.render(state["messages"]), reason)
+        for chunk in llm.stream(prompt):
+            emit(TOKEN, chunk.content)
+            stream.add(chunk)
+    return force_answer_result(state, stream.text(), reason)
+
+
+@traced("node", "强制作答")
+async def aforce_answer(state: State, reason: str) -> State:
+    emit(NOTICE, f"\n\n⏱️{reason}，根据已有信息作答\n\n")
+    stream = StreamAccumulator()
+    with finalizing():
+        prompt = force_answer_prompt(state, await context_manager.arender(state["messages"]), reason)
+        async for chunk in llm.astream(prompt):
+            emit(TOKEN, chunk.content)
+            stream.add(chunk)
+    return force_answer_result(state, stream.text(), reason)
+
+
+@traced("node", "任务规划")
+def planing(state: State) -> State:
+    """
+    计划下一步的操作
+    """
+    finished = planing_finished(state)
+    if finished is not None:
+        return finished
+    reason = budget_exceeded()
+    if reason:
+        return force_answer(state, reason)
+    prompt = planing_prompt(state, context_manager.render(state["messages"]))
 
     # 流式输出
-    print("\n\n📝任务规划中...\n")
+    emit(NOTICE, "\n\n📝任务规划中...\n\n")
 
     n = 0
     while n < 3:
-        gen = llm_with_tools.stream(prompt)
-        response = None
-        for chunk in gen:
-            if response is None:
-                response = chunk
-            else:
-                response = response + chunk
-
-            if not response.tool_calls:
-                print(chunk.content, end="", flush=True)
+        stream = StreamAccumulator()
+        for chunk in tools_model().stream(prompt):
+            stream.add(chunk)
+            # 开始调用工具后不再输出
+            if not stream.has_tool_calls:
+                emit(TOKEN, chunk.content)
+        response = stream.message()
 
         # # 直接输出
-        # response = llm_with_tools.invoke(prompt)
-
-        # 存在工具调用
-        if response.tool_calls:
-            print(f"\n\n👉下一步：工具调用\n{response.tool_calls}")
-            return {"messages": response, "n_tools": len(response.tool_calls)}
-        elif response.invalid_tool_calls:
-            n += 1
-            print(f"\n\n⚠️工具选择出错，第{n}次重试")
-        else:
-            print(f"\n\n👍任务完成")
-            return {"messages": response, "response": response.content, "n_tools": 0}
+        # response = tools_model().invoke(prompt)
+
+        result = planing_result(state, response)
+        reason = planing_stop(response, result)
+        if reason:
+            return force_answer(state, reason)
+        if result is not None:
+            return result
+        n += 1
+        emit(NOTICE, f"\n\n⚠️工具选择出错，第{n}次重试\n")
+
+
+@traced("node", "任务规划")
+async def aplaning(state: State) -> State:
+    """
+    任务规划的异步版本
+    """
+    finished = planing_finished(state)
+    if finished is not None:
+        return finished
+    reason = budget_exceeded()
+    if reason:
+        return await aforce_answer(state, reason)
+    prompt = planing_prompt(state, await context_manager.arender(state["messages"]))
+
+    emit(NOTICE, "\n\n📝任务规划中...\n\n")
+
+    n = 0
+    while n < 3:
+        stream = StreamAccumulator()
+        async for chunk in tools_model().astream(prompt):
+            stream.add(chunk)
+            if not stream.has_tool_calls:
+                emit(TOKEN, chunk.content)
+        response = stream.message()
+
+        result = planing_result(state, response)
+        reason = planing_stop(response, result)
+        if reason:
+            return await aforce_answer(state, reason)
+        if result is not None:
+            return result
+        n += 1
+        emit(NOTICE, f"\n\n⚠️工具选择出错，第{n}次重试\n")
 
 
 def should_use_tool(state: State) -> str:
@@ -238,15 +722,81 @@ def should_use_tool(state: State) -> str:
         return END
 
 
-def verify_tool_call(state: State) -> State:
+def verify_memory(state: State):
+    for tool_response in state["messages"][-state["n_tools"] :]:
+        state["memory"].append(tool_response)
+
+
+def verify_skipped(state: State, reason: str) -> State:
     """
-    验证工具调用是否正确
+    预算用完时不再调用大模型验证，回到规划模块强制作答
+    """
+    verify_memory(state)
+    emit(NOTICE, f"\n\n⏱️{reason}，跳过验证\n")
+    return {"messages": AIMessage(content=f"{reason}，跳过验证"), "memory": state["memory"], "n_loop": state["n_loop"] + 1}
+
+
+def verify_result(state: State, response: str, fast: bool = False) -> State:
+    emit(VERIFICATION, response, fast=fast)
+    state["memory"].append({"verify_tool_call": response})
+    budget = current_budget()
+    if budget is not None:
+        budget.note_verification(response)
+    return {"messages": AIMessage(content=response), "memory": state["memory"], "n_loop": state["n_loop"] + 1}
+
+
+def validate_tool_results(state: State):
+    """
+    检索工具结果的结构校验，返回(是否全部通过, 各工具的校验说明)。
+    有认知工具或者没有对应校验规则的工具时返回(False, [])，交给大模型验证
+    """
+    messages = state["messages"]
+    n_tools = state["n_tools"]
+    if not fast_verify or len(messages) <= n_tools:
+        return False, []
+    calls = {call["id"]: call for call in getattr(messages[-n_tools - 1], "tool_calls", [])}
+    document = get_runtime(ContextSchema).context.get("document", "")
+    passed = True
+    notes = []
+    for message in messages[-n_tools:]:
+        validator = validators.get(getattr(message, "name", None))
+        if validator is None:
+            return False, []
+        args = calls.get(message.tool_call_id, {}).get("args", {})
+        if message.status == "error":
+            ok, note = False, "执行出错"
+        else:
+            ok, note = validator(str(message.content).removeprefix(cached_note), args, document)
+        passed = passed and ok
+        # 带上调用参数，不同参数的调用校验说明不同，不会被预算误判为验证反思没有变化
+        notes.append(f"{message.name}{json.dumps(args, ensure_ascii=False, sort_keys=True)}：{note}")
+    return passed, notes
+
+
+def verify_passed(state: State, notes: list) -> State:
     """
+    结构校验全部通过，直接记为有效
+    """
+    verify_memory(state)
+    response = json.dumps(
+        {
+            "工具调用": [message.name for message in state["messages"][-state["n_tools"] :]],
+            "结论": "有效",
+            "反思": "；".join(notes) + "。结构校验通过。",
+            "调用编号": [message.tool_call_id for message in state["messages"][-state["n_tools"] :]],
+        },
+        ensure_ascii=False,
+    )
+    emit(NOTICE, f"\n\n👀验证反思结果（结构校验）\n{response}\n")
+    return verify_result(state, response, fast=True)
+
+
+def verify_prompt(state: State, history: str, notes: list = None) -> str:
     query = state["query"]
     n_tools = state["n_tools"]
     message = state["messages"]
-    for tool_response in message[-n_tools:]:
-        state["memory"].append(tool_response)
+    verify_memory(state)
+    results = [render_message(m) for m in message[-n_tools:]]
 
     demo = {
         "工具调用": ["上下文回忆"],
@@ -256,25 +806,65 @@ def verify_tool_call(state: State) -> State:
     prompt = f"""
     给定用户的指令，我们会通过任务规划、行动和反思闭环来完成用户的任务。。
     你是其中的验证反思模块，需要判断工具的执行结果是否有效推进了任务解答。相关指示如下：
-    1. 当前的用户问题是：{query}。历史执行轨迹是：{message[:-n_tools]}。行动结果为：{message[-n_tools :]}。
+    1. 当前的用户问题是：{query}。历史执行轨迹是：{history}。行动结果为：{results}。
     2. 请给出你对工具调用结果的分析，判断是否满足规划模块的符合预期，返回的参考样例为{demo}，请保持输出的精炼简洁。
     """
+    if notes:
+        prompt += f"""3. 检索工具的结构校验结果为：{notes}，请重点分析没有通过校验的工具。
+    """
+    return prompt
+
+
+@traced("node", "行动验证")
+def verify_tool_call(state: State) -> State:
+    """
+    验证工具调用是否正确
+    """
+    reason = budget_exceeded()
+    if reason:
+        return verify_skipped(state, reason)
+    passed, notes = validate_tool_results(state)
+    if passed:
+        return verify_passed(state, notes)
+    prompt = verify_prompt(state, context_manager.render(state["messages"][: -state["n_tools"]]), notes)
     # 流式输出
-    chunks = []
-    print(f"\n\n👀验证反思结果")
+    stream = StreamAccumulator()
+    emit(NOTICE, "\n\n👀验证反思结果\n")
     for chunk in llm.stream(prompt):
-        print(chunk.content, end="", flush=True)
-        chunks.append(chunk.content)
+        emit(TOKEN, chunk.content)
+        stream.add(chunk)
 
-    response = "".join(chunks)
-    state["memory"].append({"verify_tool_call": response})
+    response = stream.text()
 
     # # 完整输出
     # response = llm.invoke(prompt)
     # state["memory"].append({"verify_tool_call": response.content})
     # print(f"\n👉验证反思结果\n{response.content}")
 
-    return {"messages": AIMessage(content=response), "n_loop": state["n_loop"] + 1}
+    return verify_result(state, response)
+
+
+@traced("node", "行动验证")
+async def averify_tool_call(state: State) -> State:
+    """
+    行动验证的异步版本
+    """
+    reason = budget_exceeded()
+    if reason:
+        return verify_skipped(state, reason)
+    passed, notes = validate_tool_results(state)
+    if passed:
+        return verify_passed(state, notes)
+    history = await context_manager.arender(state["messages"][: -state["n_tools"]])
+    prompt = verify_prompt(state, history, notes)
+    stream = StreamAccumulator()
+    emit(NOTICE, "\n\n👀验证反思结果\n")
+    async for chunk in llm.astream(prompt):
+        emit(TOKEN, chunk.content)
+        stream.add(chunk)
+
+    response = stream.text()
+    return verify_result(state, response)
 
 
 def break_loop(state: State) -> State:
@@ -287,31 +877,300 @@ def break_loop(state: State) -> State:
         return "continue"
 
 
-graph = StateGraph(State)
-graph.add_node("任务分析", analyse)
-graph.add_node("任务规划", planing)
-tool_node = ToolNode(tools=tools)
-graph.add_node("工具调用", tool_node)
-graph.add_node("行动验证", verify_tool_call)
+def wrap_tool_call(request, execute):
+    """
+    每个工具调用单独记录耗时和token数并发出调用和结果事件，相同参数的调用复用结果，预算用完时不再执行
+    """
+    return trace_tool_call(
+        request,
+        lambda request: tool_call_events(
+            request, lambda request: tool_memo.wrap(request, lambda request: budget_tool_call(request, execute))
+        ),
+    )
 
 
-graph.add_conditional_edges(START, reject, {"拒答": END, "回答": "任务分析"})
-graph.add_edge("任务分析", "任务规划")
-graph.add_conditional_edges(
-    "任务规划", should_use_tool, {"tools": "工具调用", END: END}
-)
-graph.add_edge("工具调用", "行动验证")
-graph.add_conditional_edges("行动验证", break_loop, {"continue": "任务规划", END: END})
-# 编译静态图
-app = graph.compile()
+async def awrap_tool_call(request, execute):
+    return await atrace_tool_call(
+        request,
+        lambda request: atool_call_events(
+            request, lambda request: tool_memo.awrap(request, lambda request: abudget_tool_call(request, execute))
+        ),
+    )
+
+
+def build_graph(checkpointer=None):
+    """
+    构建并编译静态图，传入checkpointer时每一步都会持久化
+    """
+    # 节点同时提供同步和异步实现，app.invoke/stream走同步，app.ainvoke/astream走异步
+    graph = StateGraph(State)
+    graph.add_node("分段审核", RunnableLambda(chunk_review, afunc=achunk_review))
+    graph.add_node("任务规划", RunnableLambda(planing, afunc=aplaning))
+    tool_node = ToolNode(tools=tools, wrap_tool_call=wrap_tool_call, awrap_tool_call=awrap_tool_call)
+    graph.add_node("工具调用", tool_node)
+    graph.add_node("行动验证", RunnableLambda(verify_tool_call, afunc=averify_tool_call))
+
+    # 开启文档复用时先找相似的已审核文档，找到了直接结束
+    entry = START
+    if document_reuse:
+        graph.add_node("相似文档复用", RunnableLambda(reuse_review, afunc=areuse_review))
+        graph.add_edge(START, "相似文档复用")
+        entry = "相似文档复用"
+
+    if speculative_gate:
+        graph.add_node("拒答判断与任务分析", RunnableLambda(speculate, afunc=aspeculate))
+        if document_reuse:
+            graph.add_conditional_edges(entry, route_reuse, {"复用": END, "审核": "拒答判断与任务分析"})
+        else:
+            graph.add_edge(START, "拒答判断与任务分析")
+        graph.add_conditional_edges(
+            "拒答判断与任务分析", route_gate, {"拒答": END, "回答": "分段审核"}
+        )
+    else:
+        graph.add_node("任务分析", RunnableLambda(analyse, afunc=aanalyse))
+        graph.add_conditional_edges(
+            entry,
+            RunnableLambda(reuse_or_reject, afunc=areuse_or_reject),
+            {"复用": END, "拒答": END, "回答": "任务分析"},
+        )
+        graph.add_edge("任务分析", "分段审核")
+    graph.add_edge("分段审核", "任务规划")
+    graph.add_conditional_edges(
+        "任务规划", should_use_tool, {"tools": "工具调用", END: END}
+    )
+    graph.add_edge("工具调用", "行动验证")
+    graph.add_conditional_edges("行动验证", break_loop, {"continue": "任务规划", END: END})
+    return graph.compile(checkpointer=checkpointer)
+
+
+_app = None
+_session_app = None
+
+
+def get_app():
+    """
+    编译好的图，第一次执行时才构建
+    """
+    global _app
+    if _app is None:
+        _app = build_graph()
+    return _app
+
+
+def get_session_app():
+    """
+    带SQLite检查点的图，按会话id持久化状态，见Config/Checkpoint.py
+    """
+    global _session_app
+    if _session_app is None:
+        from Config.Checkpoint import sqlite_saver
+
+        _session_app = build_graph(sqlite_saver())
+    return _session_app
+
+
+def __getattr__(name):
+    # 兼容直接使用Casa_QA.app的写法
+    if name == "app":
+        return get_app()
+    raise AttributeError(name)
+
+
+def new_state() -> State:
+    """
+    新会话的初始状态
+    """
+    return {
+        "query": "",
+        "messages": [],
+        "memory": [],
+        "n_tools": 0,
+        "n_loop": 0,
+        "response": "回答完毕",
+        "findings": "",
+        "gate": "",
+        "reused": "",
+        "stop_reason": "",
+    }
+
+
+@contextmanager
+def request_scope(request_id: str = None, **meta):
+    """
+    一轮问答的trace和预算，预算的使用情况记入trace
+    """
+    with trace_request(request_id, **meta) as trace, request_budget() as budget:
+        try:
+            yield
+        finally:
+            trace.meta["budget"] = budget.to_dict()
+
+
+stream_modes = ["custom", "tasks", "values"]  # 节点发出的事件、节点开始结束、每步的完整状态
+
+
+def graph_events(chunks):
+    """
+    LangGraph的多模式流转成事件，最后补一个done事件带上最终状态
+    """
+    state = None
+    for mode, chunk in chunks:
+        if mode == "custom":
+            yield chunk
+        elif mode == "tasks":
+            yield task_event(chunk)
+        else:
+            state = chunk
+    yield Event(DONE, data={"state": state})
+
+
+async def agraph_events(chunks):
+    state = None
+    async for mode, chunk in chunks:
+        if mode == "custom":
+            yield chunk
+        elif mode == "tasks":
+            yield task_event(chunk)
+        else:
+            state = chunk
+    yield Event(DONE, data={"state": state})
+
+
+def stream_turn(state: State, document: str = "", request_id: str = None):
+    """
+    执行一轮问答，逐个返回事件（见Config/Events.py），最后一个事件是done，data["state"]为最终状态。
+    各节点和工具的耗时记录在Config/Trace.py的trace_path，token数、调用次数和时长受Config/Budget.py的预算限制
+    """
+    with request_scope(request_id, query=state["query"], document_chars=len(document)):
+        yield from graph_events(
+            get_app().stream(
+                state,
+                context={"document": document},
+                config={"recursion_limit": 100},  # 因为这里多步思考可能会很多轮
+                stream_mode=stream_modes,
+            )
+        )
+
+
+async def astream_turn(state: State, document: str = "", request_id: str = None):
+    """
+    事件流的异步版本，服务端可以把token事件直接转发给客户端
+    """
+    with request_scope(request_id, query=state["query"], document_chars=len(document)):
+        async for event in agraph_events(
+            get_app().astream(
+                state,
+                context={"document": document},
+                config={"recursion_limit": 100},
+                stream_mode=stream_modes,
+            )
+        ):
+            yield event
+
+
+def run_turn(state: State, document: str = "", request_id: str = None, subscriber=None) -> State:
+    """
+    执行一轮问答，state中的query为本轮用户查询。subscriber为接收事件的函数，
+    比如ConsolePrinter()打印到控制台，为None时不产生事件流，只返回最终状态
+    """
+    if subscriber is None:
+        with request_scope(request_id, query=state["query"], document_chars=len(document)):
+            return get_app().invoke(state, context={"document": document}, config={"recursion_limit": 100})
+    for event in stream_turn(state, document, request_id):
+        subscriber(event)
+    return event.data["state"]
+
+
+async def arun_turn(state: State, document: str = "", request_id: str = None, subscriber=None) -> State:
+    """
+    执行一轮问答的异步版本，一个事件循环里可以同时跑多个会话
+    """
+    if subscriber is None:
+        with request_scope(request_id, query=state["query"], document_chars=len(document)):
+            return await get_app().ainvoke(state, context={"document": document}, config={"recursion_limit": 100})
+    async for event in astream_turn(state, document, request_id):
+        subscriber(event)
+    return event.data["state"]
+
+
+def session_input(values: dict, query: str) -> dict:
+    """
+    本轮的输入：新会话用初始状态，已有会话只更新查询，并把消息和问答记录裁剪到配置的长度
+    """
+    if not values:
+        inputs = new_state()
+    else:
+        inputs = {}
+        messages = values.get("messages", [])
+        if len(messages) > session_messages:
+            inputs["messages"] = [RemoveMessage(id=REMOVE_ALL_MESSAGES)] + messages[-session_messages:]
+        memory = values.get("memory", [])
+        if len(memory) > session_memory:
+            inputs["memory"] = memory[-session_memory:]
+    inputs["query"] = query
+    inputs["response"] = ""
+    inputs["reused"] = ""
+    inputs["stop_reason"] = ""
+    return inputs
+
+
+def session_config(session_id: str) -> dict:
+    return {"configurable": {"thread_id": session_id}, "recursion_limit": 100}
+
+
+def stream_session_turn(session_id: str, query: str, document: str = ""):
+    """
+    持久化会话的一轮问答，状态保存在SQLite里，进程重启后用同一个session_id继续。逐个返回事件，同stream_turn
+    """
+    from Config.Checkpoint import prune_checkpoints
+
+    app = get_session_app()
+    config = session_config(session_id)
+    inputs = session_input(app.get_state(config).values, query)
+    with request_scope(None, session_id=session_id, query=query, document_chars=len(document)):
+        yield from graph_events(
+            app.stream(inputs, config=config, context={"document": document}, stream_mode=stream_modes)
+        )
+    prune_checkpoints(session_id)
+
+
+async def astream_session_turn(session_id: str, query: str, document: str = ""):
+    from Config.Checkpoint import async_sqlite_saver, prune_checkpoints
+
+    async with async_sqlite_saver() as saver:
+        # 复用编译好的图，只换成这一轮的异步检查点
+        app = get_app().copy(update={"checkpointer": saver})
+        config = session_config(session_id)
+        inputs = session_input((await app.aget_state(config)).values, query)
+        with request_scope(None, session_id=session_id, query=query, document_chars=len(document)):
+            async for event in agraph_events(
+                app.astream(inputs, config=config, context={"document": document}, stream_mode=stream_modes)
+            ):
+                yield event
+    await asyncio.to_thread(prune_checkpoints, session_id)
+
+
+def run_session_turn(session_id: str, query: str, document: str = "", subscriber=None) -> State:
+    for event in stream_session_turn(session_id, query, document):
+        if subscriber is not None:
+            subscriber(event)
+    return event.data["state"]
+
+
+async def arun_session_turn(session_id: str, query: str, document: str = "", subscriber=None) -> State:
+    async for event in astream_session_turn(session_id, query, document):
+        if subscriber is not None:
+            subscriber(event)
+    return event.data["state"]
+
 
 # # 粗略可视化
-# app.get_graph().print_ascii()
+# get_app().get_graph().print_ascii()
 
 # # 保存静态图
 # if not os.path.exists("./picture"):
 #     os.makedirs("./picture")
-# png_data = app.get_graph(xray=True).draw_mermaid_png()
+# png_data = get_app().get_graph(xray=True).draw_mermaid_png()
 # with open("./picture/graph_v1.1.png", "wb") as f:
 #     f.write(png_data)
 
@@ -325,40 +1184,26 @@ if __name__ == "__main__":
     请帮我指出文档中哪些内容违反消保合规问题，分别违反了什么规定？
     """
 
-    state = {
-        "query": "",
-        "messages": [],
-        "memory": [],
-        "n_tools": 0,
-        "n_loop": 0,
-        "response": "回答完毕",
-    }
+    # 传入会话id时继续之前的会话，否则新建
+    session_id = sys.argv[1] if len(sys.argv) > 1 else uuid.uuid4().hex[:12]
+    print(f"\n🗂 会话id：{session_id}，下次运行 python Casa_QA.py {session_id} 可以继续本次会话")
 
     print("\n🤖 机器人：你好呀！")
     while True:
         # 获取用户文档
         document = input("\n📄 请输入待审核文档（如果没有请直接回车）: ")
-        context = {
-            "document": document,
-        }
         # 获取用户输入
         user_input = input("\n👤 任务指令: ")
 
         # 如果输入 exit 就结束
         if user_input.lower() == "exit":
+            print(f"\n📊 {safety_filter.report()}")
             print("\n🤖 机器人: 再见！")
             break
         else:
             user_input = user_input
 
-        # 更新agent状态，替换为本轮用户查询
-        state["query"] = user_input
-        state["response"] = ""
-        # print(state)
-        state = app.invoke(
-            state,
-            context=context,
-            config={"recursion_limit": 100},  # 因为这里多步思考可能会很多轮
-        )
+        # 本轮用户查询，状态由检查点保存和恢复
+        state = run_session_turn(session_id, user_input, document, subscriber=ConsolePrinter())
         response = state["response"]
         print(f"\n🤖 机器人：{response}")
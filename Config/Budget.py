@@ -0,0 +1,303 @@
+"""
+单轮问答的预算
+
+每轮问答限制总token数、大模型调用次数和总时长，并识别两类死循环：同一个工具带相同参数反复调用、
+验证反思连续给出相同的结论。预算用完或出现循环时，规划模块不再调用工具，根据已有信息强制给出最终答案。
+
+总时长是硬上限：留出answer_reserve秒给强制作答，之前的调用超过截止时间会被中断，
+强制作答本身超过总时长也会中断，已经输出的部分作为答案。
+被中断的输出最后带一个response_metadata["truncated"]为True的空片段，并记入watch_truncation()，
+调用方据此不把不完整的输出当作完整结果保存或复用（生成的术语定义、工具结果复用、拒答判断）。
+"""
+
+import json
+import time
+import queue
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from langchain_core.messages import ToolMessage, AIMessageChunk
+from .Proxy import ChatModelProxy
+
+max_tokens = 60000  # 每轮问答的输入+输出token数
+max_llm_calls = 40  # 每轮问答的大模型调用次数，包括工具内部的调用
+max_seconds = 180.0  # 每轮问答的总时长，单位秒
+answer_reserve = 20.0  # 留给强制作答的时长，单位秒
+max_repeat_calls = 2  # 同一个工具带相同参数最多执行的次数
+max_same_verifications = 2  # 验证反思连续相同的次数达到后视为循环
+
+_budget = contextvars.ContextVar("budget", default=None)
+_truncation = contextvars.ContextVar("truncation", default=None)
+
+
+class Budget:
+    def __init__(self, max_tokens: int = None, max_llm_calls: int = None, max_seconds: float = None, answer_reserve: float = None):
+        # 不传时用模块级配置，运行中修改配置对之后的问答生效
+        self.max_tokens = max_tokens or globals()["max_tokens"]
+        self.max_llm_calls = max_llm_calls or globals()["max_llm_calls"]
+        self.max_seconds = max_seconds or globals()["max_seconds"]
+        self.answer_reserve = min(answer_reserve or globals()["answer_reserve"], self.max_seconds)
+        self.start = time.perf_counter()
+        self.tokens = 0
+        self.llm_calls = 0
+        self.finalizing = False  # 进入强制作答后只受总时长限制
+        self.loop_reason = None
+        self.tool_calls = {}  # 工具调用签名 -> 次数
+        self.verifications = []
+        self._lock = Lock()
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def deadline(self) -> float:
+        """
+        当前阶段的截止时间（相对开始的秒数）
+        """
+        return self.max_seconds if self.finalizing else self.max_seconds - self.answer_reserve
+
+    def remaining(self) -> float:
+        return self.deadline() - self.elapsed()
+
+    def charge(self, tokens: int):
+        with self._lock:
+            self.tokens += tokens
+            self.llm_calls += 1
+
+    def exceeded(self):
+        """
+        返回停止原因，预算充足且没有循环时返回None
+        """
+        if self.loop_reason:
+            return self.loop_reason
+        if self.tokens >= self.max_tokens:
+            return f"token数达到上限{self.max_tokens}"
+        if self.llm_calls >= self.max_llm_calls:
+            return f"大模型调用次数达到上限{self.max_llm_calls}"
+        if self.remaining() <= 0:
+            return f"用时达到上限{self.max_seconds - self.answer_reserve:.0f}秒"
+        return None
+
+    def note_tool_calls(self, tool_calls: list):
+        """
+        记录规划模块发起的工具调用，同一个工具带相同参数超过max_repeat_calls次时记为循环
+        """
+        with self._lock:
+            for call in tool_calls:
+                signature = f"{call['name']}:{json.dumps(call['args'], ensure_ascii=False, sort_keys=True)}"
+                self.tool_calls[signature] = self.tool_calls.get(signature, 0) + 1
+                if self.tool_calls[signature] > max_repeat_calls:
+                    self.loop_reason = f"重复调用{call['name']}"
+
+    def note_verification(self, text: str):
+        """
+        记录验证反思的结论，连续max_same_verifications次相同时记为循环
+        """
+        with self._lock:
+            self.verifications.append(" ".join(text.split()))
+            recent = self.verifications[-max_same_verifications:]
+            if len(recent) >= max_same_verifications and len(set(recent)) == 1:
+                self.loop_reason = "验证反思结果没有变化"
+
+    def to_dict(self) -> dict:
+        return {
+            "tokens": self.tokens,
+            "llm_calls": self.llm_calls,
+            "seconds": round(self.elapsed(), 2),
+            "stop_reason": self.exceeded(),
+        }
+
+
+@contextmanager
+def request_budget(**limits):
+    """
+    一轮问答的预算，参数同Budget，不传时用模块级配置
+    """
+    budget = Budget(**limits)
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+def current_budget():
+    return _budget.get()
+
+
+def budget_exceeded():
+    """
+    没有设置预算时返回None
+    """
+    budget = _budget.get()
+    return None if budget is None else budget.exceeded()
+
+
+def charge(tokens: int):
+    """
+    每次大模型调用结束后由Trace.TracedChatModel记账
+    """
+    budget = _budget.get()
+    if budget is not None:
+        budget.charge(tokens)
+
+
+class TruncationWatch:
+    def __init__(self):
+        self.truncated = False
+
+
+@contextmanager
+def watch_truncation():
+    """
+    期间（包括复制了上下文的子线程）有大模型输出因为超过截止时间被中断时，watch.truncated为True
+    """
+    watch = TruncationWatch()
+    token = _truncation.set(watch)
+    try:
+        yield watch
+    finally:
+        _truncation.reset(token)
+
+
+def truncated_chunk() -> AIMessageChunk:
+    """
+    记录这次中断，返回标记中断的空片段
+    """
+    watch = _truncation.get()
+    if watch is not None:
+        watch.truncated = True
+    return AIMessageChunk(content="", response_metadata={"truncated": True})
+
+
+@contextmanager
+def finalizing():
+    """
+    强制作答阶段，截止时间放宽到总时长
+    """
+    budget = _budget.get()
+    if budget is None:
+        yield
+        return
+    budget.finalizing = True
+    try:
+        yield
+    finally:
+        budget.finalizing = False
+
+
+class BudgetedChatModel(ChatModelProxy):
+    """
+    超过当前阶段截止时间时中断流式输出，包括还在等待首token的调用，已经输出的部分照常返回，最后补一个标记中断的空片段
+    """
+
+    def stream(self, input, config=None, **kwargs):
+        budget = _budget.get()
+        if budget is None:
+            yield from self.model.stream(input, config, **kwargs)
+            return
+
+        # 已经过了截止时间就不再发起请求
+        if budget.remaining() <= 0:
+            yield truncated_chunk()
+            return
+
+        # 同步接口没法给阻塞的读取设超时，放到后台线程里读，这里按剩余时间等待
+        chunks = queue.Queue()
+        stop = Event()
+        done = object()
+
+        def produce():
+            iterator = self.model.stream(input, config, **kwargs)
+            try:
+                for chunk in iterator:
+                    if stop.is_set():
+                        break
+                    chunks.put(chunk)
+            except BaseException as e:
+                chunks.put(e)
+            finally:
+                # 被中断后立即关闭内层的流：断开HTTP连接，并发名额和token预扣在这里才结算，
+                # 线程结束前名额一直占着，实际连接数不会超过并发上限
+                iterator.close()
+                chunks.put(done)
+
+        Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+        try:
+            while True:
+                remaining = budget.remaining()
+                if remaining <= 0:
+                    yield truncated_chunk()
+                    break
+                try:
+                    item = chunks.get(timeout=remaining)
+                except queue.Empty:
+                    yield truncated_chunk()
+                    break
+                if item is done:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    async def astream(self, input, config=None, **kwargs):
+        budget = _budget.get()
+        if budget is None:
+            async for chunk in self.model.astream(input, config, **kwargs):
+                yield chunk
+            return
+
+        # 后台任务读取输出，到截止时间时放入结束标记，不用每个片段单独设超时
+        chunks = asyncio.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async for chunk in self.model.astream(input, config, **kwargs):
+                    chunks.put_nowait(chunk)
+            except Exception as e:
+                chunks.put_nowait(e)
+            finally:
+                chunks.put_nowait(done)
+
+        task = asyncio.create_task(produce())
+        deadline = object()
+        timer = asyncio.get_running_loop().call_later(max(budget.remaining(), 0), chunks.put_nowait, deadline)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is deadline:
+                    yield truncated_chunk()
+                    break
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            timer.cancel()
+            task.cancel()
+
+
+def budget_tool_call(request, execute):
+    """
+    ToolNode的工具调用，预算用完时不再执行，直接返回说明
+    """
+    reason = budget_exceeded()
+    if reason:
+        return skipped_tool_message(request, reason)
+    return execute(request)
+
+
+async def abudget_tool_call(request, execute):
+    reason = budget_exceeded()
+    if reason:
+        return skipped_tool_message(request, reason)
+    return await execute(request)
+
+
+def skipped_tool_message(request, reason: str) -> ToolMessage:
+    call = request.tool_call
+    return ToolMessage(content=f"{reason}，未执行", name=call["name"], tool_call_id=call["id"], status="error")
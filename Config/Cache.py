@@ -0,0 +1,200 @@
+"""
+大模型回复缓存
+
+以模型、参数和提示词的哈希为键，内存LRU + 磁盘SQLite两级缓存，支持条数和过期时间淘汰。
+命中时仍然通过stream接口返回，调用方不需要改动。
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from langchain_core.messages import (
+    AIMessageChunk,
+    BaseMessage,
+    message_to_dict,
+    messages_from_dict,
+)
+from langchain_core.runnables import RunnableBinding
+from .Proxy import ChatModelProxy
+from .Stream import StreamAccumulator
+
+
+class LLMCache:
+    def __init__(
+        self,
+        path: str = "cache/llm_cache.sqlite",
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 100000,
+        memory_entries: int = 1024,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()  # {键: (写入时间, 值)}
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._n_writes = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON llm_cache (accessed)")
+        self.conn.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            # 内存层
+            if key in self.memory:
+                created, value = self.memory[key]
+                if now - created <= self.ttl:
+                    self.memory.move_to_end(key)
+                    self.hits_memory += 1
+                    return value
+                del self.memory[key]
+
+            # 磁盘层
+            row = self.conn.execute(
+                "SELECT value, created FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                value, created = row
+                if now - created <= self.ttl:
+                    self.conn.execute(
+                        "UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key)
+                    )
+                    self.conn.commit()
+                    self._remember(key, created, value)
+                    self.hits_disk += 1
+                    return value
+                self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.conn.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._n_writes += 1
+            if self._n_writes % 100 == 0:
+                self._evict(now)
+            self.conn.commit()
+
+    def _remember(self, key, created, value):
+        self.memory[key] = (created, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, now):
+        """
+        删除过期条目，超出条数上限时按最近访问时间淘汰
+        """
+        self.conn.execute("DELETE FROM llm_cache WHERE created < ?", (now - self.ttl,))
+        (n,) = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if n > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed LIMIT ?)",
+                (n - self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        hits = self.hits_memory + self.hits_disk
+        total = hits + self.misses
+        return {
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+
+def model_signature(model) -> dict:
+    """
+    模型名和生成参数，绑定的工具也算在内
+    """
+    if isinstance(model, ChatModelProxy):
+        return model_signature(model.model)
+    if isinstance(model, RunnableBinding):
+        return {"bound": model_signature(model.bound), "kwargs": model.kwargs}
+    return {"class": type(model).__name__, "params": getattr(model, "_identifying_params", {})}
+
+
+def cache_key(model, input, kwargs: dict) -> str:
+    if isinstance(input, str):
+        prompt = input
+    else:
+        prompt = [
+            message_to_dict(m) if isinstance(m, BaseMessage) else m for m in input
+        ]
+    data = json.dumps(
+        {"model": model_signature(model), "prompt": prompt, "kwargs": kwargs},
+        ensure_ascii=False,
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class CachedChatModel(ChatModelProxy):
+    """
+    命中缓存时一次性返回完整回复，未命中时边流式输出边记录，完整结束后写入缓存
+    """
+
+    def __init__(self, model, cache: LLMCache):
+        super().__init__(model)
+        self.cache = cache
+
+    def stream(self, input, config=None, **kwargs):
+        key = cache_key(self.model, input, kwargs)
+        message = self._lookup(key)
+        if message is not None:
+            yield message
+            return
+
+        stream = StreamAccumulator()
+        for chunk in self.model.stream(input, config, **kwargs):
+            yield stream.add(chunk)
+        self._store(key, stream.message())
+
+    async def astream(self, input, config=None, **kwargs):
+        key = cache_key(self.model, input, kwargs)
+        message = self._lookup(key)
+        if message is not None:
+            yield message
+            return
+
+        stream = StreamAccumulator()
+        async for chunk in self.model.astream(input, config, **kwargs):
+            yield stream.add(chunk)
+        self._store(key, stream.message())
+
+    def _lookup(self, key: str):
+        value = self.cache.get(key)
+        if value is None:
+            return None
+        message = messages_from_dict([json.loads(value)])[0]
+        message.id = None  # 让add_messages重新分配id，避免和历史消息冲突
+        message.response_metadata["cache_hit"] = True  # 外层的Trace据此不计入预算
+        return message
+
+    def _store(self, key: str, response):
+        if isinstance(response, AIMessageChunk) and (
+            response.content or response.tool_call_chunks
+        ):
+            self.cache.set(key, json.dumps(message_to_dict(response), ensure_ascii=False))
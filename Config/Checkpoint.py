@@ -0,0 +1,75 @@
+"""
+会话持久化
+
+LangGraph的checkpointer，直接用langgraph-checkpoint-sqlite的SqliteSaver/AsyncSqliteSaver，存在本地SQLite。
+库会保存每一步的检查点，每轮结束后用prune_checkpoints只保留每个会话最近几个，数据库大小不随轮次线性增长。
+"""
+
+import os
+import sqlite3
+from contextlib import asynccontextmanager, closing
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+checkpoint_path = "cache/sessions.sqlite"
+keep_checkpoints = 2  # 每个会话保留的检查点数
+
+
+def connect(path: str = None) -> sqlite3.Connection:
+    path = path or checkpoint_path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def sqlite_saver(path: str = None) -> SqliteSaver:
+    """
+    同步图用的检查点，连接在整个进程里复用
+    """
+    saver = SqliteSaver(connect(path))
+    saver.setup()
+    return saver
+
+
+@asynccontextmanager
+async def async_sqlite_saver(path: str = None):
+    """
+    异步图用的检查点。aiosqlite的连接绑定在当前事件循环上，所以每轮打开、结束时关闭
+    """
+    # 依赖aiosqlite，只有异步会话才用到
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+    path = path or checkpoint_path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    async with AsyncSqliteSaver.from_conn_string(path) as saver:
+        yield saver
+
+
+def prune_checkpoints(thread_id: str, keep: int = None, path: str = None) -> int:
+    """
+    删除会话最近keep个以前的检查点以及它们的写入，返回删除的检查点数。
+    检查点id是按时间递增的uuid6，和库自己取最新检查点一样按id排序
+    """
+    keep = keep_checkpoints if keep is None else keep
+    with closing(connect(path)) as conn, conn:
+        namespaces = conn.execute(
+            "SELECT DISTINCT checkpoint_ns FROM checkpoints WHERE thread_id = ?", (thread_id,)
+        ).fetchall()
+        removed = 0
+        for (checkpoint_ns,) in namespaces:
+            removed += conn.execute(
+                """
+                DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN (
+                    SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+                    ORDER BY checkpoint_id DESC LIMIT ?
+                )
+                """,
+                (thread_id, checkpoint_ns, thread_id, checkpoint_ns, keep),
+            ).rowcount
+            conn.execute(
+                """
+                DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id NOT IN (
+                    SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+                )
+                """,
+                (thread_id, checkpoint_ns, thread_id, checkpoint_ns),
+            )
+    return removed
@@ -0,0 +1,91 @@
+"""
+工具的控制台输出
+
+工具和分段审核的输出以事件的形式发出（见Config/Events.py），同一个工具的输出归到同一个输出块，
+并发时由订阅者决定怎么展示，控制台订阅者ConsolePrinter会保证各块的输出不互相穿插。
+投机执行的节点在结果确认前先缓存事件。
+"""
+
+from threading import Lock
+from .Stream import StreamAccumulator
+from .Events import emit, new_block, current_source, TOKEN, BLOCK_END
+
+
+class ToolConsole:
+    def __init__(self, title: str):
+        self.title = title
+        self.source = None
+        self.own = False  # 在工具调用里时沿用工具调用的输出块，否则单独开一个
+        self.truncated = False  # 有输出超过截止时间被中断
+
+    def __enter__(self):
+        self.source = current_source()
+        if self.source is None:
+            self.source = new_block()
+            self.own = True
+        self.write(self.title + "\n")
+        return self
+
+    def write(self, text: str):
+        emit(TOKEN, text, source=self.source)
+
+    def print(self, text: str = ""):
+        self.write(text + "\n")
+
+    def stream(self, model, prompt) -> str:
+        """
+        流式调用大模型，边输出边拼接，返回完整回复
+        """
+        stream = StreamAccumulator()
+        for chunk in model.stream(prompt):
+            self.write(chunk.content)
+            stream.add(chunk)
+        self.truncated = self.truncated or stream.truncated
+        return stream.text()
+
+    async def astream(self, model, prompt) -> str:
+        stream = StreamAccumulator()
+        async for chunk in model.astream(prompt):
+            self.write(chunk.content)
+            stream.add(chunk)
+        self.truncated = self.truncated or stream.truncated
+        return stream.text()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.own:
+            emit(BLOCK_END, source=self.source)
+        return False
+
+
+class SpeculativeConsole:
+    """
+    投机执行节点的输出：结果确认前先缓存事件，确认后补发缓存并转为实时发出，
+    结果作废时丢弃缓存，并通知节点尽快停止生成。
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.committed = False
+        self.cancelled = False
+        self._lock = Lock()
+
+    def emit(self, type: str, text: str = ""):
+        with self._lock:
+            if self.cancelled:
+                return
+            if self.committed:
+                emit(type, text)
+            else:
+                self.buffer.append((type, text))
+
+    def commit(self):
+        with self._lock:
+            self.committed = True
+            for type, text in self.buffer:
+                emit(type, text)
+            self.buffer = []
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            self.buffer = []
@@ -0,0 +1,151 @@
+"""
+上下文压缩
+
+把state["messages"]渲染成提示词里的上下文轨迹，总长度控制在token预算内：
+最近的若干条消息原样保留，更早的消息折叠成一段滚动摘要。
+摘要按消息前缀缓存，窗口后移时只把新移出窗口的消息增量合并进已有摘要。
+"""
+
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+from langchain_core.messages import BaseMessage
+
+context_token_budget = 6000  # 上下文轨迹的token预算
+summary_token_budget = 800  # 其中留给摘要的部分
+fold_step = 4  # 每次至少折叠多少条消息，避免每轮都重新做摘要
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计token数：中文按一字一个token，其余字符按四个一个token
+    """
+    cjk = sum(1 for char in text if ord(char) > 0x2E7F)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def render_message(message) -> str:
+    if isinstance(message, dict):
+        return f"{message.get('role', '')}: {message.get('content', '')}"
+    if isinstance(message, BaseMessage):
+        role = message.type
+        if getattr(message, "name", None):
+            role = f"{role}({message.name})"
+        text = f"{role}: {message.content}"
+        tool_calls = getattr(message, "tool_calls", None)
+        if tool_calls:
+            text += f" 工具调用：{[(call['name'], call['args']) for call in tool_calls]}"
+        return text
+    return str(message)
+
+
+def summary_prompt(summary: str, items: list) -> str:
+    history = "\n".join(items)
+    return f"""
+    你是一个上下文压缩模块，需要把智能体的执行轨迹压缩成一段精炼的摘要，保留任务目标、已调用的工具、检索到的关键规则和术语、已得出的结论，删去重复和无关的内容。
+    已有摘要：{summary}
+    新增轨迹：{history}
+    请输出合并后的摘要，不超过{summary_token_budget}字。
+    """
+
+
+def truncate(text: str, budget: int) -> str:
+    """
+    没有大模型摘要时的兜底：保留结尾部分
+    """
+    budget = max(budget, 0)
+    while text and estimate_tokens(text) > budget:
+        # 不足4个字时按比例已经截不动，每次去掉一个字
+        text = text[max(len(text) // 4, 1) :]
+    return text
+
+
+class ContextManager:
+    def __init__(
+        self,
+        model=None,
+        budget: int = context_token_budget,
+        summary_budget: int = summary_token_budget,
+        step: int = fold_step,
+        max_cached: int = 256,
+    ):
+        self.model = model  # 为None时不调用大模型，直接截断
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.step = step
+        self.max_cached = max_cached
+        self.summaries = OrderedDict()  # {前缀哈希: 摘要}
+        self._lock = Lock()  # ToolNode的多个工具可能在不同线程里同时渲染
+
+    def _plan(self, messages: list):
+        """
+        返回(渲染后的消息, 需要折叠的条数, 前缀哈希列表)
+        """
+        items = [render_message(m) for m in messages]
+        tokens = [estimate_tokens(item) for item in items]
+        if sum(tokens) <= self.budget:
+            return items, 0, []
+
+        # 从后往前保留原文，至少保留最后一条
+        keep_budget = self.budget - self.summary_budget
+        split = len(items) - 1
+        used = tokens[-1]
+        while split > 0 and used + tokens[split - 1] <= keep_budget:
+            split -= 1
+            used += tokens[split]
+        # 折叠条数按step取整，窗口不是每轮都移动，摘要也就不用每轮重算
+        split = min(-(-split // self.step) * self.step, len(items) - 1)
+
+        hashes = [""]
+        for item in items[:split]:
+            hashes.append(hashlib.sha1((hashes[-1] + item).encode("utf-8")).hexdigest())
+        return items, split, hashes
+
+    def _cached(self, hashes: list, split: int):
+        """
+        找到已缓存的最长前缀，返回(前缀长度, 摘要)
+        """
+        with self._lock:
+            for n in range(split, 0, -1):
+                summary = self.summaries.get(hashes[n])
+                if summary is not None:
+                    self.summaries.move_to_end(hashes[n])
+                    return n, summary
+        return 0, ""
+
+    def _remember(self, key: str, summary: str):
+        with self._lock:
+            self.summaries[key] = summary
+            while len(self.summaries) > self.max_cached:
+                self.summaries.popitem(last=False)
+
+    def _join(self, summary: str, recent: list) -> str:
+        return f"更早轨迹的摘要：{summary}\n最近的轨迹：\n" + "\n".join(recent)
+
+    def render(self, messages: list) -> str:
+        items, split, hashes = self._plan(messages)
+        if split == 0:
+            return "\n".join(items)
+
+        n, summary = self._cached(hashes, split)
+        if n < split:
+            if self.model is None:
+                summary = truncate(summary + "\n" + "\n".join(items[n:split]), self.summary_budget)
+            else:
+                summary = self.model.invoke(summary_prompt(summary, items[n:split])).content
+            self._remember(hashes[split], summary)
+        return self._join(summary, items[split:])
+
+    async def arender(self, messages: list) -> str:
+        items, split, hashes = self._plan(messages)
+        if split == 0:
+            return "\n".join(items)
+
+        n, summary = self._cached(hashes, split)
+        if n < split:
+            if self.model is None:
+                summary = truncate(summary + "\n" + "\n".join(items[n:split]), self.summary_budget)
+            else:
+                summary = (await self.model.ainvoke(summary_prompt(summary, items[n:split]))).content
+            self._remember(hashes[split], summary)
+        return self._join(summary, items[split:])
@@ -0,0 +1,180 @@
+"""
+结构化事件流
+
+节点和工具不再直接print，而是通过emit发出事件，由LangGraph的custom流模式转发给调用方：
+同步接口是生成器，异步接口是异步迭代器，服务端可以把token事件直接转发给客户端。
+控制台打印只是其中一个订阅者（ConsolePrinter），不订阅时事件直接丢弃。
+
+事件类型：
+    node_start / node_end   节点开始、结束，来自LangGraph的tasks流模式
+    token                   流式输出的片段，source为None时属于节点本身，否则属于某个工具或分段审核的输出块
+    notice                  面向用户的提示，如"任务规划中..."、重试、预算用完
+    block_end               一个工具或分段审核的输出块结束
+    tool_call / tool_result 工具调用开始、返回结果
+    verification            行动验证的结论
+    final_answer            本轮的最终答案
+    done                    本轮结束，data["state"]为最终状态
+"""
+
+import sys
+import time
+import itertools
+import contextvars
+from dataclasses import dataclass, field
+from langgraph.config import get_config, get_stream_writer
+
+NODE_START = "node_start"
+NODE_END = "node_end"
+TOKEN = "token"
+NOTICE = "notice"
+BLOCK_END = "block_end"
+TOOL_CALL = "tool_call"
+TOOL_RESULT = "tool_result"
+VERIFICATION = "verification"
+FINAL_ANSWER = "final_answer"
+DONE = "done"
+
+_source = contextvars.ContextVar("event_source", default=None)
+_block_ids = itertools.count()
+
+
+@dataclass
+class Event:
+    type: str
+    text: str = ""
+    node: str = None  # 发出事件的图节点
+    source: str = None  # 输出块的id，节点本身的输出为None
+    data: dict = field(default_factory=dict)
+
+
+def emit(type: str, text: str = "", source: str = None, **data):
+    """
+    发出事件，调用方没有订阅custom流时LangGraph直接丢弃
+    """
+    try:
+        config = get_config()
+    except RuntimeError:  # 不在图里执行，比如单独调用工具
+        return
+    node = config.get("metadata", {}).get("langgraph_node")
+    get_stream_writer()(Event(type, text, node, source or _source.get(), data))
+
+
+def current_source():
+    return _source.get()
+
+
+def new_block() -> str:
+    return f"block-{next(_block_ids)}"
+
+
+def task_event(payload: dict) -> Event:
+    """
+    tasks流模式的任务开始/结束转成节点事件
+    """
+    if "input" in payload:
+        return Event(NODE_START, node=payload["name"], data={"id": payload["id"]})
+    error = payload.get("error")
+    return Event(NODE_END, node=payload["name"], data={"id": payload["id"], "error": None if error is None else str(error)})
+
+
+def tool_call_events(request, execute):
+    """
+    ToolNode的wrap_tool_call，工具内部的输出都归到以tool_call id为名的输出块
+    """
+    call = request.tool_call
+    emit(TOOL_CALL, source=call["id"], name=call["name"], args=call["args"])
+    token = _source.set(call["id"])
+    try:
+        result = execute(request)
+    finally:
+        _source.reset(token)
+    emit_tool_result(call, result)
+    return result
+
+
+async def atool_call_events(request, execute):
+    call = request.tool_call
+    emit(TOOL_CALL, source=call["id"], name=call["name"], args=call["args"])
+    token = _source.set(call["id"])
+    try:
+        result = await execute(request)
+    finally:
+        _source.reset(token)
+    emit_tool_result(call, result)
+    return result
+
+
+def emit_tool_result(call: dict, result):
+    additional_kwargs = getattr(result, "additional_kwargs", {}) or {}
+    emit(
+        TOOL_RESULT,
+        str(getattr(result, "content", "")),
+        source=call["id"],
+        name=call["name"],
+        status=getattr(result, "status", "success"),
+        cached=bool(additional_kwargs.get("cached")),
+    )
+    emit(BLOCK_END, source=call["id"])
+
+
+class ConsolePrinter:
+    """
+    控制台订阅者。多个输出块并发时，同一时刻只实时打印一个，其余先缓存，
+    等正在打印的块结束后再整段输出，保证各块的输出不互相穿插。
+    写入不逐片段刷新，遇到换行或超过flush_interval秒才刷新。
+    """
+
+    def __init__(self, out=None, flush_interval: float = 0.05):
+        self.out = out or sys.stdout
+        self.flush_interval = flush_interval
+        self.owner = None  # 正在实时打印的输出块
+        self.buffers = {}  # 还没轮到打印的输出块
+        self.pending = []  # 已经结束、等待输出的整段内容
+        self._flushed = time.perf_counter()
+
+    def write(self, text: str):
+        if not text:
+            return
+        self.out.write(text)
+        now = time.perf_counter()
+        if "\n" in text or now - self._flushed >= self.flush_interval:
+            self.out.flush()
+            self._flushed = now
+
+    def block(self, source: str, text: str):
+        if self.owner is None:
+            # 没有块在打印，接管控制台并补上之前缓存的内容
+            self.owner = source
+            text = self.buffers.pop(source, "") + text
+        if self.owner == source:
+            self.write(text)
+        else:
+            self.buffers[source] = self.buffers.get(source, "") + text
+
+    def end_block(self, source: str):
+        if self.owner == source:
+            self.owner = None
+            blocks, self.pending = self.pending, []
+        else:
+            blocks = [self.buffers.pop(source, "")]
+            if self.owner is not None:
+                self.pending.extend(blocks)
+                blocks = []
+        for block in blocks:
+            self.write(block)
+
+    def __call__(self, event: Event):
+        if event.type in (TOKEN, NOTICE):
+            if event.source is None:
+                self.write(event.text)
+            else:
+                self.block(event.source, event.text)
+        elif event.type == BLOCK_END:
+            self.end_block(event.source)
+        elif event.type in (NODE_END, DONE):
+            # 节点结束时还没收尾的块全部输出
+            if self.owner is not None:
+                self.end_block(self.owner)
+            for source in list(self.buffers):
+                self.end_block(source)
+            self.out.flush()
@@ -1,25 +1,85 @@
-from langchain_openai import ChatOpenAI
-from threading import Lock
-
-lock = Lock()
+from .Proxy import LazyChatModel
+from .Limiter import LimitedChatModel, get_limiter
+from .Cache import LLMCache, CachedChatModel
+from .Context import ContextManager
+from .Trace import TracedChatModel
+from .Budget import BudgetedChatModel
 
 # 请修改
 llm_url = "your_llm_url"
 api_key = "your_api_key"
+max_concurrency = 4  # 同一服务地址同时在跑的请求数，按模型服务的承载能力调整
+cache_enabled = True  # 相同模型、参数和提示词直接复用历史回复
+cache_path = "cache/llm_cache.sqlite"
+cache_ttl = 7 * 24 * 3600  # 缓存有效期，单位秒
+cache_max_entries = 100000  # 磁盘缓存最大条数
+cache_memory_entries = 1024  # 内存缓存最大条数
+mock_llm = False  # 为True时使用Config/MockLLM.py的本地模拟模型，不访问远程服务
+# 多个模型服务时在这里填写，请求按负载和首token耗时分配，慢了对冲、失败了换服务，见Config/Pool.py；为空时只用llm_url
+llm_endpoints = [
+    # {"url": "http://10.0.0.1:8000/v1", "api_key": "your_api_key", "model": "qwen2.5-72b-instruct", "max_concurrency": 4},
+    # {"url": "http://10.0.0.2:8000/v1", "api_key": "your_api_key", "model": "qwen2.5-72b-instruct", "max_concurrency": 4},
+]
+
+
+def create_chat_model():
+    """
+    langchain_openai导入较慢，第一次调用大模型时才导入并创建
+    """
+    if mock_llm:
+        from .MockLLM import MockChatModel
+
+        return MockChatModel()
+
+    if llm_endpoints:
+        from .Pool import ChatModelPool
+
+        return ChatModelPool.from_config(llm_endpoints, max_concurrency)
+
+    from langchain_openai import ChatOpenAI
+
+    # qwen2.5用这个
+    return ChatOpenAI(
+        model="qwen2.5-72b-instruct",  # 非思考模型试试水
+        openai_api_key=api_key,
+        openai_api_base=llm_url,
+    )
+
+    # # quen3，流式输出必须设置"enable_thinking":True
+    # return ChatOpenAI(
+    # #     # model="qwen-plus",  # 目前也是qwen3
+    #     model="qwen3-32b",  # 小模型试试水
+    #     openai_api_key=api_key,
+    #     openai_api_base=llm_url,
+    #     extra_body={"enable_thinking": True},
+    # )
+
+
+chat_model = LazyChatModel(create_chat_model)
+
+
+def use_chat_model(model):
+    """
+    替换底层模型，并发限制、缓存和统计照常生效。需要在第一次调用大模型之前替换，
+    否则已经绑定工具的模型不会更新
+    """
+    chat_model.model = model
 
-# qwen2.5用这个
-llm = ChatOpenAI(
-    model="qwen2.5-72b-instruct",  # 非思考模型试试水
-    openai_api_key=api_key,
-    openai_api_base=llm_url,
-)
-
-# # quen3，流式输出必须设置"enable_thinking":True
-# llm = ChatOpenAI(
-# #     # model="qwen-plus",  # 目前也是qwen3
-#     model="qwen3-32b",  # 小模型试试水
-#     openai_api_key=api_key,
-#     openai_api_base=llm_url,
-#     extra_body={"enable_thinking": True},
-# )
+# 所有节点和工具共用，超出并发数的请求排队等待，命中缓存的请求不占并发名额；多个服务时上限为各服务之和
+if llm_endpoints:
+    llm = LimitedChatModel(
+        chat_model, get_limiter("pool", sum(e.get("max_concurrency", max_concurrency) for e in llm_endpoints))
+    )
+else:
+    llm = LimitedChatModel(chat_model, get_limiter(llm_url, max_concurrency))
+llm_cache = None
+if cache_enabled:
+    llm_cache = LLMCache(cache_path, cache_ttl, cache_max_entries, cache_memory_entries)
+    llm = CachedChatModel(llm, llm_cache)
+# 超过单轮问答的截止时间时中断输出，放在缓存外面，被中断的回复不会写入缓存
+llm = BudgetedChatModel(llm)
+# 最外层记录每次调用的耗时和token数，命中缓存的调用也会记录
+llm = TracedChatModel(llm)
 
+# 提示词中的上下文轨迹按token预算压缩，预算见Config/Context.py
+context_manager = ContextManager(llm)
@@ -0,0 +1,370 @@
+"""
+并发限制和请求调度
+
+每个大模型服务地址一个调度器，限制同时在跑的请求数，以及服务商的每分钟请求数和每分钟token数（令牌桶）。
+ToolNode并发执行多个工具时，耗时约等于最慢的那个工具，而不是所有工具之和。
+
+名额不够时按优先级排队，同优先级先到先得：拒答判断(gate) > 交互问答的分析、规划和验证(interactive)
+> 交互问答的工具调用和分段审核(tool) > 批量审核(batch)。批量审核不能占用最后reserved_slots个并发名额，
+也不能把令牌桶用到batch_reserve比例以下，交互请求到来时总有余量，延迟不受批量审核影响；
+没有交互请求时批量审核用满其余容量。各优先级的排队数和等待时间见stats()和prometheus()。
+"""
+
+import time
+import heapq
+import asyncio
+import itertools
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from threading import Event, Lock
+from .Proxy import ChatModelProxy
+from .Stream import StreamAccumulator
+from .Context import estimate_tokens
+from .Trace import note_wait, count_prompt_tokens, Histogram, ms_buckets, _span
+
+priority_classes = ["gate", "interactive", "tool", "batch"]  # 越靠前越优先
+tool_nodes = ["分段审核"]  # 这些节点里的调用按工具调用的优先级排队
+requests_per_minute = 0  # 服务商的每分钟请求数限制，0为不限
+tokens_per_minute = 0  # 服务商的每分钟token数限制（输入+输出），0为不限
+reserved_slots = 1  # 批量审核不能占用的并发名额数
+batch_reserve = 0.2  # 批量审核不能用掉的令牌桶比例
+completion_reserve = 512  # 开始时按提示词token数加上这个数预扣，结束后按实际用量多退少补
+poll_interval = 0.05  # 等待令牌桶补充时重新检查的间隔，秒
+
+_request_class = contextvars.ContextVar("request_class", default="interactive")
+_call_class = contextvars.ContextVar("call_class", default=None)
+
+
+@contextmanager
+def request_priority(name: str):
+    """
+    整轮问答的优先级，批量审核用request_priority("batch")，其中所有调用都按batch排队
+    """
+    token = _request_class.set(name)
+    try:
+        yield
+    finally:
+        _request_class.reset(token)
+
+
+@contextmanager
+def call_priority(name: str):
+    """
+    单次调用的优先级，比如拒答判断用call_priority("gate")
+    """
+    token = _call_class.set(name)
+    try:
+        yield
+    finally:
+        _call_class.reset(token)
+
+
+def current_priority() -> str:
+    if _request_class.get() == "batch":
+        return "batch"
+    call = _call_class.get()
+    if call is not None:
+        return call
+    current = _span.get()
+    if current is not None and (current.kind == "tool" or current.name in tool_nodes):
+        return "tool"
+    return "interactive"
+
+
+class TokenBucket:
+    """
+    容量为每分钟的限额，按秒匀速补充。结算时可能扣成负数，之后的请求等补回来再放行
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def allows(self, amount: float, reserve: float = 0.0) -> bool:
+        return self.level - min(amount, self.capacity) >= self.capacity * reserve
+
+    def wait_time(self, amount: float, reserve: float = 0.0) -> float:
+        missing = min(amount, self.capacity) + self.capacity * reserve - self.level
+        return max(missing, 0) * 60 / self.capacity
+
+
+class Waiter:
+    def __init__(self, priority: str, cost: int, seq: int):
+        self.priority = priority
+        self.cost = cost
+        self.rank = (priority_classes.index(priority), seq)
+        self.start = time.perf_counter()
+        self.granted = False
+        self.event = Event()
+        self.future = None  # 异步等待时的(事件循环, Future)
+
+    def __lt__(self, other):
+        return self.rank < other.rank
+
+
+class RequestScheduler:
+    def __init__(self, max_concurrency: int, rpm: int = None, tpm: int = None):
+        self.max_concurrency = max_concurrency
+        rpm = requests_per_minute if rpm is None else rpm
+        tpm = tokens_per_minute if tpm is None else tpm
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.running = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = Lock()
+        self.waiting = {name: 0 for name in priority_classes}
+        self.max_waiting = {name: 0 for name in priority_classes}
+        self.granted = {name: 0 for name in priority_classes}
+        self.waits = {name: Histogram(ms_buckets) for name in priority_classes}
+
+    def _admits(self, waiter: Waiter) -> bool:
+        batch = waiter.priority == "batch"
+        # 没有请求在跑时批量审核也放行，并发上限不大于reserved_slots时不会一直饿着
+        if self.running and self.running >= self.max_concurrency - (reserved_slots if batch else 0):
+            return False
+        reserve = batch_reserve if batch else 0.0
+        if self.requests is not None and not self.requests.allows(1, reserve):
+            return False
+        if self.tokens is not None and not self.tokens.allows(waiter.cost, reserve):
+            return False
+        return True
+
+    def _grant(self, waiter: Waiter):
+        self.running += 1
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            self.tokens.level -= waiter.cost
+        waiter.granted = True
+        self.granted[waiter.priority] += 1
+        self.waits[waiter.priority].observe((time.perf_counter() - waiter.start) * 1000)
+
+    def _dispatch(self):
+        """
+        按优先级放行排队的请求，队首放不了时后面的也不放，避免低优先级插队
+        """
+        now = time.monotonic()
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.refill(now)
+        while self._queue and self._admits(self._queue[0]):
+            waiter = heapq.heappop(self._queue)
+            self.waiting[waiter.priority] -= 1
+            self._grant(waiter)
+            if waiter.future is None:
+                waiter.event.set()
+            else:
+                loop, future = waiter.future
+                loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(True))
+
+    def _retry_after(self):
+        """
+        队首在等令牌桶补充时，多久后重新检查；没有速率限制时只等名额释放的通知
+        """
+        if self.requests is None and self.tokens is None:
+            return None
+        if not self._queue or self.running >= self.max_concurrency:
+            return poll_interval
+        waiter = self._queue[0]
+        reserve = batch_reserve if waiter.priority == "batch" else 0.0
+        waits = [poll_interval]
+        if self.requests is not None:
+            waits.append(self.requests.wait_time(1, reserve))
+        if self.tokens is not None:
+            waits.append(self.tokens.wait_time(waiter.cost, reserve))
+        return max(min(max(waits[1:], default=poll_interval), 1.0), 0.001)
+
+    def _enqueue(self, priority: str, cost: int, future=None) -> Waiter:
+        with self._lock:
+            waiter = Waiter(priority, cost, next(self._seq))
+            waiter.future = future
+            heapq.heappush(self._queue, waiter)
+            self.waiting[priority] += 1
+            self.max_waiting[priority] = max(self.max_waiting[priority], self.waiting[priority])
+            self._dispatch()
+            return waiter
+
+    def _cancel(self, waiter: Waiter):
+        """
+        等待中被中断（比如超过截止时间）时出队，已经放行的归还名额
+        """
+        with self._lock:
+            if waiter.granted:
+                self._release(waiter.cost, 0, refund_request=True)
+            else:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                self.waiting[waiter.priority] -= 1
+                self._dispatch()
+
+    def _release(self, cost: int, used: int, refund_request: bool = False):
+        self.running -= 1
+        if self.requests is not None and refund_request:
+            self.requests.level += 1
+        if self.tokens is not None:
+            self.tokens.level += cost - used
+        self._dispatch()
+
+    def release(self, cost: int, used: int):
+        """
+        结束时按实际token数结算：多扣的退回，少扣的补扣
+        """
+        with self._lock:
+            self._release(cost, used)
+
+    def acquire(self, priority: str, cost: int) -> Waiter:
+        waiter = self._enqueue(priority, cost)
+        try:
+            while True:
+                with self._lock:
+                    timeout = self._retry_after()
+                if waiter.event.wait(timeout):
+                    break
+                with self._lock:
+                    self._dispatch()
+        except BaseException:
+            self._cancel(waiter)
+            raise
+        return waiter
+
+    async def aacquire(self, priority: str, cost: int) -> Waiter:
+        """
+        异步版本，等待时让出事件循环，不阻塞其他协程
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enqueue(priority, cost, (loop, future))
+        try:
+            while not waiter.granted:
+                with self._lock:
+                    timeout = self._retry_after()
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._dispatch()
+        except BaseException:
+            self._cancel(waiter)
+            raise
+        return waiter
+
+    @contextmanager
+    def slot(self, priority: str = "interactive", cost: int = 0):
+        start = time.perf_counter()
+        self.acquire(priority, cost)
+        note_wait(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            self.release(cost, cost)
+
+    @asynccontextmanager
+    async def aslot(self, priority: str = "interactive", cost: int = 0):
+        start = time.perf_counter()
+        await self.aacquire(priority, cost)
+        note_wait(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            self.release(cost, cost)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "max_concurrency": self.max_concurrency,
+                "waiting": dict(self.waiting),
+                "max_waiting": dict(self.max_waiting),
+                "granted": dict(self.granted),
+                "wait_ms": {name: histogram.to_dict() for name, histogram in self.waits.items()},
+                "requests_available": None if self.requests is None else self.requests.level,
+                "tokens_available": None if self.tokens is None else self.tokens.level,
+            }
+
+    def prometheus(self, endpoint: str = "") -> str:
+        """
+        Prometheus文本格式的排队数和等待时间，可以拼在Trace.metrics.prometheus()后面
+        """
+        lines = []
+        with self._lock:
+            lines.append(f'cpir_llm_running{{endpoint="{endpoint}"}} {self.running}')
+            for name in priority_classes:
+                labels = f'endpoint="{endpoint}",priority="{name}"'
+                lines.append(f"cpir_llm_queue_depth{{{labels}}} {self.waiting[name]}")
+                lines.append(f"cpir_llm_queue_depth_max{{{labels}}} {self.max_waiting[name]}")
+                histogram = self.waits[name]
+                seen = 0
+                for bound, n in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    seen += n
+                    lines.append(f'cpir_llm_queue_wait_ms_bucket{{{labels},le="{bound}"}} {seen}')
+                lines.append(f"cpir_llm_queue_wait_ms_sum{{{labels}}} {histogram.total}")
+                lines.append(f"cpir_llm_queue_wait_ms_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+_limiters = {}
+_limiters_lock = Lock()
+
+
+def get_limiter(endpoint: str, max_concurrency: int) -> RequestScheduler:
+    """
+    同一个服务地址共用一个调度器，速率限制取模块级配置
+    """
+    with _limiters_lock:
+        if endpoint not in _limiters:
+            _limiters[endpoint] = RequestScheduler(max_concurrency)
+        return _limiters[endpoint]
+
+
+def used_tokens(prompt: int, stream: StreamAccumulator) -> int:
+    if stream.usage:
+        return stream.usage.get("input_tokens", 0) + stream.usage.get("output_tokens", 0)
+    return prompt + estimate_tokens(stream.text())
+
+
+class LimitedChatModel(ChatModelProxy):
+    """
+    流式输出的整个过程都占用一个并发名额。设置了每分钟token数时，按提示词估算预扣，结束后按实际用量结算
+    """
+
+    def __init__(self, model, limiter: RequestScheduler):
+        super().__init__(model)
+        self.limiter = limiter
+
+    def _prompt_tokens(self, input) -> int:
+        """
+        没有token数限制时不估算，返回None
+        """
+        return None if self.limiter.tokens is None else count_prompt_tokens(input)
+
+    def stream(self, input, config=None, **kwargs):
+        prompt = self._prompt_tokens(input)
+        cost = 0 if prompt is None else prompt + completion_reserve
+        start = time.perf_counter()
+        self.limiter.acquire(current_priority(), cost)
+        note_wait(time.perf_counter() - start)
+        stream = StreamAccumulator()
+        try:
+            for chunk in self.model.stream(input, config, **kwargs):
+                yield chunk if prompt is None else stream.add(chunk)
+        finally:
+            self.limiter.release(cost, 0 if prompt is None else used_tokens(prompt, stream))
+
+    async def astream(self, input, config=None, **kwargs):
+        prompt = self._prompt_tokens(input)
+        cost = 0 if prompt is None else prompt + completion_reserve
+        start = time.perf_counter()
+        await self.limiter.aacquire(current_priority(), cost)
+        note_wait(time.perf_counter() - start)
+        stream = StreamAccumulator()
+        try:
+            async for chunk in self.model.astream(input, config, **kwargs):
+                yield chunk if prompt is None else stream.add(chunk)
+        finally:
+            self.limiter.release(cost, 0 if prompt is None else used_tokens(prompt, stream))
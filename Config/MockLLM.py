@@ -0,0 +1,152 @@
+"""
+本地模拟模型
+
+不访问远程服务，按提示词给出确定的回复，用于离线调试和性能测试。
+首token延迟和输出速度可调，绑定工具后规划模块会按固定规则发起工具调用。
+
+用法：
+    from Config.LLM_Client import use_chat_model
+    from Config.MockLLM import MockChatModel
+    use_chat_model(MockChatModel(ttft=0.3, tokens_per_second=50))
+"""
+
+import re
+import ast
+import json
+import time
+import asyncio
+import hashlib
+from typing import Any, Callable, Optional
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from .Stream import StreamAccumulator
+
+risk_phrases = ["保证", "保本", "稳赚", "最高", "收益", "零风险", "第一", "无理由"]  # 模拟逐句审核时判为违规的措辞
+
+
+def prompt_text(messages) -> str:
+    return "\n".join(str(message.content) for message in messages)
+
+
+def digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def filler(text: str, n_chars: int) -> str:
+    """
+    由提示词哈希生成的固定文本，同一提示词每次相同
+    """
+    seed = digest(text)
+    body = f"模拟输出{seed[:8]}，"
+    return (body * (n_chars // len(body) + 1))[:n_chars] + "。"
+
+
+def default_responder(text: str, tool_names: list, reply_chars: int = 60):
+    """
+    返回字符串作为回复内容，或返回[{"name", "args"}, ...]作为工具调用
+    """
+    # 拒答判断
+    if "安全风险" in text and "拒答" in text:
+        return "回答"
+    # 逐句审核：含风险措辞的句子判为违规
+    if "逐句审核模块" in text:
+        findings = []
+        for start, end, sentence in re.findall(r"\[(\d+)-(\d+)\] (.*)", text):
+            phrase = next((p for p in risk_phrases if p in sentence), None)
+            if phrase:
+                findings.append(
+                    {"position": f"{start}-{end}", "sentence": sentence.strip(), "rule": "不得承诺收益", "reason": f"含有“{phrase}”"}
+                )
+        return json.dumps(findings, ensure_ascii=False)
+    # 术语定义
+    match = re.search(r"术语清单为：(\[.*?\])", text)
+    if match:
+        try:
+            words = ast.literal_eval(match.group(1))
+        except (ValueError, SyntaxError):
+            words = []
+        return "".join(f"{word}：{filler(word, 20)}" for word in words)
+    # 规划：还没有工具结果时先查规则和术语，拿到结果后给出最终答案
+    if "任务规划模块" in text:
+        if tool_names and "tool(" not in text:
+            calls = []
+            if "审核规则查询" in tool_names:
+                calls.append({"name": "审核规则查询", "args": {"query": "查找适用的审核规则"}})
+            if "保险术语查询" in tool_names:
+                calls.append({"name": "保险术语查询", "args": {"terms": ["犹豫期", "现金价值"]}})
+            if calls:
+                return calls
+        return "最终答案：" + filler(text, reply_chars)
+    return filler(text, reply_chars)
+
+
+class MockChatModel(BaseChatModel):
+    ttft: float = 0.0  # 首token延迟，单位秒
+    tokens_per_second: float = 0.0  # 输出速度，0为不限速
+    chars_per_token: int = 2  # 每个流式片段的字数
+    reply_chars: int = 60  # 普通回复的字数
+    tool_names: list = []
+    responder: Optional[Callable[..., Any]] = None  # 自定义回复规则，参数同default_responder
+
+    @property
+    def _llm_type(self) -> str:
+        return "mock"
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {"model_name": "mock", "tools": self.tool_names, "reply_chars": self.reply_chars}
+
+    def bind_tools(self, tools, **kwargs):
+        names = [convert_to_openai_tool(tool)["function"]["name"] for tool in tools]
+        return self.model_copy(update={"tool_names": names})
+
+    def _reply(self, messages):
+        text = prompt_text(messages)
+        responder = self.responder or default_responder
+        return responder(text, self.tool_names, self.reply_chars), digest(text)
+
+    def _chunks(self, messages):
+        reply, seed = self._reply(messages)
+        if isinstance(reply, list):
+            yield AIMessageChunk(
+                content="",
+                tool_call_chunks=[
+                    {"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False), "id": f"call_{seed[:12]}_{i}", "index": i}
+                    for i, call in enumerate(reply)
+                ],
+            )
+            return
+        step = max(self.chars_per_token, 1)
+        for i in range(0, len(reply), step):
+            yield AIMessageChunk(content=reply[i : i + step])
+
+    def _delays(self):
+        """
+        每个片段之前的等待时间
+        """
+        yield self.ttft
+        interval = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        while True:
+            yield interval
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        stream = StreamAccumulator()
+        for chunk in self._stream(messages, stop, run_manager, **kwargs):
+            stream.add(chunk.message)
+        response = stream.message()
+        message = AIMessage(content=response.content, tool_calls=response.tool_calls)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for delay, chunk in zip(self._delays(), self._chunks(messages)):
+            if delay:
+                time.sleep(delay)
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        for delay, chunk in zip(self._delays(), self._chunks(messages)):
+            if delay:
+                await asyncio.sleep(delay)
+            yield ChatGenerationChunk(message=chunk)
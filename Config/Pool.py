@@ -0,0 +1,439 @@
+"""
+多个模型服务的连接池
+
+把多个模型服务地址（可以是不同的模型）组成一个模型，对外和ChatOpenAI一样提供stream/astream/bind_tools，节点和工具不用改。
+1. 连接复用：每个服务地址一个httpx连接池，绑定工具后的模型共用同一个连接池，不会每次请求重新握手；
+2. 负载均衡：还没有首token记录的服务先各分到一个请求测出耗时，之后按(在途请求数+1)/并发上限×首token耗时的滑动平均，
+   选预计最快开始输出的服务；
+3. 对冲请求：首token超过近期首token耗时中位数的几倍还没到时，向另一个服务再发一次，先输出的一方胜出，另一方取消，只输出一份结果；
+4. 故障转移和熔断：出第一个token前失败的请求换一个服务重试；连续失败的服务熔断一段时间不再分配，
+   冷却后放一个探测请求，成功则恢复。已经开始输出后失败的请求不能续接，直接抛出异常。
+
+同步接口的每次请求在后台线程里读流，取消的请求在收到下一个片段时关闭连接；异步接口直接取消任务。
+用Benchmark/StubServer.py在本地起几个模拟服务即可测试，见Benchmark/Endpoints.py。
+"""
+
+import time
+import queue
+import asyncio
+import statistics
+import contextvars
+from collections import deque
+from threading import Lock, Thread
+from .Cache import model_signature
+
+ttft_alpha = 0.2  # 首token耗时滑动平均的权重
+default_ttft = 1.0  # 还没有记录时假定的首token耗时，秒
+ttft_window = 50  # 每个服务保留最近多少次首token耗时，用来算中位数
+hedge_enabled = True
+hedge_factor = 3.0  # 首token超过近期首token耗时中位数的这个倍数还没到，就向另一个服务对冲
+hedge_min_delay = 0.5  # 对冲的最短等待时间，秒
+hedge_min_samples = 5  # 首token耗时样本少于这个数时，对冲等待cold_hedge_delay
+cold_hedge_delay = 1.0  # 样本不足时的对冲等待时间，秒
+failure_threshold = 3  # 连续失败这么多次后熔断
+breaker_cooldown = 30.0  # 熔断后多久放一个探测请求，秒
+request_timeout = 120.0  # 单次请求的读超时，秒
+connect_timeout = 5.0
+keepalive_expiry = 60.0  # 空闲连接保留时间，秒
+
+_done = object()
+_pick_lock = Lock()  # 选服务和占用名额一起完成，半开状态只放出一个探测请求
+
+
+class Endpoint:
+    """
+    一个模型服务的在途请求数、首token耗时和熔断状态，同一个服务的所有绑定模型共用
+    """
+
+    def __init__(self, name: str, model, max_concurrency: int = 4):
+        self.name = name
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.outstanding = 0
+        self.ttft = None
+        self.samples = deque(maxlen=ttft_window)  # 最近的首token耗时，只记真正收到首token的请求
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # 连续失败次数
+        self.opened_at = None  # 熔断开始的时间
+        self.probing = False
+        self._lock = Lock()
+
+    def state(self, now: float = None) -> str:
+        if self.opened_at is None:
+            return "closed"
+        now = time.monotonic() if now is None else now
+        return "half_open" if now - self.opened_at >= breaker_cooldown else "open"
+
+    def available(self, now: float) -> bool:
+        state = self.state(now)
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    @property
+    def cold(self) -> bool:
+        return self.ttft is None
+
+    def score(self, cold_ttft: float) -> float:
+        """
+        预计多久能开始输出，越小越优先。还没有记录的服务按cold_ttft估计
+        """
+        ttft = cold_ttft if self.ttft is None else self.ttft
+        return (self.outstanding + 1) / self.max_concurrency * ttft
+
+    def acquire(self):
+        with self._lock:
+            self.outstanding += 1
+            self.requests += 1
+            if self.opened_at is not None:
+                self.probing = True
+
+    def observe_ttft(self, seconds: float, sample: bool = True):
+        """
+        sample为False表示请求被取消时已等待的时间，只拉高滑动平均，不作为首token耗时样本
+        """
+        with self._lock:
+            self.ttft = seconds if self.ttft is None else (1 - ttft_alpha) * self.ttft + ttft_alpha * seconds
+            if sample:
+                self.samples.append(seconds)
+
+    def release(self, ok: bool = None):
+        """
+        ok为True表示成功，False表示失败，None表示被取消（对冲失败的一方），不影响熔断状态
+        """
+        with self._lock:
+            self.outstanding -= 1
+            self.probing = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            elif ok is False:
+                self.errors += 1
+                self.failures += 1
+                if self.failures >= failure_threshold or self.opened_at is not None:
+                    self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.state(),
+            "outstanding": self.outstanding,
+            "ttft_ms": None if self.ttft is None else self.ttft * 1000,
+            "requests": self.requests,
+            "errors": self.errors,
+        }
+
+
+class Attempt:
+    """
+    发往一个服务的一次请求
+    """
+
+    def __init__(self, index: int, endpoint: Endpoint):
+        self.index = index
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.first = None
+        self.cancelled = False
+        self.error = None
+        self.task = None
+
+    def on_chunk(self):
+        if self.first is None:
+            self.first = time.perf_counter()
+            self.endpoint.observe_ttft(self.first - self.start)
+
+    def finish(self, ok: bool):
+        # 取消时还没出首token，用已等待的时间更新耗时，慢的服务随之降低优先级
+        if ok is None and self.first is None:
+            self.endpoint.observe_ttft(time.perf_counter() - self.start, sample=False)
+        self.endpoint.release(ok)
+
+
+class Race:
+    """
+    一次调用的各个请求：最先输出片段的请求胜出，其余取消；出首token前失败的请求换一个服务重试
+    """
+
+    def __init__(self, pool: "ChatModelPool"):
+        self.pool = pool
+        self.attempts = []
+        self.tried = set()
+        self.winner = None
+        self.running = 0
+        self.hedge_at = None
+
+    def launch(self, start) -> bool:
+        attempt = self.pool.pick(self.tried)
+        if attempt is None:
+            if not self.attempts:
+                raise RuntimeError("所有模型服务都处于熔断状态")
+            return False
+        self.tried.add(attempt.index)
+        self.attempts.append(attempt)
+        self.running += 1
+        if self.hedge_at is None and hedge_enabled:
+            self.hedge_at = time.perf_counter() + self.pool.hedge_delay()
+        start(attempt)
+        return True
+
+    def timeout(self):
+        """
+        等待下一个片段的最长时间，还可以对冲时为距离对冲的剩余时间，否则一直等
+        """
+        if self.hedge_at is None or self.winner is not None:
+            return None
+        return max(self.hedge_at - time.perf_counter(), 0)
+
+    def hedge(self, start):
+        self.hedge_at = None
+        self.launch(start)
+
+    def accept(self, attempt: Attempt) -> bool:
+        """
+        收到片段时决定是否输出：第一个出片段的请求胜出，其余请求取消
+        """
+        if self.winner is None:
+            self.winner = attempt
+            self.hedge_at = None
+            for other in self.attempts:
+                if other is not attempt:
+                    other.cancelled = True
+                    if other.task is not None:
+                        other.task.cancel()
+        return attempt is self.winner
+
+    def finished(self, attempt: Attempt, start) -> bool:
+        """
+        一个请求结束，返回整次调用是否结束
+        """
+        self.running -= 1
+        if attempt is self.winner:
+            if attempt.error is not None:
+                raise attempt.error  # 已经开始输出，不能换服务续接
+            return True
+        if self.winner is not None or attempt.cancelled:
+            return False
+        if attempt.error is None:
+            return True  # 正常结束但没有任何输出
+        # 出首token前失败：还有在跑的请求就等它，否则换一个服务
+        if not self.running:
+            self.launch(start)
+        return False
+
+    def fail(self):
+        errors = [attempt.error for attempt in self.attempts if attempt.error is not None]
+        raise errors[-1] if errors else RuntimeError("所有模型服务都处于熔断状态")
+
+
+def create_http_clients(max_connections: int):
+    import httpx
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+    timeout = httpx.Timeout(request_timeout, connect=connect_timeout)
+    return httpx.Client(limits=limits, timeout=timeout), httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+def openai_endpoint(config: dict, max_concurrency: int = 4) -> Endpoint:
+    """
+    config为{"url", "api_key", "model", "max_concurrency"(可选), "name"(可选), "kwargs"(可选，传给ChatOpenAI)}
+    """
+    from langchain_openai import ChatOpenAI
+
+    max_concurrency = config.get("max_concurrency", max_concurrency)
+    # 对冲请求会比并发上限多占一个连接
+    http_client, http_async_client = create_http_clients(max_concurrency + 1)
+    model = ChatOpenAI(
+        model=config["model"],
+        openai_api_key=config.get("api_key", "EMPTY"),
+        openai_api_base=config["url"],
+        http_client=http_client,
+        http_async_client=http_async_client,
+        max_retries=0,  # 重试由连接池换服务完成
+        **config.get("kwargs", {}),
+    )
+    return Endpoint(config.get("name") or f"{config['model']}@{config['url']}", model, max_concurrency)
+
+
+class ChatModelPool:
+    """
+    endpoints为共享状态的服务列表，models为与之对应的模型（绑定工具后是绑定后的模型）
+    """
+
+    def __init__(self, endpoints: list, models: list = None):
+        self.endpoints = endpoints
+        self.models = models if models is not None else [endpoint.model for endpoint in endpoints]
+
+    @classmethod
+    def from_config(cls, configs: list, max_concurrency: int = 4) -> "ChatModelPool":
+        return cls([openai_endpoint(config, max_concurrency) for config in configs])
+
+    @property
+    def _identifying_params(self) -> dict:
+        # 缓存键包含所有服务的模型和参数
+        return {"pool": [model_signature(model) for model in self.models]}
+
+    def bind_tools(self, tools, **kwargs):
+        return ChatModelPool(self.endpoints, [model.bind_tools(tools, **kwargs) for model in self.models])
+
+    def bind(self, **kwargs):
+        return ChatModelPool(self.endpoints, [model.bind(**kwargs) for model in self.models])
+
+    def stats(self) -> list:
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def pick(self, exclude: set):
+        """
+        可用服务里预计最快开始输出的一个，都熔断时返回None
+        """
+        with _pick_lock:
+            now = time.monotonic()
+            candidates = [
+                (i, endpoint)
+                for i, endpoint in enumerate(self.endpoints)
+                if i not in exclude and endpoint.available(now)
+            ]
+            if not candidates:
+                return None
+            # 优先选没有满载的服务
+            free = [(i, endpoint) for i, endpoint in candidates if endpoint.outstanding < endpoint.max_concurrency]
+            # 还没有记录、也没有在途请求的服务先分一个请求测出耗时，不会因为排在后面一直分不到
+            probes = [(i, endpoint) for i, endpoint in free if endpoint.cold and not endpoint.outstanding]
+            if probes:
+                i, endpoint = probes[0]
+            else:
+                cold_ttft = self.typical_ttft()
+                i, endpoint = min(free or candidates, key=lambda x: x[1].score(cold_ttft))
+            endpoint.acquire()
+        return Attempt(i, endpoint)
+
+    def ttft_samples(self) -> list:
+        return [seconds for endpoint in self.endpoints for seconds in list(endpoint.samples)]
+
+    def typical_ttft(self) -> float:
+        """
+        所有服务近期首token耗时的中位数，没有样本时为default_ttft
+        """
+        samples = self.ttft_samples()
+        return statistics.median(samples) if samples else default_ttft
+
+    def hedge_delay(self) -> float:
+        """
+        以近期首token耗时的中位数为基准，不受长尾和单个慢服务影响；样本太少时中位数不可靠，等待cold_hedge_delay
+        """
+        samples = self.ttft_samples()
+        if len(samples) < hedge_min_samples:
+            return max(hedge_min_delay, cold_hedge_delay)
+        return max(hedge_min_delay, hedge_factor * statistics.median(samples))
+
+    def _run(self, attempt: Attempt, input, config, kwargs: dict, events: queue.Queue):
+        ok = None
+        try:
+            iterator = self.models[attempt.index].stream(input, config, **kwargs)
+            try:
+                for chunk in iterator:
+                    if attempt.cancelled:
+                        break
+                    attempt.on_chunk()
+                    events.put((attempt, chunk))
+                else:
+                    ok = True
+            finally:
+                iterator.close()
+        except Exception as e:
+            if not attempt.cancelled:
+                ok = False
+                attempt.error = e
+        finally:
+            attempt.finish(ok)
+            events.put((attempt, _done))
+
+    def stream(self, input, config=None, **kwargs):
+        race = Race(self)
+        events = queue.Queue()
+
+        def start(attempt):
+            # 带上当前上下文，trace和预算照常计入所在节点
+            Thread(
+                target=contextvars.copy_context().run,
+                args=(self._run, attempt, input, config, kwargs, events),
+                daemon=True,
+            ).start()
+
+        race.launch(start)
+        try:
+            while race.running:
+                try:
+                    attempt, item = events.get(timeout=race.timeout())
+                except queue.Empty:
+                    race.hedge(start)
+                    continue
+                if item is _done:
+                    if race.finished(attempt, start):
+                        return
+                elif race.accept(attempt):
+                    yield item
+            race.fail()
+        finally:
+            for attempt in race.attempts:
+                attempt.cancelled = True
+
+    async def _arun(self, attempt: Attempt, input, config, kwargs: dict, events: asyncio.Queue):
+        ok = None
+        try:
+            async for chunk in self.models[attempt.index].astream(input, config, **kwargs):
+                attempt.on_chunk()
+                events.put_nowait((attempt, chunk))
+            ok = True
+        except Exception as e:
+            ok = False
+            attempt.error = e
+        finally:
+            attempt.finish(ok)
+            events.put_nowait((attempt, _done))
+
+    async def astream(self, input, config=None, **kwargs):
+        race = Race(self)
+        events = asyncio.Queue()
+
+        def start(attempt):
+            attempt.task = asyncio.create_task(self._arun(attempt, input, config, kwargs, events))
+
+        race.launch(start)
+        try:
+            while race.running:
+                try:
+                    attempt, item = await asyncio.wait_for(events.get(), race.timeout())
+                except asyncio.TimeoutError:
+                    race.hedge(start)
+                    continue
+                if item is _done:
+                    if race.finished(attempt, start):
+                        return
+                elif race.accept(attempt):
+                    yield item
+            race.fail()
+        finally:
+            for attempt in race.attempts:
+                attempt.cancelled = True
+                if attempt.task is not None and not attempt.task.done():
+                    attempt.task.cancel()
+
+    def invoke(self, input, config=None, **kwargs):
+        from .Stream import StreamAccumulator
+
+        stream = StreamAccumulator()
+        for chunk in self.stream(input, config, **kwargs):
+            stream.add(chunk)
+        return stream.message()
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        from .Stream import StreamAccumulator
+
+        stream = StreamAccumulator()
+        async for chunk in self.astream(input, config, **kwargs):
+            stream.add(chunk)
+        return stream.message()
@@ -0,0 +1,77 @@
+"""
+大模型代理基类
+
+对外保持和ChatOpenAI一致的stream/astream/invoke/ainvoke/bind_tools接口，子类只需要改写stream和astream，
+节点和工具的调用方式不用变。
+"""
+
+import copy
+from threading import Lock
+from langchain_core.messages import AIMessageChunk
+from .Stream import StreamAccumulator
+
+
+class ChatModelProxy:
+    def __init__(self, model):
+        self.model = model
+
+    def _wrap(self, model):
+        """
+        bind_tools等方法返回的新模型，同样套上当前代理
+        """
+        proxy = copy.copy(self)
+        proxy.model = model
+        return proxy
+
+    def bind_tools(self, tools, **kwargs):
+        return self._wrap(self.model.bind_tools(tools, **kwargs))
+
+    def bind(self, **kwargs):
+        return self._wrap(self.model.bind(**kwargs))
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.model.stream(input, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        async for chunk in self.model.astream(input, config, **kwargs):
+            yield chunk
+
+    def invoke(self, input, config=None, **kwargs) -> AIMessageChunk:
+        stream = StreamAccumulator()
+        for chunk in self.stream(input, config, **kwargs):
+            stream.add(chunk)
+        return stream.message()
+
+    async def ainvoke(self, input, config=None, **kwargs) -> AIMessageChunk:
+        stream = StreamAccumulator()
+        async for chunk in self.astream(input, config, **kwargs):
+            stream.add(chunk)
+        return stream.message()
+
+    def __getattr__(self, name):
+        if name == "model" or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+class LazyChatModel(ChatModelProxy):
+    """
+    第一次使用时才调用factory创建模型，导入时不加载模型SDK，进程启动更快
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._model = None
+        self._lock = Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self.factory()
+        return self._model
+
+    @model.setter
+    def model(self, model):
+        self._model = model
@@ -0,0 +1,90 @@
+"""
+流式输出的拼接
+
+AIMessageChunk逐个相加时每次都会复制已有内容、重新合并工具调用参数的JSON片段，输出越长越慢（平方级）。
+这里把文本和各工具调用的参数片段分别追加到列表，结束时拼接一次、解析一次工具调用；
+出现第一个工具调用片段时就能知道模型开始调用工具，不用等到解析完。
+"""
+
+import json
+from langchain_core.messages import AIMessageChunk
+from langchain_core.messages.ai import add_usage
+
+
+class StreamAccumulator:
+    def __init__(self):
+        self.chunks = 0
+        self.contents = []
+        self.calls = {}  # 工具调用的index -> {"name", "id", "args": [参数片段]}
+        self.usage = None
+        self.response_metadata = {}
+        self.id = None
+
+    @property
+    def has_tool_calls(self) -> bool:
+        return bool(self.calls)
+
+    @property
+    def truncated(self) -> bool:
+        """
+        超过截止时间被中断（见Config/Budget.py），输出不完整
+        """
+        return bool(self.response_metadata.get("truncated"))
+
+    def add(self, chunk):
+        """
+        追加一个片段，返回片段本身，方便边拼接边转发
+        """
+        self.chunks += 1
+        if isinstance(chunk.content, str):
+            if chunk.content:
+                self.contents.append(chunk.content)
+        elif chunk.content:
+            self.contents.extend(part if isinstance(part, str) else part.get("text", "") for part in chunk.content)
+        calls = getattr(chunk, "tool_call_chunks", None)
+        if calls is None:  # 完整的AIMessage（比如缓存命中）只有解析好的tool_calls
+            calls = [
+                {"name": call["name"], "id": call["id"], "args": json.dumps(call["args"], ensure_ascii=False), "index": None}
+                for call in getattr(chunk, "tool_calls", None) or ()
+            ]
+        for call in calls:
+            # 没有index的片段各自是一个工具调用
+            index = call.get("index")
+            if index is None:
+                index = ("chunk", len(self.calls))
+            merged = self.calls.setdefault(index, {"name": None, "id": None, "args": []})
+            merged["name"] = merged["name"] or call.get("name")
+            merged["id"] = merged["id"] or call.get("id")
+            if call.get("args"):
+                merged["args"].append(call["args"])
+        if getattr(chunk, "usage_metadata", None):
+            self.usage = add_usage(self.usage, chunk.usage_metadata)
+        if chunk.response_metadata:
+            self.response_metadata.update(chunk.response_metadata)
+        self.id = self.id or chunk.id
+        return chunk
+
+    def text(self) -> str:
+        return "".join(self.contents)
+
+    def message(self):
+        """
+        拼成一个完整的AIMessageChunk，工具调用的参数在这里解析一次，没有任何片段时返回None
+        """
+        if not self.chunks:
+            return None
+        return AIMessageChunk(
+            content=self.text(),
+            id=self.id,
+            tool_call_chunks=[
+                {
+                    "name": call["name"],
+                    "id": call["id"],
+                    "args": "".join(call["args"]),
+                    "index": index if isinstance(index, int) else None,
+                }
+                for index, call in self.calls.items()
+            ],
+            usage_metadata=self.usage,
+            response_metadata=self.response_metadata,
+        )
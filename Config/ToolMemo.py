@@ -0,0 +1,136 @@
+"""
+工具调用结果复用
+
+规划模块经常用相同参数重复调用同一个工具，每次都是一次完整的大模型调用。
+以工具名、规范化后的参数和文档哈希为键：同一会话内直接复用历史消息里的工具结果，
+检索类工具还可以跨会话复用（同一文档），存在本地SQLite。复用的结果会注明来自缓存，规划模块据此不再重复调用。
+依赖知识库的工具的键还带上知识库版本，规则库和术语库热更新后不会复用旧结果。
+"""
+
+import json
+import hashlib
+from langchain_core.messages import ToolMessage
+from .Console import ToolConsole
+from .Budget import watch_truncation
+
+cached_note = "（缓存结果：之前已经用相同参数调用过该工具，结果不会变化，无需再次调用）\n"
+
+
+def normalize(value):
+    """
+    字符串去掉多余空白，字符串列表（如术语列表）去重排序，顺序不同的同一组参数视为相同
+    """
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, list):
+        items = [normalize(item) for item in value]
+        if all(isinstance(item, str) for item in items):
+            return sorted(set(items))
+        return items
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    return value
+
+
+def digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def memo_key(name: str, args: dict, document: str, version: str = "") -> str:
+    data = json.dumps(
+        {"tool": name, "args": normalize(args), "document": digest(document), "version": version},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return digest(data)
+
+
+class ToolMemo:
+    """
+    ToolNode的wrap_tool_call，tools为可以复用结果的工具名，persistent为其中可以跨会话复用的，
+    cache为跨会话复用的存储（Config/Cache.py的LLMCache），为None时只在会话内复用，
+    versioned为结果依赖知识库的工具名，version为返回当前知识库版本的函数
+    """
+
+    def __init__(self, tools, persistent=(), cache=None, versioned=(), version=None):
+        self.tools = set(tools)
+        self.persistent = set(persistent) & self.tools
+        self.cache = cache
+        self.versioned = set(versioned) & self.tools
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, request):
+        name = request.tool_call["name"]
+        if name not in self.tools:
+            return None
+        context = getattr(request.runtime, "context", None) or {}
+        version = self.version() if self.version is not None and name in self.versioned else ""
+        return memo_key(name, request.tool_call["args"], context.get("document", ""), version)
+
+    def lookup(self, request, key: str):
+        """
+        先找本会话历史消息里的同键结果，再找跨会话存储
+        """
+        state = request.state if isinstance(request.state, dict) else {}
+        for message in reversed(state.get("messages", [])):
+            if (
+                isinstance(message, ToolMessage)
+                and message.additional_kwargs.get("memo_key") == key
+                and message.status != "error"
+            ):
+                return message.content.removeprefix(cached_note)
+        if self.cache is not None and request.tool_call["name"] in self.persistent:
+            return self.cache.get(key)
+        return None
+
+    def cached_message(self, request, key: str, content: str) -> ToolMessage:
+        self.hits += 1
+        call = request.tool_call
+        with ToolConsole(f"\n♻️复用结果={call['name']}") as console:
+            console.print(content)
+        return ToolMessage(
+            content=cached_note + content,
+            name=call["name"],
+            tool_call_id=call["id"],
+            additional_kwargs={"memo_key": key, "cached": True},
+        )
+
+    def remember(self, request, key: str, message, truncated: bool = False):
+        """
+        执行成功的结果打上键，留在消息里供本会话复用；输出超过截止时间被中断的结果不完整，不复用
+        """
+        self.misses += 1
+        if truncated or not isinstance(message, ToolMessage) or message.status == "error":
+            return message
+        message.additional_kwargs["memo_key"] = key
+        if self.cache is not None and request.tool_call["name"] in self.persistent:
+            self.cache.set(key, str(message.content))
+        return message
+
+    def wrap(self, request, execute):
+        key = self._key(request)
+        if key is None:
+            return execute(request)
+        content = self.lookup(request, key)
+        if content is not None:
+            return self.cached_message(request, key, content)
+        with watch_truncation() as watch:
+            message = execute(request)
+        return self.remember(request, key, message, watch.truncated)
+
+    async def awrap(self, request, execute):
+        key = self._key(request)
+        if key is None:
+            return await execute(request)
+        content = self.lookup(request, key)
+        if content is not None:
+            return self.cached_message(request, key, content)
+        with watch_truncation() as watch:
+            message = await execute(request)
+        return self.remember(request, key, message, watch.truncated)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
@@ -0,0 +1,365 @@
+"""
+耗时和token统计
+
+每轮问答记录一条trace：每个节点和工具的耗时、首token时间、输入输出token数、等待并发名额的时间和所在轮次，
+结束时追加写入JSONL文件，同时汇总成直方图，可以导出为JSON文件或Prometheus文本格式。
+"""
+
+import os
+import json
+import time
+import uuid
+import functools
+import inspect
+import contextvars
+from contextlib import contextmanager
+from threading import Lock
+from .Proxy import ChatModelProxy
+from .Stream import StreamAccumulator
+from .Context import estimate_tokens, render_message
+from .Budget import charge
+
+trace_enabled = True  # 关闭后不记录trace，直方图照常汇总
+trace_path = "traces/trace.jsonl"
+metrics_path = "traces/metrics.json"
+
+# 直方图分桶上界，最后一个桶为+Inf
+ms_buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000]
+token_buckets = [64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+
+_trace = contextvars.ContextVar("trace", default=None)
+_span = contextvars.ContextVar("span", default=None)
+
+
+class Span:
+    """
+    一个节点或工具的一次执行，期间所有大模型调用的统计都累加在这里
+    """
+
+    def __init__(self, kind: str, name: str, loop=None, parent=None):
+        self.kind = kind  # node / tool / request
+        self.name = name
+        self.loop = loop
+        self.parent = parent.name if parent else None
+        self.start = time.time()
+        self._perf = time.perf_counter()
+        self.wall_ms = 0.0
+        self.ttft_ms = None  # 从开始执行到第一个大模型token的时间
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.wait_ms = 0.0
+        self.llm_calls = []
+        self.error = None
+        self._lock = Lock()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._perf) * 1000
+
+    def add_wait(self, ms: float):
+        with self._lock:
+            self.wait_ms += ms
+
+    def add_call(self, call: dict):
+        with self._lock:
+            self.llm_calls.append(call)
+            self.prompt_tokens += call["prompt_tokens"]
+            self.completion_tokens += call["completion_tokens"]
+            if call["first_token_at_ms"] is not None:
+                ttft = call["first_token_at_ms"] - self._perf * 1000
+                if self.ttft_ms is None or ttft < self.ttft_ms:
+                    self.ttft_ms = ttft
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "parent": self.parent,
+            "loop": self.loop,
+            "start": round(self.start, 3),
+            "wall_ms": round(self.wall_ms, 1),
+            "ttft_ms": None if self.ttft_ms is None else round(self.ttft_ms, 1),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "wait_ms": round(self.wait_ms, 1),
+            "llm_calls": [
+                {key: value for key, value in call.items() if key != "first_token_at_ms"}
+                for call in self.llm_calls
+            ],
+            "error": self.error,
+        }
+
+
+class Histogram:
+    def __init__(self, buckets: list):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """
+        按桶上界估计分位数
+        """
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": self.buckets,
+            "counts": self.counts,
+            "count": self.count,
+            "sum": round(self.total, 1),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+        }
+
+
+class Metrics:
+    """
+    按(类型, 名称, 指标)汇总的直方图
+    """
+
+    fields = {
+        "wall_ms": ms_buckets,
+        "ttft_ms": ms_buckets,
+        "wait_ms": ms_buckets,
+        "prompt_tokens": token_buckets,
+        "completion_tokens": token_buckets,
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = Lock()
+
+    def observe(self, span: Span):
+        with self._lock:
+            for field, buckets in self.fields.items():
+                value = getattr(span, field)
+                if value is None:
+                    continue
+                key = (span.kind, span.name, field)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for (kind, name, field), histogram in sorted(self.histograms.items()):
+                result.setdefault(f"{kind}:{name}", {})[field] = histogram.to_dict()
+            return result
+
+    def prometheus(self) -> str:
+        """
+        Prometheus文本格式，可以直接作为/metrics接口的返回
+        """
+        lines = []
+        with self._lock:
+            for (kind, name, field), histogram in sorted(self.histograms.items()):
+                metric = f"cpir_{field}"
+                labels = f'kind="{kind}",name="{name}"'
+                seen = 0
+                for bound, n in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    seen += n
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {seen}')
+                lines.append(f"{metric}_sum{{{labels}}} {histogram.total}")
+                lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str = metrics_path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
+_write_lock = Lock()
+
+
+class RequestTrace:
+    def __init__(self, request_id: str, meta: dict):
+        self.request_id = request_id
+        self.meta = meta
+        self.spans = []
+        self._lock = Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+@contextmanager
+def span(kind: str, name: str, loop=None):
+    parent = _span.get()
+    current = Span(kind, name, loop, parent)
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _span.reset(token)
+        current.wall_ms = current.elapsed_ms()
+        metrics.observe(current)
+        trace = _trace.get()
+        if trace is not None:
+            trace.add(current)
+
+
+@contextmanager
+def trace_request(request_id: str = None, **meta):
+    """
+    一轮问答的trace，结束时写入trace_path并更新metrics_path
+    """
+    trace = RequestTrace(request_id or uuid.uuid4().hex, meta)
+    token = _trace.set(trace if trace_enabled else None)
+    try:
+        with span("request", "问答") as root:
+            yield trace
+    finally:
+        _trace.reset(token)
+        if trace_enabled:
+            record = {
+                "request_id": trace.request_id,
+                **trace.meta,
+                "wall_ms": round(root.wall_ms, 1),
+                "spans": [s.to_dict() for s in sorted(trace.spans, key=lambda s: s.start) if s is not root],
+            }
+            with _write_lock:
+                os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+                with open(trace_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                metrics.dump(metrics_path)
+
+
+def state_loop(args: tuple):
+    state = args[0] if args else None
+    return state.get("n_loop") if isinstance(state, dict) else None
+
+
+def traced(kind: str, name: str):
+    """
+    节点函数的装饰器，同步和异步函数都适用，轮次取自state["n_loop"]
+    """
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def awrapper(*args, **kwargs):
+                with span(kind, name, state_loop(args)):
+                    return await func(*args, **kwargs)
+
+            return awrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, name, state_loop(args)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def trace_tool_call(request, execute):
+    """
+    ToolNode的wrap_tool_call，每个工具调用一个span
+    """
+    with span("tool", request.tool_call["name"], state_loop((request.state,))):
+        return execute(request)
+
+
+async def atrace_tool_call(request, execute):
+    with span("tool", request.tool_call["name"], state_loop((request.state,))):
+        return await execute(request)
+
+
+def note_wait(seconds: float):
+    """
+    并发限制器等待名额的时间，计入当前span
+    """
+    current = _span.get()
+    if current is not None:
+        current.add_wait(seconds * 1000)
+
+
+def count_prompt_tokens(input) -> int:
+    if isinstance(input, str):
+        return estimate_tokens(input)
+    return sum(estimate_tokens(render_message(message)) for message in input)
+
+
+class TracedChatModel(ChatModelProxy):
+    """
+    记录每次大模型调用的耗时、首token时间和token数，同时计入本轮问答的预算。
+    服务端返回usage时用实际值，否则按Context.estimate_tokens估算；命中缓存的调用不访问模型服务，不计入预算
+    """
+
+    def _start(self, input):
+        return {"prompt_tokens": count_prompt_tokens(input), "start": time.perf_counter()}
+
+    def _finish(self, call: dict, first, response):
+        now = time.perf_counter()
+        usage = getattr(response, "usage_metadata", None) or {}
+        completion = 0
+        if response is not None:
+            completion = estimate_tokens(str(response.content))
+            for chunk in getattr(response, "tool_call_chunks", None) or []:
+                completion += estimate_tokens(f"{chunk.get('name') or ''}{chunk.get('args') or ''}")
+        record = {
+            "wall_ms": round((now - call["start"]) * 1000, 1),
+            "ttft_ms": None if first is None else round((first - call["start"]) * 1000, 1),
+            "prompt_tokens": usage.get("input_tokens") or call["prompt_tokens"],
+            "completion_tokens": usage.get("output_tokens") or completion,
+            "usage": "server" if usage else "estimated",
+            "first_token_at_ms": None if first is None else first * 1000,
+        }
+        if response is not None and response.response_metadata.get("cache_hit"):
+            record["usage"] = "cache"
+        else:
+            charge(record["prompt_tokens"] + record["completion_tokens"])
+        current = _span.get()
+        if current is not None:
+            current.add_call(record)
+
+    def stream(self, input, config=None, **kwargs):
+        call = self._start(input)
+        first = None
+        stream = StreamAccumulator()
+        try:
+            for chunk in self.model.stream(input, config, **kwargs):
+                if first is None:
+                    first = time.perf_counter()
+                yield stream.add(chunk)
+        finally:
+            self._finish(call, first, stream.message())
+
+    async def astream(self, input, config=None, **kwargs):
+        call = self._start(input)
+        first = None
+        stream = StreamAccumulator()
+        try:
+            async for chunk in self.model.astream(input, config, **kwargs):
+                if first is None:
+                    first = time.perf_counter()
+                yield stream.add(chunk)
+        finally:
+            self._finish(call, first, stream.message())
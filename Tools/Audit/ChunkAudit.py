@@ -0,0 +1,186 @@
+"""
+分段审核
+
+长文档按句子切成片段，每个片段在本地初筛候选规则和术语，再并发调用大模型逐句判断，
+最后按句子在原文中的位置合并成完整的审核发现。耗时取决于并发数，而不是文档长度。
+"""
+
+import re
+import json
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from Config.LLM_Client import llm
+from Config.Console import ToolConsole
+from Tools.Search.KnowledgeBase import knowledge_base
+from Tools.Search.RulesSearch import search_rules
+from .Segment import chunk_document
+
+chunk_min_chars = 500  # 文档超过这个长度才分段审核，短文档直接交给规划模块
+chunk_max_chars = 300  # 每个片段的最大字数
+chunk_rules_k = 5  # 每个片段初筛的规则数
+chunk_workers = 8  # 同时审核的片段数，实际并发还受max_concurrency限制
+chunk_retries = 1  # 输出无法解析时重新审核的次数，仍然失败的片段不记录发现
+
+
+def document_view(document: str) -> str:
+    """
+    长文档在提示词里只放开头部分，完整内容由分段审核逐句处理
+    """
+    if len(document) < chunk_min_chars:
+        return document
+    return f"{document[:chunk_min_chars]}……（全文共{len(document)}字，已按句子分段审核，见逐句审核结果）"
+
+
+def chunk_prompt(chunk: dict, query: str):
+    """
+    片段内没有命中任何规则时返回None，不调用大模型
+    """
+    text = "\n".join(f"[{start}-{end}] {sentence}" for start, end, sentence in chunk["sentences"])
+    kb = knowledge_base()
+    hits = search_rules(text, k=chunk_rules_k, kb=kb)
+    if not hits:
+        return None
+    rules = [kb.rules[doc_id] for doc_id, _ in hits]
+    terms = [
+        f"{term}：{kb.terms(name)[term]}"
+        for name in ["insurance", "consumer_protection"]
+        for term in kb.automaton(name).find_all(text)
+    ]
+    return f"""
+    你是宣传文档的逐句审核模块，请判断下面这段文档中的每一句是否违反给定的消保审核规则。
+    任务指令为：{query}。
+    文档片段为（方括号内是句子在原文中的起止位置）：
+    {text}
+    候选规则为：{rules}。其中fileName为审核规则的来源，rule为审核规则的内容。
+    相关术语为：{terms}。
+    请只输出JSON列表，每个违规句子一项，格式为[{{"position": "起始-结束", "sentence": "原句", "rule": "违反的规则及来源", "reason": "违规原因"}}]，没有违规时输出[]。
+    """
+
+
+def locate(item: dict, chunk: dict):
+    """
+    审核发现在原文中的位置：优先用大模型给出的位置，限制在片段范围内；位置缺失或落在片段外时按原句在片段中查找，
+    都找不到时记为整个片段
+    """
+    position = re.match(r"\s*(\d+)\s*-\s*(\d+)", str(item.get("position", "")))
+    if position:
+        start, end = int(position.group(1)), int(position.group(2))
+        if start <= end and start < chunk["end"] and end > chunk["start"]:
+            return max(start, chunk["start"]), min(end, chunk["end"])
+    sentence = str(item.get("sentence", "")).strip()
+    for start, end, text in chunk["sentences"]:
+        if sentence and (sentence in text or text in sentence):
+            return start, end
+    return chunk["start"], chunk["end"]
+
+
+def parse_findings(text: str, chunk: dict):
+    """
+    解析大模型输出的JSON，解析失败时返回None，由调用方重试；不是对象或缺少违规原因的项丢弃
+    """
+    match = re.search(r"\[.*\]", text, re.S)
+    try:
+        items = json.loads(match.group()) if match else None
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        return None
+
+    findings = []
+    for item in items:
+        if not isinstance(item, dict) or not (item.get("rule") or item.get("reason")):
+            continue
+        start, end = locate(item, chunk)
+        findings.append(
+            {
+                "start": start,
+                "end": end,
+                "sentence": str(item.get("sentence", "")),
+                "rule": str(item.get("rule", "")),
+                "reason": str(item.get("reason", "")),
+            }
+        )
+    return findings
+
+
+def merge_findings(results: list) -> list:
+    """
+    按句子位置排序，同一句子违反同一规则只保留一次
+    """
+    merged = {}
+    for findings in results:
+        for finding in findings:
+            merged.setdefault((finding["start"], finding["rule"]), finding)
+    return sorted(merged.values(), key=lambda x: (x["start"], x["end"]))
+
+
+def format_findings(findings: list) -> str:
+    if not findings:
+        return "逐句审核未发现违规内容。"
+    lines = []
+    for finding in findings:
+        line = f"[{finding['start']}-{finding['end']}]"
+        if finding["sentence"]:
+            line += f" 「{finding['sentence']}」"
+        if finding["rule"]:
+            line += f" 违反：{finding['rule']}"
+        if finding["reason"]:
+            line += f" 原因：{finding['reason']}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def audit_chunk(i: int, chunk: dict, query: str) -> list:
+    prompt = chunk_prompt(chunk, query)
+    if prompt is None:
+        return []
+    for attempt in range(chunk_retries + 1):
+        title = f"\n📑分段审核=第{i + 1}段[{chunk['start']}-{chunk['end']}]" + ("（重试）" if attempt else "")
+        with ToolConsole(title) as console:
+            text = console.stream(llm, prompt)
+        findings = parse_findings(text, chunk)
+        if findings is not None:
+            return findings
+    return []
+
+
+async def aaudit_chunk(i: int, chunk: dict, query: str) -> list:
+    prompt = chunk_prompt(chunk, query)
+    if prompt is None:
+        return []
+    for attempt in range(chunk_retries + 1):
+        title = f"\n📑分段审核=第{i + 1}段[{chunk['start']}-{chunk['end']}]" + ("（重试）" if attempt else "")
+        with ToolConsole(title) as console:
+            text = await console.astream(llm, prompt)
+        findings = parse_findings(text, chunk)
+        if findings is not None:
+            return findings
+    return []
+
+
+def chunk_audit(document: str, query: str) -> list:
+    """
+    并发审核所有片段，返回按位置排序的审核发现
+    """
+    chunks = chunk_document(document, chunk_max_chars)
+    with ThreadPoolExecutor(max_workers=chunk_workers) as pool:
+        # 每个片段带上当前上下文，大模型调用的统计计入所在节点
+        futures = [
+            pool.submit(contextvars.copy_context().run, audit_chunk, i, chunk, query)
+            for i, chunk in enumerate(chunks)
+        ]
+        results = [future.result() for future in futures]
+    return merge_findings(results)
+
+
+async def achunk_audit(document: str, query: str) -> list:
+    chunks = chunk_document(document, chunk_max_chars)
+    semaphore = asyncio.Semaphore(chunk_workers)
+
+    async def run(i, chunk):
+        async with semaphore:
+            return await aaudit_chunk(i, chunk, query)
+
+    results = await asyncio.gather(*[run(i, chunk) for i, chunk in enumerate(chunks)])
+    return merge_findings(results)
@@ -0,0 +1,243 @@
+"""
+相似文档复用
+
+送审的文案很多是同一活动文案的变体，只改了几句话，每个变体仍然要走完整的拒答、分析、规划、工具和验证闭环。
+审核完成的文档连同任务指令、最终答案和逐句审核结果存在本地SQLite，按字符片段计算MinHash签名并用LSH分桶索引。
+新文档先按桶找同一任务指令下的候选，再按分句（逗号也切开）逐句比对：未改动内容的占比达到阈值时沿用之前的结论，
+只把新增或改写的句子交给大模型审核，批量审核的成本大致和新内容的多少成正比。完全相同的文档直接复用，不调用大模型。
+"""
+
+import os
+import json
+import time
+import zlib
+import random
+import sqlite3
+import hashlib
+import difflib
+from threading import Lock
+from Tools.Search.KnowledgeBase import knowledge_base
+from Tools.Search.RulesSearch import search_rules
+from .Segment import split_sentences, clause_end
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+near_duplicate_path = "cache/audited_documents.sqlite"
+near_duplicate_threshold = 0.6  # 未改动内容占文档的比例达到这个值才复用
+max_documents = 20000  # 最多保存的文档数，超出时删除最早的
+shingle_size = 5  # 计算MinHash的字符片段长度
+num_perm = 64  # MinHash签名长度
+num_bands = 32  # LSH分桶数，每桶num_perm/num_bands行；字符片段相似度0.4的文档有99%以上的概率至少落进同一个桶
+max_candidates = 3  # 按签名相似度取前几个候选逐句比对
+reuse_rules_k = 5  # 改动句子初筛的规则数
+
+_prime = (1 << 31) - 1
+_rng = random.Random(20240601)  # 固定种子，不同进程算出的签名一致
+_coef_a = [_rng.randrange(1, _prime) for _ in range(num_perm)]
+_coef_b = [_rng.randrange(0, _prime) for _ in range(num_perm)]
+_coef = None if np is None else (np.array(_coef_a, dtype=np.uint64)[:, None], np.array(_coef_b, dtype=np.uint64)[:, None])
+
+
+def normalize(text: str) -> str:
+    return "".join(text.split())
+
+
+def shingles(text: str) -> set:
+    """
+    去掉空白后的字符片段，用crc32编码，文档短于片段长度时整段作为一个片段
+    """
+    text = normalize(text)
+    if len(text) <= shingle_size:
+        return {zlib.crc32(text.encode("utf-8"))} if text else set()
+    return {zlib.crc32(text[i : i + shingle_size].encode("utf-8")) for i in range(len(text) - shingle_size + 1)}
+
+
+def minhash(text: str) -> list:
+    grams = shingles(text)
+    if not grams:
+        return [_prime] * num_perm
+    if _coef is not None:
+        x = np.fromiter(grams, dtype=np.uint64, count=len(grams))
+        return ((_coef[0] * x + _coef[1]) % _prime).min(axis=1).tolist()
+    return [min((a * x + b) % _prime for x in grams) for a, b in zip(_coef_a, _coef_b)]
+
+
+def estimate_similarity(a: list, b: list) -> float:
+    """
+    两个签名相同位置取值相等的比例，是字符片段Jaccard相似度的估计
+    """
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def band_keys(signature: list, query: str) -> list:
+    """
+    每个桶的键带上任务指令，只有同一指令下的文档才会成为候选
+    """
+    rows = num_perm // num_bands
+    query = " ".join(query.split())
+    return [
+        hashlib.sha1(f"{query}\0{band}\0{signature[band * rows : (band + 1) * rows]}".encode("utf-8")).hexdigest()[:16]
+        for band in range(num_bands)
+    ]
+
+
+def diff_clauses(old: str, new: str) -> dict:
+    """
+    按分句比对两份文档，返回{"similarity": 未改动内容的占比, "kept": [(新位置起, 止, 句子)],
+    "added": [(新位置起, 止, 句子)], "removed": [句子]}
+    """
+    old_clauses = split_sentences(old, clause_end)
+    new_clauses = split_sentences(new, clause_end)
+    matcher = difflib.SequenceMatcher(
+        None, [normalize(c[2]) for c in old_clauses], [normalize(c[2]) for c in new_clauses], autojunk=False
+    )
+    kept, added, removed = [], [], []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            kept.extend(new_clauses[j1:j2])
+        else:
+            removed.extend(c[2] for c in old_clauses[i1:i2])
+            added.extend(new_clauses[j1:j2])
+    total = max(sum(len(c[2]) for c in old_clauses), sum(len(c[2]) for c in new_clauses), 1)
+    return {"similarity": sum(len(c[2]) for c in kept) / total, "kept": kept, "added": added, "removed": removed}
+
+
+def remap_findings(findings: str, document: str) -> str:
+    """
+    逐句审核结果里的句子在新文档中仍然存在时更新起止位置，句子已经被删改的结果去掉
+    """
+    lines = []
+    for line in findings.splitlines():
+        if "「" not in line or "」" not in line:
+            continue
+        sentence = line[line.index("「") + 1 : line.index("」")]
+        start = document.find(sentence) if sentence else -1
+        if start < 0:
+            continue
+        lines.append(f"[{start}-{start + len(sentence)}]{line[line.index(']') + 1 :]}")
+    return "\n".join(lines)
+
+
+class DocumentStore:
+    """
+    已审核文档的指纹库，线程安全，多个批量审核的线程共用一个连接
+    """
+
+    def __init__(self, path: str = near_duplicate_path, max_entries: int = max_documents):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, query TEXT, document TEXT, answer TEXT,
+                findings TEXT, signature TEXT, created REAL
+            );
+            CREATE TABLE IF NOT EXISTS bands (key TEXT, doc_id INTEGER);
+            CREATE INDEX IF NOT EXISTS idx_band ON bands (key);
+            """
+        )
+        self.conn.commit()
+
+    def lookup(self, document: str, query: str, threshold: float = near_duplicate_threshold):
+        """
+        找同一任务指令下最相似的已审核文档，未改动内容的占比低于阈值时返回None。
+        返回{"id", "document", "answer", "findings", "similarity", "kept", "added", "removed"}
+        """
+        signature = minhash(document)
+        keys = band_keys(signature, query)
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT DISTINCT d.id, d.document, d.answer, d.findings, d.signature FROM bands b "
+                f"JOIN documents d ON d.id = b.doc_id WHERE b.key IN ({','.join('?' * len(keys))})",
+                keys,
+            ).fetchall()
+        candidates = sorted(rows, key=lambda row: estimate_similarity(signature, json.loads(row[4])), reverse=True)
+        best = None
+        for doc_id, old, answer, findings, _ in candidates[:max_candidates]:
+            diff = diff_clauses(old, document)
+            if diff["similarity"] >= threshold and (best is None or diff["similarity"] > best["similarity"]):
+                best = {"id": doc_id, "document": old, "answer": answer, "findings": findings, **diff}
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return best
+
+    def add(self, document: str, query: str, answer: str, findings: str = "") -> int:
+        signature = minhash(document)
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT INTO documents (query, document, answer, findings, signature, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (query, document, answer, findings, json.dumps(signature), time.time()),
+            )
+            doc_id = cursor.lastrowid
+            self.conn.executemany(
+                "INSERT INTO bands (key, doc_id) VALUES (?, ?)", [(key, doc_id) for key in band_keys(signature, query)]
+            )
+            oldest = doc_id - self.max_entries
+            if oldest > 0:
+                self.conn.execute("DELETE FROM documents WHERE id <= ?", (oldest,))
+                self.conn.execute("DELETE FROM bands WHERE doc_id <= ?", (oldest,))
+            self.conn.commit()
+        return doc_id
+
+    def stats(self) -> dict:
+        with self._lock:
+            n = self.conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        return {"documents": n, "hits": self.hits, "misses": self.misses}
+
+
+_store = None
+_store_lock = Lock()
+
+
+def document_store() -> DocumentStore:
+    """
+    第一次使用时才打开数据库
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DocumentStore()
+    return _store
+
+
+def reuse_prompt(match: dict, query: str):
+    """
+    增量审核的提示词：已审核文档的结论、被删改的原句、新增或改写的句子及其候选规则。文档完全相同时返回None，不调用大模型
+    """
+    if not match["added"] and not match["removed"]:
+        return None
+    text = "\n".join(f"[{start}-{end}] {clause}" for start, end, clause in match["added"]) or "无"
+    kb = knowledge_base()
+    rules, terms = [], []
+    if match["added"]:
+        rules = [kb.rules[doc_id] for doc_id, _ in search_rules(text, k=reuse_rules_k, kb=kb)]
+        terms = [
+            f"{term}：{kb.terms(name)[term]}"
+            for name in ["insurance", "consumer_protection"]
+            for term in kb.automaton(name).find_all(text)
+        ]
+    removed = "；".join(match["removed"]) or "无"
+    return f"""
+    你是宣传文档的增量审核模块。当前文档和一份已审核文档高度相似，已审核文档的结论可以沿用，只需要审核有变化的内容。
+    任务指令为：{query}。
+    已审核文档的审核结论为：{match["answer"]}
+    已审核文档中被删除或改写的原句为：{removed}。只和这些句子有关的结论不再适用。
+    当前文档中新增或改写的句子为（方括号内是句子在当前文档中的起止位置）：
+    {text}
+    候选规则为：{rules}。其中fileName为审核规则的来源，rule为审核规则的内容。
+    相关术语为：{terms}。
+    请给出当前文档完整的最终答案：沿用仍然适用的结论，去掉只和被删除句子有关的结论，补充新增或改写句子的审核结果并引用其位置。
+    """
@@ -0,0 +1,48 @@
+"""
+文档切分
+
+按句子切分宣传文档并记录每句在原文中的位置，再把相邻句子合并成长度受控的片段
+"""
+
+import re
+
+sentence_end = re.compile(r"[^。！？!?；;～\n]*[。！？!?；;～\n]+|[^。！？!?；;～\n]+$")
+clause_end = re.compile(r"[^。！？!?；;～，,：:\n]*[。！？!?；;～，,：:\n]+|[^。！？!?；;～，,：:\n]+$")  # 按逗号再细分，比对改动时用
+
+
+def split_sentences(document: str, pattern=sentence_end) -> list:
+    """
+    返回[(起始位置, 结束位置, 句子), ...]，位置按原文字符计，句子去掉首尾空白
+    """
+    sentences = []
+    for match in pattern.finditer(document):
+        text = match.group()
+        stripped = text.strip()
+        if not stripped:
+            continue
+        start = match.start() + text.index(stripped)
+        sentences.append((start, start + len(stripped), stripped))
+    return sentences
+
+
+def chunk_document(document: str, max_chars: int = 300) -> list:
+    """
+    把句子合并成不超过max_chars的片段，单句超长时单独成段
+    返回[{"start": 起始位置, "end": 结束位置, "sentences": [(起始, 结束, 句子), ...]}, ...]
+    """
+    chunks = []
+    current = []
+    length = 0
+    for sentence in split_sentences(document):
+        n = len(sentence[2])
+        if current and length + n > max_chars:
+            chunks.append(current)
+            current, length = [], 0
+        current.append(sentence)
+        length += n
+    if current:
+        chunks.append(current)
+    return [
+        {"start": sentences[0][0], "end": sentences[-1][1], "sentences": sentences}
+        for sentences in chunks
+    ]
@@ -0,0 +1,3 @@
+from .Segment import split_sentences, chunk_document
+from .ChunkAudit import chunk_audit, achunk_audit, format_findings, document_view
+from .NearDuplicate import document_store, reuse_prompt, remap_findings
@@ -0,0 +1,112 @@
+"""
+拒答判断的本地预筛
+
+关键词词表 + 字符bigram朴素贝叶斯分类器，明确的问题在本地直接判断，
+只有拿不准的问题才交给大模型，省掉大部分请求在关键路径上的一次大模型调用。
+本地只看问题本身：多轮对话中的追问（比如“那这个呢”）要结合上下文才能判断目标是否明确，只能在本地拒答，不能直接回答。
+"""
+
+import json
+import math
+from collections import Counter
+from threading import Lock
+from Tools.Search.BM25Index import char_ngrams
+from Tools.Search.AhoCorasick import AhoCorasick
+
+accept_threshold = 0.95  # 分类器判为“回答”的最低概率
+reject_threshold = 0.95  # 命中风险词后判为“拒答”的最低概率
+min_coverage = 0.3  # 问题中在训练语料里出现过的bigram占比，太低说明分类器没见过这类问题
+
+
+class NaiveBayes:
+    def __init__(self, samples: list):
+        self.labels = sorted({sample["label"] for sample in samples})
+        self.gram_counts = {label: Counter() for label in self.labels}
+        self.doc_counts = Counter()
+        for sample in samples:
+            self.doc_counts[sample["label"]] += 1
+            self.gram_counts[sample["label"]].update(char_ngrams(sample["text"]))
+        self.vocab = set().union(*self.gram_counts.values())
+        self.totals = {label: sum(counts.values()) for label, counts in self.gram_counts.items()}
+
+    def coverage(self, grams: list) -> float:
+        return sum(1 for gram in grams if gram in self.vocab) / max(len(grams), 1)
+
+    def predict(self, grams: list) -> dict:
+        """
+        返回每个类别的后验概率
+        """
+        n_docs = sum(self.doc_counts.values())
+        scores = {}
+        for label in self.labels:
+            score = math.log(self.doc_counts[label] / n_docs)
+            denominator = self.totals[label] + len(self.vocab) + 1
+            for gram in grams:
+                if gram in self.vocab:
+                    score += math.log((self.gram_counts[label][gram] + 1) / denominator)
+            scores[label] = score
+        top = max(scores.values())
+        exp = {label: math.exp(score - top) for label, score in scores.items()}
+        total = sum(exp.values())
+        return {label: value / total for label, value in exp.items()}
+
+
+class SafetyFilter:
+    def __init__(self, path: str = "Tools/Safety/safety_lexicon.json"):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.risk_automaton = AhoCorasick(data["risk_words"])
+        self.domain_automaton = AhoCorasick(data["domain_words"])
+        self.classifier = NaiveBayes(data["samples"])
+        self.counts = Counter()
+        self._lock = Lock()
+
+    def classify(self, query: str, follow_up: bool = False):
+        """
+        返回“回答”或“拒答”，拿不准时返回None，交给大模型判断
+        follow_up为True表示会话里已有历史消息，本地只拒答明确违规的问题，其余都交给大模型结合上下文判断
+        """
+        grams = char_ngrams(query)
+        risk = self.risk_automaton.find_all(query)
+        if not grams:
+            verdict = None
+        elif self.classifier.coverage(grams) < min_coverage:
+            verdict = None
+        else:
+            prob = self.classifier.predict(grams)
+            if risk:
+                # 命中风险词时只在分类器也很确定时直接拒答，例如“宣传中的赌博式收益”这类审核问题仍交给大模型
+                verdict = "拒答" if prob.get("拒答", 0) >= reject_threshold else None
+            elif prob.get("回答", 0) >= accept_threshold and self.domain_automaton.find_all(query):
+                verdict = None if follow_up else "回答"
+            else:
+                verdict = None
+
+        with self._lock:
+            self.counts["total"] += 1
+            self.counts[verdict or "llm"] += 1
+            if follow_up and verdict is None:
+                self.counts["follow_up"] += 1
+        return verdict
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.counts["total"]
+            return {
+                "total": total,
+                "local_accept": self.counts["回答"],
+                "local_reject": self.counts["拒答"],
+                "llm": self.counts["llm"],
+                "follow_up_llm": self.counts["follow_up"],
+                "bypass_rate": (total - self.counts["llm"]) / total if total else 0.0,
+            }
+
+    def report(self) -> str:
+        stats = self.stats()
+        return (
+            f"拒答判断共{stats['total']}次，本地直接回答{stats['local_accept']}次，"
+            f"本地直接拒答{stats['local_reject']}次，交给大模型{stats['llm']}次，"
+            f"绕过率{stats['bypass_rate']:.1%}\n"
+            f"其中多轮追问交给大模型结合上下文判断{stats['follow_up_llm']}次"
+            f"（占{stats['follow_up_llm'] / stats['total'] if stats['total'] else 0:.1%}）"
+        )
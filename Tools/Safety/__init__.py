@@ -0,0 +1 @@
+from .SafetyFilter import SafetyFilter
@@ -0,0 +1,74 @@
+"""
+多模式匹配
+
+Aho-Corasick自动机，一次扫描文档找出词典中出现过的所有术语
+"""
+
+from collections import deque
+
+
+class AhoCorasick:
+    """
+    goto: 每个状态的转移表 {字符: 下一个状态}
+    fail: 失配时跳转的状态
+    output: 每个状态结束的术语序号（含沿fail链继承的）
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [p for p in patterns if p]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for idx, pattern in enumerate(self.patterns):
+            self._add(pattern, idx)
+        self._build_fail()
+
+    def _add(self, pattern: str, idx: int):
+        state = 0
+        for char in pattern:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = nxt
+        self.output[state].append(idx)
+
+    def _build_fail(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and char not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(char, 0)
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """
+        逐个产出(结束位置, 术语)，结束位置不含
+        """
+        state = 0
+        goto, fail, output = self.goto, self.fail, self.output
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for idx in output[state]:
+                yield pos + 1, self.patterns[idx]
+
+    def find_all(self, text: str) -> list:
+        """
+        文档中出现过的术语，按首次出现的顺序去重
+        """
+        seen = set()
+        found = []
+        for _, pattern in self.iter_matches(text):
+            if pattern not in seen:
+                seen.add(pattern)
+                found.append(pattern)
+        return found
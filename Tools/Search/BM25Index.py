@@ -0,0 +1,138 @@
+"""
+BM25检索
+
+基于中文字符n-gram的倒排索引，用于在调用大模型之前对规则库做本地初筛。
+索引构建一次后保存到磁盘，数据源不变时直接加载。
+"""
+
+import os
+import json
+import math
+import hashlib
+from collections import Counter
+
+
+def char_ngrams(text: str, n: int = 2) -> list:
+    """
+    把文本切成字符n-gram，标点和空白作为分隔符，不跨片段取n-gram
+    """
+    grams = []
+    piece = []
+    for char in text + " ":
+        if char.isalnum():
+            piece.append(char.lower())
+            continue
+        if piece:
+            if len(piece) < n:
+                grams.append("".join(piece))
+            else:
+                grams.extend(
+                    "".join(piece[i : i + n]) for i in range(len(piece) - n + 1)
+                )
+            piece = []
+    return grams
+
+
+def texts_hash(texts: list) -> str:
+    """
+    文本列表的指纹，用于判断磁盘上的索引是否过期
+    """
+    data = json.dumps(texts, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+class BM25Index:
+    """
+    倒排索引 + BM25打分
+
+    postings: {n-gram: [[文档序号, 词频], ...]}
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, n: int = 2):
+        self.k1 = k1
+        self.b = b
+        self.n = n
+        self.postings = {}
+        self.doc_len = []
+        self.avgdl = 0.0
+        self.source_hash = ""
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_len)
+
+    def build(self, texts: list) -> "BM25Index":
+        self.postings = {}
+        self.doc_len = []
+        for doc_id, text in enumerate(texts):
+            grams = char_ngrams(text, self.n)
+            self.doc_len.append(len(grams))
+            for gram, tf in Counter(grams).items():
+                self.postings.setdefault(gram, []).append([doc_id, tf])
+        self.avgdl = sum(self.doc_len) / max(self.n_docs, 1)
+        self.source_hash = texts_hash(texts)
+        return self
+
+    def idf(self, gram: str) -> float:
+        df = len(self.postings.get(gram, []))
+        return math.log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, text: str, k: int = 10) -> list:
+        """
+        返回得分最高的k个文档，形式为[(文档序号, 得分), ...]，得分为0的文档不返回
+        """
+        scores = {}
+        for gram in set(char_ngrams(text, self.n)):
+            postings = self.postings.get(gram)
+            if not postings:
+                continue
+            idf = self.idf(gram)
+            for doc_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / self.avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "n": self.n,
+            "source_hash": self.source_hash,
+            "doc_len": self.doc_len,
+            "postings": self.postings,
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"], n=data["n"])
+        index.source_hash = data["source_hash"]
+        index.doc_len = data["doc_len"]
+        index.postings = data["postings"]
+        index.avgdl = sum(index.doc_len) / max(index.n_docs, 1)
+        return index
+
+    @classmethod
+    def load_or_build(cls, texts: list, path: str) -> "BM25Index":
+        """
+        磁盘上有对应数据源的索引就直接加载，否则重新构建并保存
+        """
+        if os.path.exists(path):
+            try:
+                index = cls.load(path)
+                if index.source_hash == texts_hash(texts):
+                    return index
+            except (OSError, ValueError, KeyError):
+                pass
+        index = cls().build(texts)
+        try:
+            index.save(path)
+        except OSError:
+            pass  # 只读目录下不落盘，下次启动重新构建
+        return index
@@ -0,0 +1,104 @@
+"""
+大模型生成的术语定义
+
+知识库里查不到的术语由大模型给出定义，定义连同来源（模型、生成时间、所属术语库）一起持久化，
+下次遇到同一术语直接在本地回答。每次写入版本号加一，过期的定义重新生成。
+"""
+
+import os
+import json
+import time
+from threading import Lock
+
+generated_terms_ttl = 30 * 24 * 3600  # 生成定义的有效期，单位秒
+
+
+def parse_definitions(text: str, words: list) -> dict:
+    """
+    按“术语：定义”的格式解析大模型输出，只保留请求中的术语，一个术语的定义截到下一个术语为止
+    """
+    positions = []
+    for word in words:
+        for sep in ("：", ":"):
+            start = text.find(f"{word}{sep}")
+            if start != -1:
+                positions.append((start, start + len(word) + 1, word))
+                break
+    positions.sort()
+
+    definitions = {}
+    for i, (_, begin, word) in enumerate(positions):
+        end = positions[i + 1][0] if i + 1 < len(positions) else len(text)
+        definition = text[begin:end].strip().strip("。；;，,").strip()
+        if definition:
+            definitions[word] = definition
+    return definitions
+
+
+class GeneratedGlossary:
+    def __init__(self, name: str, path: str, ttl: int = generated_terms_ttl):
+        self.name = name  # 所属术语库，记录在来源里
+        self.path = path
+        self.ttl = ttl
+        self.version = 0
+        self.terms = {}  # {术语: {"definition", "source", "model", "created", "version"}}
+        self.mtime = None
+        self._lock = Lock()
+        self._load()
+
+    def _load(self):
+        """
+        其他进程写过文件时重新读取，文件损坏时当作空库
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.version = data["version"]
+            self.terms = data["terms"]
+        except (OSError, ValueError, KeyError):
+            return
+        self.mtime = mtime
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"name": self.name, "version": self.version, "terms": self.terms}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)  # 原子替换，读到的要么是旧版本要么是新版本
+        self.mtime = os.path.getmtime(self.path)
+
+    def get_many(self, words: list) -> dict:
+        """
+        返回未过期的{术语: 定义}
+        """
+        now = time.time()
+        with self._lock:
+            self._load()
+            return {
+                word: self.terms[word]["definition"]
+                for word in words
+                if word in self.terms and now - self.terms[word]["created"] < self.ttl
+            }
+
+    def add_many(self, definitions: dict, model: str = ""):
+        if not definitions:
+            return
+        with self._lock:
+            self._load()  # 先合并其他进程的写入
+            self.version += 1
+            now = time.time()
+            for word, definition in definitions.items():
+                self.terms[word] = {
+                    "definition": definition,
+                    "source": f"llm:{self.name}",
+                    "model": model,
+                    "created": now,
+                    "version": self.version,
+                }
+            self._save()
@@ -0,0 +1,414 @@
+"""
+知识库二进制格式
+
+把规则库、术语库连同BM25倒排索引、语义检索向量和术语匹配自动机预编译成一个二进制文件，运行时用mmap只读映射：
+启动时只读文件头，数据页在第一次访问时才由操作系统载入，多个进程映射同一文件时共享物理内存。
+数据源文件有变化时自动重新编译，也可以手动编译：python -m Tools.Search.KnowledgeBase
+
+文件结构：魔数(8字节) + 文件头长度(4字节) + JSON文件头 + 按8字节对齐的数据段。
+字符串表由UTF-8数据段和偏移数组组成，数组一律为uint32，语义检索的向量矩阵为float32。
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+from array import array
+from collections.abc import Mapping, Sequence
+from threading import Lock
+from .BM25Index import BM25Index
+from .AhoCorasick import AhoCorasick
+from .SemanticIndex import SemanticIndex, semantic_params, np
+
+kb_magic = b"CPKB0002"
+kb_path = "Tools/Search/cache/kb.bin"
+kb_sources = {
+    "rules": "Tools/Search/rules.json",
+    "insurance": "Tools/Search/insurance_terms.json",
+    "consumer_protection": "Tools/Search/consumer_protection_terms.json",
+}
+glossary_names = ["insurance", "consumer_protection"]
+
+
+def source_stats(sources: dict) -> dict:
+    """
+    数据源的大小和修改时间，用于判断编译结果是否过期
+    """
+    stats = {}
+    for name, path in sources.items():
+        stat = os.stat(path)
+        stats[name] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def uint32(values) -> array:
+    data = array("I", values)
+    assert data.itemsize == 4
+    return data
+
+
+class KBWriter:
+    def __init__(self):
+        self.sections = {}  # {名称: (字节, 类型码)}
+
+    def add_array(self, name: str, values):
+        self.sections[name] = (uint32(values).tobytes(), "I")
+
+    def add_floats(self, name: str, values):
+        self.sections[name] = (np.ascontiguousarray(values, dtype=np.float32).tobytes(), "f")
+
+    def add_semantic(self, name: str, texts: list):
+        index = SemanticIndex.build(texts)
+        self.add_floats(f"{name}.vectors", index.vectors)
+        self.add_floats(f"{name}.idf", index.idf)
+
+    def add_strings(self, name: str, texts: list):
+        """
+        字符串表，另外按UTF-8字节序存一份排序后的下标，用于二分查找
+        """
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = [0]
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        self.sections[f"{name}.data"] = (b"".join(encoded), "B")
+        self.add_array(f"{name}.offsets", offsets)
+        self.add_array(f"{name}.sorted", sorted(range(len(encoded)), key=lambda i: encoded[i]))
+
+    def write(self, path: str, meta: dict):
+        layout = {}
+        offset = 0
+        for name, (data, typecode) in self.sections.items():
+            layout[name] = [offset, len(data), typecode]
+            offset += -(-len(data) // 8) * 8
+        header = json.dumps({**meta, "sections": layout}, ensure_ascii=False).encode("utf-8")
+        base = len(kb_magic) + 4 + len(header)
+        padding = -(-base // 8) * 8 - base
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(kb_magic + struct.pack("<I", len(header)) + header + b"\0" * padding)
+            for data, _ in self.sections.values():
+                f.write(data + b"\0" * (-len(data) % 8))
+        os.replace(tmp_path, path)  # 原子替换，正在映射旧文件的进程不受影响
+
+
+def compile_kb(path: str = kb_path, sources: dict = kb_sources) -> str:
+    """
+    编译规则库和术语库，返回输出路径
+    """
+    stats = source_stats(sources)
+    writer = KBWriter()
+
+    with open(sources["rules"], "r", encoding="utf-8") as f:
+        rules = json.load(f)
+    writer.add_strings("rules.fileName", [rule["fileName"] for rule in rules])
+    writer.add_strings("rules.rule", [rule["rule"] for rule in rules])
+
+    index = BM25Index().build([f"{rule['fileName']}{rule['rule']}" for rule in rules])
+    grams = sorted(index.postings, key=lambda gram: gram.encode("utf-8"))
+    starts, docs, tfs = [0], [], []
+    for gram in grams:
+        for doc_id, tf in index.postings[gram]:
+            docs.append(doc_id)
+            tfs.append(tf)
+        starts.append(len(docs))
+    writer.add_strings("bm25.grams", grams)
+    writer.add_array("bm25.starts", starts)
+    writer.add_array("bm25.docs", docs)
+    writer.add_array("bm25.tfs", tfs)
+    writer.add_array("bm25.doc_len", index.doc_len)
+    if np is not None:
+        writer.add_semantic("rules", [rule["rule"] for rule in rules])
+
+    for name in glossary_names:
+        with open(sources[name], "r", encoding="utf-8") as f:
+            glossary = json.load(f)
+        automaton = AhoCorasick(glossary)
+        writer.add_strings(f"{name}.keys", list(glossary))
+        writer.add_strings(f"{name}.values", list(glossary.values()))
+        if np is not None:
+            # 术语按术语名编码：用相近说法查术语时，只比名称比带上定义更准
+            writer.add_semantic(name, list(glossary))
+        # 自动机状态按转移字符排序展开成数组
+        edge_start, edge_char, edge_next, out_start, out = [0], [], [], [0], []
+        keys = {key: i for i, key in enumerate(glossary)}
+        for state, edges in enumerate(automaton.goto):
+            for char in sorted(edges):
+                edge_char.append(ord(char))
+                edge_next.append(edges[char])
+            edge_start.append(len(edge_char))
+            out.extend(keys[automaton.patterns[idx]] for idx in automaton.output[state])
+            out_start.append(len(out))
+        writer.add_array(f"{name}.ac.edge_start", edge_start)
+        writer.add_array(f"{name}.ac.edge_char", edge_char)
+        writer.add_array(f"{name}.ac.edge_next", edge_next)
+        writer.add_array(f"{name}.ac.fail", automaton.fail)
+        writer.add_array(f"{name}.ac.out_start", out_start)
+        writer.add_array(f"{name}.ac.out", out)
+
+    writer.write(
+        path,
+        {
+            "byteorder": sys.byteorder,
+            "sources": stats,
+            "bm25": {"k1": index.k1, "b": index.b, "n": index.n, "avgdl": index.avgdl, "source_hash": index.source_hash},
+            "semantic": semantic_params(),
+        },
+    )
+    return path
+
+
+class StringTable(Sequence):
+    def __init__(self, data: memoryview, offsets: memoryview, order: memoryview):
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw(self, i: int) -> bytes:
+        return bytes(self.data[self.offsets[i] : self.offsets[i + 1]])
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.raw(i).decode("utf-8")
+
+    def find(self, text: str) -> int:
+        """
+        二分查找，返回下标，找不到返回-1
+        """
+        key = text.encode("utf-8")
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.order) and self.raw(self.order[lo]) == key:
+            return self.order[lo]
+        return -1
+
+
+class MappedRules(Sequence):
+    """
+    和rules.json一样按下标取{"fileName", "rule"}
+    """
+
+    def __init__(self, file_names: StringTable, rules: StringTable):
+        self.file_names = file_names
+        self.rules = rules
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def __getitem__(self, i: int) -> dict:
+        return {"fileName": self.file_names[i], "rule": self.rules[i]}
+
+
+class MappedGlossary(Mapping):
+    """
+    和术语json一样的{术语: 定义}，按原文件顺序遍历
+    """
+
+    def __init__(self, keys: StringTable, values: StringTable):
+        self.keys_table = keys
+        self.values_table = values
+
+    def __len__(self) -> int:
+        return len(self.keys_table)
+
+    def __iter__(self):
+        return iter(self.keys_table)
+
+    def key(self, i: int) -> str:
+        """
+        第i个术语，和语义检索的文档序号对应
+        """
+        return self.keys_table[i]
+
+    def __getitem__(self, key: str) -> str:
+        i = self.keys_table.find(key) if isinstance(key, str) else -1
+        if i == -1:
+            raise KeyError(key)
+        return self.values_table[i]
+
+
+class MappedPostings:
+    """
+    BM25Index.postings的只读视图：{n-gram: [(文档序号, 词频), ...]}
+    """
+
+    def __init__(self, grams: StringTable, starts: memoryview, docs: memoryview, tfs: memoryview):
+        self.grams = grams
+        self.starts = starts
+        self.docs = docs
+        self.tfs = tfs
+
+    def __len__(self) -> int:
+        return len(self.grams)
+
+    def get(self, gram: str, default=None):
+        i = self.grams.find(gram)
+        if i == -1:
+            return default
+        start, end = self.starts[i], self.starts[i + 1]
+        return list(zip(self.docs[start:end], self.tfs[start:end]))
+
+
+class MappedAhoCorasick(AhoCorasick):
+    """
+    从数组直接匹配的自动机，接口和AhoCorasick相同。
+    访问到的状态才把转移表和输出展开成字典缓存，匹配速度和AhoCorasick一致
+    """
+
+    def __init__(self, patterns: StringTable, edge_start, edge_char, edge_next, fail, out_start, out):
+        self.patterns = patterns
+        self.edge_start = edge_start
+        self.edge_char = edge_char
+        self.edge_next = edge_next
+        self.fail = fail
+        self.out_start = out_start
+        self.out = out
+        self.states = {}  # {状态: (转移表, 输出的术语)}
+
+    def _state(self, state: int):
+        cached = self.states.get(state)
+        if cached is None:
+            start, end = self.edge_start[state], self.edge_start[state + 1]
+            edges = {chr(self.edge_char[i]): self.edge_next[i] for i in range(start, end)}
+            outputs = tuple(self.patterns[self.out[i]] for i in range(self.out_start[state], self.out_start[state + 1]))
+            cached = self.states[state] = (edges, outputs)
+        return cached
+
+    def iter_matches(self, text: str):
+        state = 0
+        states, fail = self.states, self.fail
+        root = edges = self._state(0)[0]
+        for pos, char in enumerate(text):
+            while state and char not in edges:
+                state = fail[state]
+                edges = (states.get(state) or self._state(state))[0]
+            state = edges.get(char, 0)
+            if not state:
+                edges = root
+                continue
+            edges, outputs = states.get(state) or self._state(state)
+            for pattern in outputs:
+                yield pos + 1, pattern
+
+
+class KnowledgeBase:
+    """
+    映射后的知识库，各部分在第一次访问时才构造
+    """
+
+    def __init__(self, path: str = kb_path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[: len(kb_magic)] != kb_magic:
+            raise ValueError(f"{path}不是知识库文件")
+        (length,) = struct.unpack_from("<I", self.mm, len(kb_magic))
+        start = len(kb_magic) + 4
+        self.header = json.loads(self.mm[start : start + length].decode("utf-8"))
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path}的字节序与当前机器不一致")
+        self.base = -(-(start + length) // 8) * 8
+        self.view = memoryview(self.mm)
+        self.parts = {}
+        self._lock = Lock()
+
+    def section(self, name: str) -> memoryview:
+        offset, length, typecode = self.header["sections"][name]
+        data = self.view[self.base + offset : self.base + offset + length]
+        return data.cast(typecode) if typecode != "B" else data
+
+    def strings(self, name: str) -> StringTable:
+        return StringTable(self.section(f"{name}.data"), self.section(f"{name}.offsets"), self.section(f"{name}.sorted"))
+
+    def _part(self, key: str, build):
+        part = self.parts.get(key)
+        if part is None:
+            with self._lock:
+                part = self.parts.get(key)
+                if part is None:
+                    part = self.parts[key] = build()
+        return part
+
+    @property
+    def rules(self) -> MappedRules:
+        return self._part("rules", lambda: MappedRules(self.strings("rules.fileName"), self.strings("rules.rule")))
+
+    @property
+    def rules_index(self) -> BM25Index:
+        def build():
+            params = self.header["bm25"]
+            index = BM25Index(k1=params["k1"], b=params["b"], n=params["n"])
+            index.postings = MappedPostings(
+                self.strings("bm25.grams"),
+                self.section("bm25.starts"),
+                self.section("bm25.docs"),
+                self.section("bm25.tfs"),
+            )
+            index.doc_len = self.section("bm25.doc_len")
+            index.avgdl = params["avgdl"]
+            index.source_hash = params["source_hash"]
+            return index
+
+        return self._part("rules_index", build)
+
+    def terms(self, name: str) -> MappedGlossary:
+        return self._part(
+            f"{name}.terms", lambda: MappedGlossary(self.strings(f"{name}.keys"), self.strings(f"{name}.values"))
+        )
+
+    def semantic(self, name: str):
+        """
+        规则库（name为"rules"）或术语库的语义检索，编译时没有NumPy则返回None
+        """
+
+        def build():
+            if np is None or f"{name}.vectors" not in self.header["sections"]:
+                return None
+            idf = np.frombuffer(self.section(f"{name}.idf"), dtype=np.float32)
+            vectors = np.frombuffer(self.section(f"{name}.vectors"), dtype=np.float32).reshape(-1, len(idf))
+            return SemanticIndex(vectors, idf)
+
+        return self._part(f"{name}.semantic", build)
+
+    def automaton(self, name: str) -> MappedAhoCorasick:
+        return self._part(
+            f"{name}.automaton",
+            lambda: MappedAhoCorasick(
+                self.strings(f"{name}.keys"),
+                *[self.section(f"{name}.ac.{part}") for part in ["edge_start", "edge_char", "edge_next", "fail", "out_start", "out"]],
+            ),
+        )
+
+
+def knowledge_base():
+    """
+    当前的知识库快照，第一次调用时映射知识库文件，数据源有变化时叠加更新，见KnowledgeManager.py
+    """
+    from .KnowledgeManager import manager
+
+    return manager.snapshot()
+
+
+def knowledge_version() -> str:
+    """
+    当前知识库快照对应的数据源状态，规则库或术语库改动后变化，检索结果复用（Config/ToolMemo.py）的键里带上它
+    """
+    return json.dumps(knowledge_base().stamp, ensure_ascii=False, sort_keys=True)
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    path = compile_kb()
+    print(f"已编译{path}，{os.path.getsize(path)}字节，耗时{(time.perf_counter() - start) * 1000:.1f}ms")
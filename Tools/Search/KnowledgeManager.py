@@ -0,0 +1,430 @@
+"""
+知识库热更新
+
+规则库和术语库的JSON改动后不需要重启进程。KnowledgeManager定期检查数据源的大小和修改时间
+（设置了version_path时改为检查版本文件的内容），发现变化后在后台线程里和当前快照逐条比较，
+把新增、修改、删除的条目叠加到编译好的kb.bin上生成新快照：BM25倒排、语义向量和术语自动机都只处理变化的条目，
+被删除的条目留在原位但不再被检索到，已有的文档序号不变。新快照准备好后整体替换引用，
+正在执行的请求继续使用已经拿到的旧快照，不会被阻塞，也不会读到一半新一半旧的数据。
+叠加的条目超过compact_threshold时在后台重新编译kb.bin，编译完成后同样整体替换。
+"""
+
+import json
+import time
+from collections import Counter
+from collections.abc import Mapping, Sequence
+from threading import Lock, Thread
+from .AhoCorasick import AhoCorasick
+from .BM25Index import BM25Index, char_ngrams
+from .SemanticIndex import SemanticIndex, semantic_params, np
+from .KnowledgeBase import KnowledgeBase, compile_kb, source_stats, kb_path, kb_sources, glossary_names
+
+reload_interval = 2.0  # 两次检查数据源变化的最小间隔，单位秒
+compact_threshold = 200  # 叠加的变化条目数超过这个值时后台重新编译kb.bin
+version_path = None  # 版本文件，设置后只在它的内容变化时重新加载，数据源可以分几次写完再更新版本
+
+
+class OverlayRules(Sequence):
+    """
+    编译好的规则后面追加新增的规则，和MappedRules一样按下标取{"fileName", "rule"}
+    """
+
+    def __init__(self, base, added: tuple):
+        self.base = base
+        self.added = added
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.added)
+
+    def __getitem__(self, i: int) -> dict:
+        if i < len(self.base):
+            return self.base[i]
+        return self.added[i - len(self.base)]
+
+
+class OverlayPostings:
+    """
+    编译好的倒排表加上新增规则的倒排表，去掉已删除的规则
+    """
+
+    def __init__(self, base, added: dict, deleted: frozenset):
+        self.base = base
+        self.added = added
+        self.deleted = deleted
+
+    def get(self, gram: str, default=None):
+        postings = self.base.get(gram) or []
+        if self.deleted:
+            postings = [posting for posting in postings if posting[0] not in self.deleted]
+        extra = self.added.get(gram)
+        if extra:
+            postings = list(postings) + [posting for posting in extra if posting[0] not in self.deleted]
+        return postings or default
+
+
+class OverlayLengths(Sequence):
+    def __init__(self, base, added: list):
+        self.base = base
+        self.added = added
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.added)
+
+    def __getitem__(self, i: int) -> int:
+        if i < len(self.base):
+            return self.base[i]
+        return self.added[i - len(self.base)]
+
+
+class OverlayBM25(BM25Index):
+    """
+    叠加变化后的BM25，文档数和平均长度按有效的规则计算
+    """
+
+    def __init__(self, base: BM25Index, postings: dict, lengths: list, deleted: frozenset):
+        super().__init__(k1=base.k1, b=base.b, n=base.n)
+        self.postings = OverlayPostings(base.postings, postings, deleted)
+        self.doc_len = OverlayLengths(base.doc_len, lengths)
+        self.live = len(self.doc_len) - len(deleted)
+        total = base.avgdl * len(base.doc_len) + sum(lengths) - sum(self.doc_len[i] for i in deleted)
+        self.avgdl = total / max(self.live, 1)
+        self.source_hash = base.source_hash
+
+    @property
+    def n_docs(self) -> int:
+        return self.live
+
+
+class OverlaySemantic(SemanticIndex):
+    """
+    编译好的向量矩阵不复制，新增条目的向量单独一块，已删除的条目相似度记为-1
+    新增条目沿用编译时的idf，重新编译后才更新
+    """
+
+    def __init__(self, base: SemanticIndex, added, deleted: frozenset):
+        super().__init__(base.vectors, base.idf)
+        self.added = added
+        self.deleted = np.array(sorted(deleted), dtype=np.int64)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.vectors) + len(self.added)
+
+    def scores(self, texts: list):
+        queries = self.encode(texts)
+        scores = queries @ self.vectors.T
+        if len(self.added):
+            scores = np.hstack([scores, queries @ self.added.T])
+        if len(self.deleted):
+            scores[:, self.deleted] = -1.0
+        return scores
+
+
+class OverlayGlossary(Mapping):
+    """
+    编译好的术语库加上新增、修改和删除的术语。新增术语的序号接在编译好的术语后面，和语义检索的文档序号对应
+    """
+
+    def __init__(self, base, added: tuple, values: dict, deleted: frozenset):
+        self.base = base
+        self.added = added  # 新增的术语，按加入顺序
+        self.values = values  # 新增和修改过的{术语: 定义}
+        self.deleted = deleted
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.deleted:
+                yield key
+        for key in self.added:
+            if key not in self.deleted:
+                yield key
+
+    def __contains__(self, key) -> bool:
+        return key not in self.deleted and (key in self.values or key in self.base)
+
+    def __getitem__(self, key: str) -> str:
+        if key in self.deleted:
+            raise KeyError(key)
+        if key in self.values:
+            return self.values[key]
+        return self.base[key]
+
+    def key(self, i: int) -> str:
+        if i < len(self.base):
+            return self.base.key(i)
+        return self.added[i - len(self.base)]
+
+
+class OverlayAutomaton(AhoCorasick):
+    """
+    编译好的自动机加上只含新增术语的小自动机，两边的匹配按位置合并，去掉已删除的术语，接口和AhoCorasick相同
+    """
+
+    def __init__(self, base: AhoCorasick, added: AhoCorasick, deleted: frozenset):
+        self.base = base
+        self.added = added
+        self.deleted = deleted
+
+    def iter_matches(self, text: str):
+        matches = sorted([*self.base.iter_matches(text), *self.added.iter_matches(text)], key=lambda x: x[0])
+        for end, pattern in matches:
+            if pattern not in self.deleted:
+                yield end, pattern
+
+
+class KnowledgeSnapshot:
+    """
+    知识库快照：编译好的KnowledgeBase加上之后的变化，接口和KnowledgeBase一致，创建后不再修改
+    """
+
+    def __init__(self, base: KnowledgeBase, version: int = 0):
+        self.base = base
+        self.version = version
+        self.stamp = None  # 对应的数据源状态，由KnowledgeManager设置，重启进程后数据源不变时也不变
+        self.changes = 0  # 叠加的变化条目数
+        self.rules = base.rules
+        self.rules_index = base.rules_index
+        self.rules_added = ()
+        self.rules_deleted = frozenset()
+        self.rules_postings = {}
+        self.rules_lengths = []
+        self.rules_vectors = None
+        self._semantic = {"rules": base.semantic("rules")}
+        self._terms = {}
+        self._automata = {}
+        self.glossaries = {}  # {术语库: (新增术语, 新增和修改的定义, 删除的术语, 新增术语的向量)}
+        for name in glossary_names:
+            self._terms[name] = base.terms(name)
+            self._automata[name] = base.automaton(name)
+            self._semantic[name] = base.semantic(name)
+            self.glossaries[name] = ((), {}, frozenset(), None)
+
+    def semantic(self, name: str):
+        return self._semantic[name]
+
+    def terms(self, name: str):
+        return self._terms[name]
+
+    def automaton(self, name: str):
+        return self._automata[name]
+
+    def apply(self, sources: dict) -> "KnowledgeSnapshot":
+        """
+        和新的数据源{"rules": [...], 术语库: {...}}比较，返回叠加了变化的新快照，当前快照不变
+        """
+        snapshot = KnowledgeSnapshot.__new__(KnowledgeSnapshot)
+        snapshot.__dict__.update(self.__dict__)
+        snapshot._semantic = dict(self._semantic)
+        snapshot._terms = dict(self._terms)
+        snapshot._automata = dict(self._automata)
+        snapshot.glossaries = dict(self.glossaries)
+        snapshot.version = self.version + 1
+        snapshot._apply_rules(sources["rules"])
+        for name in glossary_names:
+            snapshot._apply_glossary(name, sources[name])
+        return snapshot
+
+    def _apply_rules(self, rules: list):
+        # 内容相同的规则视为同一条，修改等于删除旧的再新增
+        live = {}
+        for i in range(len(self.rules)):
+            if i not in self.rules_deleted:
+                rule = self.rules[i]
+                live.setdefault((rule["fileName"], rule["rule"]), []).append(i)
+        added = []
+        for rule in rules:
+            ids = live.get((rule["fileName"], rule["rule"]))
+            if ids:
+                ids.pop()
+            else:
+                added.append({"fileName": rule["fileName"], "rule": rule["rule"]})
+        deleted = {i for ids in live.values() for i in ids}
+        if not added and not deleted:
+            return
+
+        base = self.base.rules_index
+        postings = {gram: list(items) for gram, items in self.rules_postings.items()}
+        lengths = list(self.rules_lengths)
+        start = len(self.rules)
+        for doc_id, rule in enumerate(added, start):
+            grams = char_ngrams(f"{rule['fileName']}{rule['rule']}", base.n)
+            lengths.append(len(grams))
+            for gram, tf in Counter(grams).items():
+                postings.setdefault(gram, []).append((doc_id, tf))
+
+        self.rules_added = self.rules_added + tuple(added)
+        self.rules_deleted = self.rules_deleted | deleted
+        self.rules_postings = postings
+        self.rules_lengths = lengths
+        self.rules = OverlayRules(self.base.rules, self.rules_added)
+        self.rules_index = OverlayBM25(base, postings, lengths, self.rules_deleted)
+        semantic = self.base.semantic("rules")
+        if semantic is not None:
+            self.rules_vectors = self._stack(self.rules_vectors, semantic, [rule["rule"] for rule in added])
+            self._semantic["rules"] = OverlaySemantic(semantic, self.rules_vectors, self.rules_deleted)
+        self.changes += len(added) + len(deleted)
+
+    def _apply_glossary(self, name: str, glossary: dict):
+        current = self._terms[name]
+        added_keys, values, deleted, vectors = self.glossaries[name]
+        new_keys = [key for key in glossary if key not in current]
+        removed = {key for key in current if key not in glossary}
+        edited = {key: value for key, value in glossary.items() if key in current and current[key] != value}
+        if not new_keys and not removed and not edited:
+            return
+
+        base = self.base.terms(name)
+        values = {**values, **edited, **{key: glossary[key] for key in new_keys}}
+        # 删除后又加回来的术语沿用原来的序号
+        known = set(base) | set(added_keys)
+        fresh = [key for key in new_keys if key not in known]
+        added_keys = added_keys + tuple(fresh)
+        deleted = (deleted - set(new_keys)) | removed
+        semantic = self.base.semantic(name)
+        if semantic is not None:
+            vectors = self._stack(vectors, semantic, fresh)
+            ids = {base.keys_table.find(key) if key in base else len(base) + added_keys.index(key) for key in deleted}
+            self._semantic[name] = OverlaySemantic(semantic, vectors, frozenset(ids))
+
+        self.glossaries[name] = (added_keys, values, deleted, vectors)
+        self._terms[name] = OverlayGlossary(base, added_keys, values, deleted)
+        if new_keys or removed:
+            self._automata[name] = OverlayAutomaton(self.base.automaton(name), AhoCorasick(added_keys), deleted)
+        self.changes += len(new_keys) + len(removed) + len(edited)
+
+    @staticmethod
+    def _stack(vectors, semantic: SemanticIndex, texts: list):
+        rows = semantic.encode(texts) if texts else np.zeros((0, semantic.dim), dtype=np.float32)
+        return rows if vectors is None else np.vstack([vectors, rows])
+
+
+def load_sources(sources: dict = kb_sources) -> dict:
+    data = {}
+    for name, path in sources.items():
+        with open(path, "r", encoding="utf-8") as f:
+            data[name] = json.load(f)
+    return data
+
+
+class KnowledgeManager:
+    def __init__(self, path: str = kb_path, sources: dict = kb_sources):
+        self.path = path
+        self.sources = sources
+        self.current = None
+        self.stamp = None  # 当前快照对应的数据源状态
+        self.last_error = None
+        self._next_check = 0.0
+        self._reloading = False
+        self._lock = Lock()  # 保护首次加载和后台任务的启动
+        self._reload_lock = Lock()  # 同一时刻只有一个重新加载或重新编译
+
+    def _stamp(self):
+        if version_path is not None:
+            try:
+                with open(version_path, "r", encoding="utf-8") as f:
+                    return f.read().strip()
+            except OSError:
+                pass
+        return source_stats(self.sources)
+
+    def _open_base(self) -> KnowledgeBase:
+        """
+        映射kb.bin，文件不存在、损坏或向量编码参数变了时才重新编译；数据源的变化交给快照叠加
+        """
+        try:
+            kb = KnowledgeBase(self.path)
+            if kb.header["semantic"] == semantic_params():
+                return kb
+        except (OSError, ValueError, KeyError):
+            pass
+        return KnowledgeBase(compile_kb(self.path, self.sources))
+
+    def snapshot(self) -> KnowledgeSnapshot:
+        """
+        当前快照。第一次调用时加载，之后最多每reload_interval秒检查一次数据源，有变化时在后台更新，这里不等待
+        """
+        if self.current is None:
+            with self._lock:
+                if self.current is None:
+                    stamp = self._stamp()
+                    base = self._open_base()
+                    snapshot = KnowledgeSnapshot(base)
+                    if base.header["sources"] != source_stats(self.sources):
+                        snapshot = snapshot.apply(load_sources(self.sources))
+                    self.stamp = snapshot.stamp = stamp
+                    self.current = snapshot
+                    self._next_check = time.monotonic() + reload_interval
+                    if snapshot.changes > compact_threshold:
+                        self._start(self.compact)
+            return self.current
+
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + reload_interval
+            self._check()
+        return self.current
+
+    def _check(self):
+        try:
+            stamp = self._stamp()
+        except OSError:
+            return
+        if stamp != self.stamp:
+            with self._lock:
+                self._start(self.reload)
+
+    def _start(self, target):
+        if self._reloading:
+            return
+        self._reloading = True
+        Thread(target=self._run, args=(target,), daemon=True).start()
+
+    def _run(self, target):
+        try:
+            target()
+            if target != self.compact and self.current.changes > compact_threshold:
+                self.compact()
+        finally:
+            self._reloading = False
+
+    def reload(self) -> KnowledgeSnapshot:
+        """
+        读取数据源并叠加变化，可以直接调用。数据源正在写入、格式不对时保留当前快照，下次检查再试
+        """
+        with self._reload_lock:
+            stamp = self._stamp()
+            if self.current is not None and stamp == self.stamp:
+                return self.current
+            try:
+                snapshot = (self.current or self.snapshot()).apply(load_sources(self.sources))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                return self.current
+            self.last_error = None
+            snapshot.stamp = stamp
+            self.current = snapshot  # 整体替换引用，已经拿到旧快照的请求不受影响
+            self.stamp = stamp
+        return snapshot
+
+    def compact(self) -> KnowledgeSnapshot:
+        """
+        重新编译kb.bin，换成没有叠加层的快照，期间的请求继续用当前快照
+        """
+        with self._reload_lock:
+            stamp = self._stamp()
+            try:
+                base = KnowledgeBase(compile_kb(self.path, self.sources))
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                return self.current
+            snapshot = KnowledgeSnapshot(base, self.current.version + 1 if self.current else 0)
+            snapshot.stamp = stamp
+            self.current = snapshot
+            self.stamp = stamp
+        return snapshot
+
+
+manager = KnowledgeManager()
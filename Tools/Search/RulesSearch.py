@@ -4,15 +4,17 @@
 审核规则搜索
 """
 
-import json
 from langchain_core.tools import tool
 from langchain_core.runnables.config import RunnableConfig
 from langgraph.runtime import get_runtime
 from pydantic import BaseModel, Field
-from Config.LLM_Client import llm, lock
+from Config.LLM_Client import llm
+from Config.Console import ToolConsole
+from .KnowledgeBase import knowledge_base
+from .SemanticIndex import fuse, split_text
 
-with open("Tools/Search/rules.json", "r", encoding="utf-8") as f:
-    rules_all = json.load(f)
+top_k = 10  # 初筛后交给大模型的规则数，提示词长度只和它有关
+semantic_min_score = 0.03  # 语义检索的相似度低于这个值的规则不参与融合
 
 
 class RulesSearchInput(BaseModel):
@@ -20,6 +22,85 @@ class RulesSearchInput(BaseModel):
     query: str = Field(description="用户的任务指令", default="")
 
 
+def search_rules(text: str, k: int = top_k, kb=None) -> list:
+    """
+    BM25和语义检索（按句子）的排名融合，返回[(规则序号, 得分), ...]，知识库没有语义向量时只用BM25
+    kb为知识库快照，取规则内容时要用同一个快照，序号才对得上
+    """
+    # 规则库和索引在第一次检索时才映射
+    kb = kb or knowledge_base()
+    hits = kb.rules_index.search(text, k=k)
+    semantic = kb.semantic("rules")
+    if semantic is None:
+        return hits
+    return fuse([hits, semantic.search(split_text(text), k=k, min_score=semantic_min_score)], k=k)
+
+
+def retrieve_rules(query: str, document: str, kb=None) -> list:
+    """
+    初筛规则，返回[(规则序号, 得分), ...]。长文档按片段分别检索再融合，后半部分命中的规则也能进前top_k
+    """
+    # Tools.Audit依赖本模块的search_rules，这里延迟导入避免循环
+    from Tools.Audit.ChunkAudit import chunk_min_chars, chunk_max_chars
+    from Tools.Audit.Segment import chunk_document
+
+    kb = kb or knowledge_base()
+    if len(document) < chunk_min_chars:
+        return search_rules(f"{query}\n{document}", k=top_k, kb=kb)
+    rankings = [search_rules(query, k=top_k, kb=kb)] if query else []
+    for chunk in chunk_document(document, chunk_max_chars):
+        text = "".join(sentence for _, _, sentence in chunk["sentences"])
+        rankings.append(search_rules(text, k=top_k, kb=kb))
+    return fuse([ranking for ranking in rankings if ranking], k=top_k)
+
+
+def rules_prompt(query: str, document: str):
+    """
+    先用BM25和语义检索初筛，只把最相关的top_k条规则丢给大模型去匹配。没有相关规则时返回None
+    长文档只放开头部分，提示词长度不随文档增长
+    """
+    from Tools.Audit.ChunkAudit import document_view
+
+    kb = knowledge_base()
+    hits = retrieve_rules(query, document, kb=kb)
+    if not hits:
+        return None
+    rules = [kb.rules[doc_id] for doc_id, _ in hits]
+
+    return f"""
+    请根据你自己的理解，判断哪些消保审核规则适用于文档。
+    任务指令为：{query}。
+    文档内容为：{document_view(document)}。
+    规则清单为：{rules}。其中fileName为审核规则的来源，rule为审核规则的内容。
+    请结合任务指令，原样返回你认为适用于文档的审核规则内容和来源，最多不超过5条。
+    """
+
+
+no_rules = "规则库中未检索到与文档相关的审核规则。"
+cite_chars = 30  # 规则原文连续这么多字（规则更短时为全文）出现在回复里，视为引用了这条规则
+
+
+def cited(rule: str, result: str) -> bool:
+    rule = "".join(rule.split())
+    return bool(rule) and rule[:cite_chars] in result
+
+
+def validate_rules(result: str, args: dict, document: str = ""):
+    """
+    审核规则查询的结构校验，返回(是否通过, 说明)，通过时不需要大模型再做验证。
+    回复原样引用了本次初筛出的规则才通过，没有引用或者改写了规则时交给大模型验证
+    """
+    result = "".join(result.split())
+    if not result or result == no_rules:
+        return False, "没有检索到审核规则"
+    kb = knowledge_base()
+    hits = [doc_id for doc_id, _ in retrieve_rules(args.get("query", ""), document, kb=kb)]
+    quoted = [doc_id for doc_id in hits if cited(kb.rules[doc_id]["rule"], result)]
+    if not quoted:
+        return False, "回复没有引用初筛出的审核规则原文"
+    return True, f"引用了{len(quoted)}条初筛出的审核规则（序号{quoted}）"
+
+
 @tool(
     "审核规则查询",
     description="根据文档，查找适用于文档的消保审核规则。",
@@ -29,24 +110,30 @@ def rules_search(query: str, context: RunnableConfig) -> str: #简单的模拟
     """
     根据文档，查找适用于文档的消保审核规则。
     """
+    document = get_runtime(context).context.get("document", "")
+    prompt = rules_prompt(query, document)
+    with ToolConsole("\n🔎检索工具=审核规则查询") as console:
+        if prompt is None:
+            console.print(no_rules)
+            return no_rules
+        result = console.stream(llm, prompt)
 
-    print(f"\n🔎检索工具=审核规则查询")
-    rules = (
-        rules_all  # 当规则库很大的时候，要引入检索引擎初筛，不能全部丢个大模型去匹配。
-    )
+    return result
 
-    document = get_runtime(context).context.get("document", "")
-    prompt = f"""
-    请根据你自己的理解，判断哪些消保审核规则适用于文档。
-    任务指令为：{query}。
-    文档内容为：{document}。
-    规则清单为：{rules}。其中fileName为审核规则的来源，rule为审核规则的内容。
-    请结合任务指令，返回你认为适用于文档的审核规则内容，最多不超过5条。
+
+async def arules_search(query: str, context: RunnableConfig) -> str:
     """
-    result=""
-    with lock:
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            result += chunk.content
+    审核规则查询的异步版本
+    """
+    document = get_runtime(context).context.get("document", "")
+    prompt = rules_prompt(query, document)
+    with ToolConsole("\n🔎检索工具=审核规则查询") as console:
+        if prompt is None:
+            console.print(no_rules)
+            return no_rules
+        result = await console.astream(llm, prompt)
 
     return result
+
+
+rules_search.coroutine = arules_search
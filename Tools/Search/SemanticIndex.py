@@ -0,0 +1,154 @@
+"""
+语义检索
+
+规则和术语编码成哈希TF-IDF向量：字符1~3-gram哈希到固定维数，次线性词频乘以idf后做L2归一化，
+整个库存成一个NumPy矩阵，和知识库一起编译、mmap映射。查询时一次矩阵乘法算出所有查询和所有文档的余弦相似度。
+不需要网络和模型，能召回字面不完全一致的相近表述（如"犹豫期间"和"犹豫期"、"比存款利息高"和"与银行储蓄简单比较"），
+按句子查询，长文档里某一句相关的规则不会被其余内容稀释。和BM25的排名融合后使用。
+完全不共享字词的说法仍然召回不到，需要换成本地向量模型编码的矩阵，查询接口不变。
+没有安装NumPy时不可用，检索退回只用BM25。
+"""
+
+import re
+import zlib
+from .BM25Index import char_ngrams
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+vector_dim = 8192  # 哈希后的向量维数，越大哈希冲突越少，知识库文件越大
+ngram_sizes = (1, 2, 3)
+rrf_k = 60  # 排名融合的平滑常数
+sentence_sep = re.compile(r"[。！？!?；;～\n]+")
+
+
+def split_text(text: str) -> list:
+    """
+    按句切分查询文本，去掉空句
+    """
+    return [sentence.strip() for sentence in sentence_sep.split(text) if sentence.strip()]
+
+
+def semantic_params():
+    """
+    向量的编码参数，和知识库文件头里记录的不一致时重新编译，没有NumPy时为None
+    """
+    return None if np is None else {"dim": vector_dim, "ngram_sizes": list(ngram_sizes)}
+
+
+def hashed_grams(text: str, dim: int = vector_dim) -> dict:
+    """
+    字符n-gram哈希到桶，返回{桶: 次数}。用crc32而不是hash()，不同进程的结果一致
+    """
+    counts = {}
+    for n in ngram_sizes:
+        for gram in char_ngrams(text, n):
+            bucket = zlib.crc32(gram.encode("utf-8")) % dim
+            counts[bucket] = counts.get(bucket, 0) + 1
+    return counts
+
+
+class SemanticIndex:
+    """
+    vectors为(文档数, 维数)的float32矩阵，每行已归一化；idf为各维的权重
+    """
+
+    def __init__(self, vectors, idf):
+        self.vectors = vectors
+        self.idf = idf
+
+    @property
+    def dim(self) -> int:
+        return len(self.idf)
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.vectors)
+
+    @classmethod
+    def build(cls, texts: list, dim: int = vector_dim) -> "SemanticIndex":
+        counts = [hashed_grams(text, dim) for text in texts]
+        df = np.zeros(dim, dtype=np.float32)
+        for doc in counts:
+            df[list(doc)] += 1
+        idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+        index = cls(None, idf)
+        index.vectors = index._encode(counts)
+        return index
+
+    def _encode(self, counts: list):
+        matrix = np.zeros((len(counts), self.dim), dtype=np.float32)
+        for row, doc in enumerate(counts):
+            if doc:
+                buckets = np.fromiter(doc.keys(), dtype=np.int64, count=len(doc))
+                tfs = np.fromiter(doc.values(), dtype=np.float32, count=len(doc))
+                matrix[row, buckets] = 1 + np.log(tfs)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-12)
+
+    def encode(self, texts: list):
+        return self._encode([hashed_grams(text, self.dim) for text in texts])
+
+    def scores(self, texts: list):
+        """
+        (查询数, 文档数)的余弦相似度矩阵
+        """
+        return self.encode(texts) @ self.vectors.T
+
+    def search(self, texts, k: int = 10, min_score: float = 0.0) -> list:
+        """
+        texts可以是一段文本，也可以是多句文本（取每个文档在各句上的最高分），
+        返回得分最高的k个文档，形式为[(文档序号, 得分), ...]，和BM25Index.search一致
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        texts = [text for text in texts if text.strip()]
+        if not texts or not self.n_docs:
+            return []
+        scores = self.scores(texts).max(axis=0)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > min_score]
+
+    def neighbors(self, texts: list, k: int = 5, min_score: float = 0.0) -> list:
+        """
+        每个查询最相近的k个文档，返回[[(文档序号, 得分), ...], ...]，按得分从高到低
+        """
+        if not texts or not self.n_docs:
+            return [[] for _ in texts]
+        scores = self.scores(texts)
+        k = min(k, scores.shape[1])
+        results = []
+        for row in scores:
+            top = np.argpartition(-row, k - 1)[:k]
+            top = top[np.argsort(-row[top])]
+            results.append([(int(i), float(row[i])) for i in top if row[i] >= min_score])
+        return results
+
+    def nearest(self, texts: list, min_score: float = 0.0) -> list:
+        """
+        每个查询最相近的文档，返回[(文档序号, 得分)或None, ...]
+        """
+        if not texts or not self.n_docs:
+            return [None] * len(texts)
+        scores = self.scores(texts)
+        best = scores.argmax(axis=1)
+        return [
+            (int(i), float(scores[row, i])) if scores[row, i] >= min_score else None
+            for row, i in enumerate(best)
+        ]
+
+
+def fuse(rankings: list, k: int = 10) -> list:
+    """
+    倒数排名融合：多路检索结果[(文档序号, 得分), ...]按1/(rrf_k+名次)累加，返回前k个[(文档序号, 融合得分), ...]
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, (doc_id, _) in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1 / (rrf_k + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
@@ -3,17 +3,177 @@
 
 保险术语定义查询
 消保术语定义查询
+知识库没有原词的术语先用语义检索找同一术语的近义说法，仍未收录的由大模型生成定义并持久化，同一术语只生成一次
 """
 
-import json
+import difflib
+
 from langchain_core.tools import tool
 from langchain_core.runnables.config import RunnableConfig
 from langgraph.runtime import get_runtime
 from pydantic import BaseModel, Field
-from Config.LLM_Client import llm, lock
+from Config.LLM_Client import llm
+from Config.Console import ToolConsole
+from Config.Cache import model_signature
+from .AhoCorasick import AhoCorasick
+from .KnowledgeBase import knowledge_base
+from .GeneratedGlossary import GeneratedGlossary, parse_definitions
+
+term_min_score = 0.5  # 名称的语义相似度达到这个值才可能是同一术语的不同说法
+term_min_ratio = 0.8  # 同时字面相似度（difflib）也要达到这个值
+term_candidates = 5  # 每个说法取语义最相近的几个术语再按字面筛选
+short_forms = {"保险": "险"}  # 术语结尾的常见简写，分红保险即分红险
+
+
+def synonym(word: str, term: str) -> bool:
+    """
+    近义说法：字面相近，且不是一方包含另一方（投保人年龄和投保人、分红和分红险是不同的术语）
+    """
+    if word in term or term in word:
+        return False
+    return difflib.SequenceMatcher(None, word, term).ratio() >= term_min_ratio
+
+
+def nearest_terms(words: list, glossary, semantic) -> list:
+    """
+    每个说法在术语库中的近义术语，没有时为None。先按简写规则查原词，再用语义检索找字面相近的术语
+    """
+    found = []
+    for word, hits in zip(words, semantic.neighbors(words, k=term_candidates, min_score=term_min_score)):
+        short = [word[: -len(suffix)] + form for suffix, form in short_forms.items() if word.endswith(suffix)]
+        terms = [term for term in short if term in glossary]
+        terms += [term for term in (glossary.key(doc_id) for doc_id, _ in hits) if synonym(word, term)]
+        found.append(terms[0] if terms else None)
+    return found
+
+
+def lookup_terms(terms: list, document: str, glossary, automaton: AhoCorasick, console: ToolConsole, semantic=None):
+    """
+    先查工具调用中给出的术语，再扫描文档中出现的术语，返回(已查到的定义, 知识库未查到的术语)
+    semantic为术语库的语义检索（KnowledgeBase.semantic），原词查不到时找近义术语
+    """
+    parts = []  # 定义逐条追加，最后拼接一次
+    words = []
+    matched = set()  # 已经输出过定义的术语
+
+    # 检索工具调用中识别到的术语
+    for term in terms:
+        if term in glossary:
+            one_term = f"{term}：{glossary[term]}。"
+            console.print(one_term)
+            parts.append(one_term)
+            matched.add(term)
+        else:
+            words.append(term)
+            # print(f"{term}：未找到定义")
+
+    # 原词查不到的术语一次批量找近义术语，找不到的交给大模型定义
+    if words and semantic is not None:
+        unknown = []
+        for word, term in zip(words, nearest_terms(words, glossary, semantic)):
+            if term is None:
+                unknown.append(word)
+                continue
+            one_term = f"{word}（相近术语：{term}）：{glossary[term]}。"
+            console.print(one_term)
+            parts.append(one_term)
+            matched.add(term)
+        words = unknown
+
+    # 检索待审核文档是否存在关键词
+    if document != "":
+        for term in automaton.find_all(document):
+            if term not in matched:
+                one_term = f"{term}：{glossary[term]}。"
+                console.print(one_term)
+                parts.append(one_term)
+                matched.add(term)
+
+    return "".join(parts), words
+
+
+def validate_terms(name: str, result: str, args: dict, document: str = ""):
+    """
+    术语查询的结构校验，name为术语库：工具调用中给出的每个术语（没有给出时为文档中出现的术语）都是知识库收录的原词，
+    且结果中是知识库里的定义。相近术语和大模型生成的定义无法这样确认，交给大模型验证
+    """
+    if not result.strip():
+        return False, "没有查到任何术语定义"
+    kb = knowledge_base()
+    glossary = kb.terms(name)
+    terms = list(dict.fromkeys(args.get("terms", [])))
+    if not terms and document:
+        terms = list(dict.fromkeys(kb.automaton(name).find_all(document)))
+    if not terms:
+        return False, "没有给出术语，文档中也没有知识库收录的术语"
+    unverified = [term for term in terms if term not in glossary or f"{term}：{glossary[term]}。" not in result]
+    if unverified:
+        return False, f"术语{unverified}的定义不是知识库原词查到的"
+    return True, f"术语{terms}的定义都来自知识库"
+
+
+def validate_insurance_terms(result: str, args: dict, document: str = ""):
+    return validate_terms("insurance", result, args, document)
+
+
+def validate_consumer_protection_terms(result: str, args: dict, document: str = ""):
+    return validate_terms("consumer_protection", result, args, document)
+
+
+def terms_prompt(words: list) -> str:
+    return f"""
+        请根据你自己的理解，给出这些术语的定义，输出形式为：术语1：术语1的定义。术语2：术语2的定义...
+        术语清单为：{words}
+        """
+
+
+def model_name() -> str:
+    return str(model_signature(llm)["params"].get("model_name", ""))
+
+
+def recall_generated(words: list, generated: GeneratedGlossary, console: ToolConsole):
+    """
+    先查已生成过的定义，返回(已查到的定义, 需要大模型生成的术语)
+    """
+    known = generated.get_many(words)
+    parts = []
+    if known:
+        console.print("\n知识库未查到的术语，之前由LLM生成的定义如下：")
+        for word, definition in known.items():
+            one_term = f"{word}：{definition}。"
+            console.print(one_term)
+            parts.append(one_term)
+    return "".join(parts), [word for word in dict.fromkeys(words) if word not in known]
+
+
+def define_terms(words: list, generated: GeneratedGlossary, console: ToolConsole) -> str:
+    result, new_words = recall_generated(words, generated, console)
+    if not new_words:
+        return result
+
+    # 新术语一次请求批量生成
+    console.print("\n知识库未查到的术语，LLM自己的定义如下：")
+    response = console.stream(llm, terms_prompt(new_words))
+    # 超过截止时间被中断的定义不完整，不保存
+    if not console.truncated:
+        generated.add_many(parse_definitions(response, new_words), model_name())
+    return result + response
+
+
+async def adefine_terms(words: list, generated: GeneratedGlossary, console: ToolConsole) -> str:
+    result, new_words = recall_generated(words, generated, console)
+    if not new_words:
+        return result
+
+    console.print("\n知识库未查到的术语，LLM自己的定义如下：")
+    response = await console.astream(llm, terms_prompt(new_words))
+    if not console.truncated:
+        generated.add_many(parse_definitions(response, new_words), model_name())
+    return result + response
 
-with open("Tools/Search/insurance_terms.json", "r", encoding="utf-8") as f:
-    insurance_terms = json.load(f)
+
+# 术语库和匹配自动机在第一次查询时才从知识库映射，见knowledge_base().terms/automaton
+insurance_generated = GeneratedGlossary("保险术语", "Tools/Search/cache/generated_insurance_terms.json")
 
 
 class InsuranceSearchInput(BaseModel):
@@ -31,48 +191,40 @@ def insurance_terms_search(terms: list, context: RunnableConfig) -> str:
     """
     输入保险术语列表，输出每个术语的定义。
     """
+    document = get_runtime(context).context.get("document", "")
+    kb = knowledge_base()
+    with ToolConsole("\n🔎检索工具=保险术语查询") as console:
+        result, words = lookup_terms(
+            terms, document, kb.terms("insurance"), kb.automaton("insurance"), console, kb.semantic("insurance")
+        )
 
-    print(f"\n🔎检索工具=保险术语查询")
+        # 从LLM中获取术语定义
+        result += define_terms(words, insurance_generated, console)
 
-    result = ""
-    words = []
-    with lock:
-        # 检索工具调用中识别到的保险术语
-        # print("\n从任务指令中检索术语")
-        for term in terms:
-            if term in insurance_terms:
-                one_term = f"{term}：{insurance_terms[term]}。"
-                print(one_term)
-                result += one_term
-            else:
-                words.append(term)
-                # print(f"{term}：未找到定义")
-
-        # 检索待审核文档是否存在关键词
-        # print("\n从文档中检索术语")
-        document = get_runtime(context).context.get("document", "")
-        if document != "":
-            for term in insurance_terms:
-                if term in document and term not in result:
-                    one_term = f"{term}：{insurance_terms[term]}。"
-                    print(one_term)
-                    result += one_term
+    return result
 
-        # 从LLM中获取术语定义
-        print("\n知识库未查到的术语，LLM自己的定义如下：")
-        prompt = f"""
-        请根据你自己的理解，给出这些术语的定义，输出形式为：术语1：术语1的定义。术语2：术语2的定义...
-        术语清单为：{words}
-        """
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            result += chunk.content
+
+async def ainsurance_terms_search(terms: list, context: RunnableConfig) -> str:
+    """
+    保险术语查询的异步版本
+    """
+    document = get_runtime(context).context.get("document", "")
+    kb = knowledge_base()
+    with ToolConsole("\n🔎检索工具=保险术语查询") as console:
+        result, words = lookup_terms(
+            terms, document, kb.terms("insurance"), kb.automaton("insurance"), console, kb.semantic("insurance")
+        )
+        result += await adefine_terms(words, insurance_generated, console)
 
     return result
 
 
-with open("Tools/Search/consumer_protection_terms.json", "r", encoding="utf-8") as f:
-    consumer_protection_terms = json.load(f)
+insurance_terms_search.coroutine = ainsurance_terms_search
+
+
+consumer_protection_generated = GeneratedGlossary(
+    "消保术语", "Tools/Search/cache/generated_consumer_protection_terms.json"
+)
 
 
 class ConsumerProtectionSearchInput(BaseModel):
@@ -90,41 +242,42 @@ def consumer_protection_terms_search(terms: list, context: RunnableConfig) -> di
     """
     输入消保术语列表，输出每个术语的定义。
     """
+    document = get_runtime(context).context.get("document", "")
+    kb = knowledge_base()
+    with ToolConsole("\n🔎检索工具=消保术语查询") as console:
+        result, words = lookup_terms(
+            terms,
+            document,
+            kb.terms("consumer_protection"),
+            kb.automaton("consumer_protection"),
+            console,
+            kb.semantic("consumer_protection"),
+        )
 
-    print(f"\n🔎检索工具=消保术语查询")
+        # 从LLM中获取术语定义
+        result += define_terms(words, consumer_protection_generated, console)
 
-    result = ""
-    words = []
-    with lock:
-        # 检索工具调用中识别到的消保术语
-        print("\n从任务指令中检索术语")
-        for term in terms:
-            if term in consumer_protection_terms:
-                one_term = f"{term}：{consumer_protection_terms[term]}。"
-                print(one_term)
-                result += one_term
-            else:
-                words.append(term)
-                # print(f"{term}：未找到定义")
-
-        # 检索待审核文档是否存在关键词
-        print("\n从文档中检索术语")
-        document = get_runtime(context).context.get("document", "")
-        if document != "":
-            for term in consumer_protection_terms:
-                if term in document and term not in result:
-                    one_term = f"{term}：{consumer_protection_terms[term]}。"
-                    print(one_term)
-                    result += one_term
+    return result
 
-        # 从LLM中获取术语定义
-        print("\n知识库未查到的术语，LLM自己的定义如下：")
-        prompt = f"""
-        请根据你自己的理解，给出这些术语的定义，输出形式为：术语1：术语1的定义。术语2：术语2的定义...
-        术语清单为：{words}
-        """
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            result += chunk.content
+
+async def aconsumer_protection_terms_search(terms: list, context: RunnableConfig) -> dict:
+    """
+    消保术语查询的异步版本
+    """
+    document = get_runtime(context).context.get("document", "")
+    kb = knowledge_base()
+    with ToolConsole("\n🔎检索工具=消保术语查询") as console:
+        result, words = lookup_terms(
+            terms,
+            document,
+            kb.terms("consumer_protection"),
+            kb.automaton("consumer_protection"),
+            console,
+            kb.semantic("consumer_protection"),
+        )
+        result += await adefine_terms(words, consumer_protection_generated, console)
 
     return result
+
+
+consumer_protection_terms_search.coroutine = aconsumer_protection_terms_search
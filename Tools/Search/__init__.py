@@ -1,2 +1,14 @@
-from .TermsSearch import insurance_terms_search, consumer_protection_terms_search
-from .RulesSearch import rules_search
+from .TermsSearch import (
+    insurance_terms_search,
+    consumer_protection_terms_search,
+    validate_insurance_terms,
+    validate_consumer_protection_terms,
+)
+from .RulesSearch import rules_search, validate_rules
+
+# 检索工具的结构校验，结果能和知识库原文对上时行动验证不再调用大模型
+validators = {
+    "保险术语查询": validate_insurance_terms,
+    "消保术语查询": validate_consumer_protection_terms,
+    "审核规则查询": validate_rules,
+}
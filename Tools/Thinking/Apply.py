@@ -7,7 +7,8 @@
 from langchain_core.tools import tool
 from langgraph.prebuilt import InjectedState
 from pydantic import BaseModel, Field
-from Config.LLM_Client import llm, lock
+from Config.LLM_Client import llm
+from Config.Console import ToolConsole
 
 
 class AnswerInput(BaseModel):
@@ -16,6 +17,14 @@ class AnswerInput(BaseModel):
     query: str = Field(description="用户指令")
 
 
+def direct_answer_prompt(query: str) -> str:
+    return f"""
+    根据任务指令，直接回答问题。
+    任务指令是：{query}。
+    输出任务答案。
+    """
+
+
 @tool(
     "直接作答",
     description="当任务的上下文信息足够时，利用大模型本身的能力进行作答，并结束任务。",
@@ -25,27 +34,28 @@ def direct_answer(query: str) -> str:
     """
     当任务的上下文信息足够时，利用大模型本身的能力进行作答，并结束任务。
     """
-    prompt = f"""
-    根据任务指令，直接回答问题。
-    任务指令是：{query}。
-    输出任务答案。
-    """
-    with lock:
-        # 流式输出
-        chunks  = []
-        print(f"\n💡认知工具=直接作答")
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            chunks.append(chunk.content)
-
-        response = "".join(chunks)
+    prompt = direct_answer_prompt(query)
+    # 流式输出
+    with ToolConsole("\n💡认知工具=直接作答") as console:
+        response = console.stream(llm, prompt)
 
-        # # 完整输出
-        # response = llm.invoke(prompt).content
-        # print(f"\n💡认知工具=直接作答\n{response}")
+    # # 完整输出
+    # response = llm.invoke(prompt).content
+    # print(f"\n💡认知工具=直接作答\n{response}")
 
     return response
 
 
+async def adirect_answer(query: str) -> str:
+    """
+    直接作答的异步版本
+    """
+    with ToolConsole("\n💡认知工具=直接作答") as console:
+        return await console.astream(llm, direct_answer_prompt(query))
+
+
+direct_answer.coroutine = adirect_answer
+
+
 class RecognizingInput(BaseModel):
     query: str = Field(description="任务指令")
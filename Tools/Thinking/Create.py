@@ -10,7 +10,9 @@ from langgraph.prebuilt import InjectedState
 from langchain_core.runnables.config import RunnableConfig
 from langgraph.runtime import get_runtime
 from pydantic import BaseModel, Field
-from Config.LLM_Client import llm, lock
+from Config.LLM_Client import llm, context_manager
+from Config.Console import ToolConsole
+from Tools.Audit import document_view
 
 
 class DecomposeInput(BaseModel):
@@ -18,6 +20,16 @@ class DecomposeInput(BaseModel):
     messages: Annotated[list, InjectedState("messages")] = Field(description="历史上下文")
 
 
+def decompose_prompt(query: str, history: str, document: str) -> str:
+    return f"""
+    你是一个任务分解模块，你的职责是将当前任务指令拆解为若干个相对简单的子任务，拆解的子任务数不宜超过5个。
+    文档是：{document_view(document)}
+    任务指令是：{query}。
+    上下文是：{history}
+    输出格式为：子任务1, 子任务2, ...
+    """
+
+
 @tool(
     "任务分解",
     description="如果当前任务过于复杂，需要拆解为若干个相对简单的子任务。",
@@ -27,25 +39,27 @@ def decompose(query: str, messages: Annotated[list, InjectedState("messages")],
     """
     如果当前任务过于复杂，需要拆解为若干个相对简单的子任务。
     """
-    prompt = f"""
-    你是一个任务分解模块，你的职责是将当前任务指令拆解为若干个相对简单的子任务，拆解的子任务数不宜超过5个。
-    文档是：{get_runtime(context).context.get("document", "")}
-    任务指令是：{query}。
-    上下文是：{messages}
-    输出格式为：子任务1, 子任务2, ...
-    """
-    with lock:
-        # 流式输出
-        chunks  = []
-        print(f"\n💡认知工具=任务分解")
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            chunks.append(chunk.content)
-
-        response = "".join(chunks)
+    document = get_runtime(context).context.get("document", "")
+    prompt = decompose_prompt(query, context_manager.render(messages), document)
+    # 流式输出
+    with ToolConsole("\n💡认知工具=任务分解") as console:
+        response = console.stream(llm, prompt)
 
-        # # 完整输出
-        # response = llm.invoke(prompt).content
-        # print(f"\n💡认知工具=任务分解\n{response}")
+    # # 完整输出
+    # response = llm.invoke(prompt).content
+    # print(f"\n💡认知工具=任务分解\n{response}")
 
     return response
+
+
+async def adecompose(query: str, messages: Annotated[list, InjectedState("messages")], context: RunnableConfig) -> str:
+    """
+    任务分解的异步版本
+    """
+    document = get_runtime(context).context.get("document", "")
+    with ToolConsole("\n💡认知工具=任务分解") as console:
+        history = await context_manager.arender(messages)
+        return await console.astream(llm, decompose_prompt(query, history, document))
+
+
+decompose.coroutine = adecompose
@@ -12,13 +12,22 @@ from typing_extensions import Annotated
 from langchain_core.tools import tool
 from langgraph.prebuilt import InjectedState
 from pydantic import BaseModel, Field
-from Config.LLM_Client import llm, lock
+from Config.LLM_Client import llm, context_manager
+from Config.Console import ToolConsole
 
 
 class RecognizingInput(BaseModel):
     query: str = Field(description="任务指令")
 
 
+def recognizing_prompt(query: str) -> str:
+    return f"""
+    你是一个知识要素识别模块，你的任务是从任务指令中提取出任务的关键知识要素。
+    任务指令是：{query}。
+    输出格式为：[要素1, 要素2, ...]
+    """
+
+
 @tool(
     "要素识别",
     description="当任务指令中存在影响任务完成的关键信息要素（如时间、主体、规则、约束条件）时，需要通过识别工具从指令中提取出这些核心要素信息。",
@@ -28,33 +37,43 @@ def recognizing(query: str) -> str:
     """
     任务指令中存在影响任务完成的关键信息要素（如时间、主体、规则、约束条件）时，需要通过识别工具从指令中提取出这些核心要素信息。
     """
-    prompt = f"""
-    你是一个知识要素识别模块，你的任务是从任务指令中提取出任务的关键知识要素。
-    任务指令是：{query}。
-    输出格式为：[要素1, 要素2, ...]
-    """
-    with lock:
-        # 流式输出
-        chunks  = []
-        print(f"\n💡认知工具=要素识别")
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            chunks.append(chunk.content)
-
-        response = "".join(chunks)
+    prompt = recognizing_prompt(query)
+    # 流式输出
+    with ToolConsole("\n💡认知工具=要素识别") as console:
+        response = console.stream(llm, prompt)
 
-        # # 完整输出
-        # response = llm.invoke(prompt).content
-        # print(f"\n💡认知工具=要素识别\n{response}")
+    # # 完整输出
+    # response = llm.invoke(prompt).content
+    # print(f"\n💡认知工具=要素识别\n{response}")
 
     return response
 
 
+async def arecognizing(query: str) -> str:
+    """
+    要素识别的异步版本
+    """
+    with ToolConsole("\n💡认知工具=要素识别") as console:
+        return await console.astream(llm, recognizing_prompt(query))
+
+
+recognizing.coroutine = arecognizing
+
+
 class RecallingInput(BaseModel):
     query: str = Field(description="任务指令")
     messages: Annotated[list, InjectedState("messages")] = Field(description="历史上下文")
 
 
+def recalling_prompt(query: str, history: str) -> str:
+    return f"""
+    你是一个上下文回忆模块，你的任务是从历史上下文中，调取与当前任务相关的内容。
+    任务指令是：{query}。
+    上下文是：{history}
+    输出格式为：信息1, 信息2, ...
+    """
+
+
 @tool(
     "上下文回忆",
     description="当任务需要调用长时记忆来推进时，需要通过回忆工具从历史上下文调取与当前任务相关的内容。",
@@ -64,24 +83,25 @@ def recalling(query: str, messages: Annotated[list, InjectedState("messages")])
     """
     当任务需要调用长时记忆来推进时，需要通过回忆工具从历史上下文调取与当前任务相关的内容。
     """
-    prompt = f"""
-    你是一个上下文回忆模块，你的任务是从历史上下文中，调取与当前任务相关的内容。
-    任务指令是：{query}。
-    上下文是：{messages}
-    输出格式为：信息1, 信息2, ...
-    """
-    with lock:
-        # 流式输出
-        chunks  = []
-        print(f"\n💡认知工具=上下文回忆")
-        for chunk in llm.stream(prompt):
-            print(chunk.content, end="", flush=True)
-            chunks.append(chunk.content)
-
-        response = "".join(chunks)
+    prompt = recalling_prompt(query, context_manager.render(messages))
+    # 流式输出
+    with ToolConsole("\n💡认知工具=上下文回忆") as console:
+        response = console.stream(llm, prompt)
 
-        # # 完整输出
-        # response = llm.invoke(prompt).content
-        # print(f"\n💡认知工具=上下文回忆\n{response}")
+    # # 完整输出
+    # response = llm.invoke(prompt).content
+    # print(f"\n💡认知工具=上下文回忆\n{response}")
 
     return response
+
+
+async def arecalling(query: str, messages: Annotated[list, InjectedState("messages")]) -> str:
+    """
+    上下文回忆的异步版本
+    """
+    with ToolConsole("\n💡认知工具=上下文回忆") as console:
+        history = await context_manager.arender(messages)
+        return await console.astream(llm, recalling_prompt(query, history))
+
+
+recalling.coroutine = arecalling